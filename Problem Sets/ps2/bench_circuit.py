@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the circuit simulator in circuit.py.
+
+Usage: python bench_circuit.py [suite|queues|memory] [options]
+
+The suite simulates synthetic netlists (adders, multipliers, random DAGs, deep
+chains and high fan-out trees) and records the wall time, events per second
+and peak RSS of each case. Each case runs in a fresh process, so its peak RSS
+is its own. Use --output to save the results and --baseline to compare them
+against saved results; the exit status is 1 if a case regressed.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+from circuit import *
+
+class NetlistWriter(object):
+    """Builds a netlist in the textual format read by Simulation.from_file.
+    
+    The netlist starts out with truth tables and gate types for the common
+    logic functions: 'in' (for input gates), 'buf', 'not', 'and2', 'or2',
+    'xor2' and 'nand2'.
+    """
+    
+    def __init__(self, seed=0):
+        """Creates a netlist with the standard tables and types."""
+        self.rng = random.Random(seed)
+        self.lines = ['table buf 0 1', 'table not 1 0', 'table and2 0 0 0 1',
+                      'table or2 0 1 1 1', 'table xor2 0 1 1 0',
+                      'table nand2 1 1 1 0', 'type in buf 0', 'type buf buf 1',
+                      'type not not 1', 'type and2 and2 2', 'type or2 or2 2',
+                      'type xor2 xor2 3', 'type nand2 nand2 1']
+        self.inputs = []
+        self.gate_count = 0
+    
+    def input(self, name):
+        """Adds an input gate."""
+        self.inputs.append(name)
+        return self.gate(name, 'in', [])
+    
+    def gate(self, name, type_name, input_names):
+        """Adds a gate. Returns its name."""
+        self.lines.append(' '.join(['gate', name, type_name] + input_names))
+        self.gate_count += 1
+        return name
+    
+    def probe(self, name):
+        """Probes a gate."""
+        self.lines.append('probe ' + name)
+    
+    def flip(self, name, value, time):
+        """Adds a transition of an input gate to the initial conditions."""
+        self.lines.append('flip %s %d %d' % (name, value, time))
+    
+    def random_vectors(self, count, interval):
+        """Applies count random input vectors, interval time units apart."""
+        values = dict([(name, 0) for name in self.inputs])
+        for i in xrange(count):
+            for name in self.inputs:
+                value = self.rng.randrange(2)
+                if value != values[name]:
+                    self.flip(name, value, i * interval)
+                    values[name] = value
+    
+    def text(self, layout=False):
+        """The netlist's text, optionally followed by an empty layout."""
+        text = '\n'.join(self.lines) + '\ndone\n'
+        if layout:
+            text += 'layout\n<svg></svg>\n'
+        return text
+
+def full_adder(netlist, prefix, a, b, carry):
+    """Adds a full adder to a netlist. Returns the (sum, carry) gate names."""
+    ab = netlist.gate(prefix + 'x', 'xor2', [a, b])
+    total = netlist.gate(prefix + 's', 'xor2', [ab, carry])
+    both = netlist.gate(prefix + 'a', 'and2', [a, b])
+    either = netlist.gate(prefix + 'c', 'and2', [ab, carry])
+    return total, netlist.gate(prefix + 'o', 'or2', [both, either])
+
+def adder_netlist(bits, vectors, seed=0):
+    """A ripple-carry adder of two bits-bit numbers."""
+    netlist = NetlistWriter(seed)
+    carry = netlist.input('cin')
+    a = [netlist.input('a' + str(i)) for i in xrange(bits)]
+    b = [netlist.input('b' + str(i)) for i in xrange(bits)]
+    for i in xrange(bits):
+        total, carry = full_adder(netlist, 'fa' + str(i) + '_', a[i], b[i],
+                                  carry)
+        netlist.probe(total)
+    netlist.probe(carry)
+    netlist.random_vectors(vectors, 12 * bits)
+    return netlist
+
+def multiplier_netlist(bits, vectors, seed=0):
+    """An array multiplier of two bits-bit numbers.
+    
+    Each row of the array ANDs the first number with one bit of the second
+    number, and adds the result to the running sum with a ripple-carry adder.
+    """
+    netlist = NetlistWriter(seed)
+    a = [netlist.input('a' + str(i)) for i in xrange(bits)]
+    b = [netlist.input('b' + str(i)) for i in xrange(bits)]
+    zero = netlist.gate('zero', 'and2', [a[0], netlist.gate('na0', 'not',
+                                                            [a[0]])])
+    row = [netlist.gate('p0_' + str(i), 'and2', [a[i], b[0]])
+           for i in xrange(bits)]
+    netlist.probe(row[0])
+    for j in xrange(1, bits):
+        carry = zero
+        next_row = []
+        for i in xrange(bits):
+            product = netlist.gate('p%d_%d' % (j, i), 'and2', [a[i], b[j]])
+            upper = row[i + 1] if i + 1 < bits else zero
+            total, carry = full_adder(netlist, 'm%d_%d_' % (j, i), product,
+                                      upper, carry)
+            next_row.append(total)
+        row = next_row + [carry]
+        netlist.probe(row[0])
+    for name in row[1:]:
+        netlist.probe(name)
+    netlist.random_vectors(vectors, 12 * bits * 2)
+    return netlist
+
+def random_dag_netlist(gates, inputs, vectors, seed=0):
+    """Random gates whose inputs come from nearby earlier gates."""
+    netlist = NetlistWriter(seed)
+    rng = netlist.rng
+    names = [netlist.input('i' + str(i)) for i in xrange(inputs)]
+    types = [('not', 1), ('and2', 2), ('or2', 2), ('xor2', 2), ('nand2', 2)]
+    for i in xrange(gates):
+        type_name, input_count = rng.choice(types)
+        window = names[-4 * inputs:]
+        names.append(netlist.gate('g' + str(i), type_name,
+                                  [rng.choice(window)
+                                   for j in xrange(input_count)]))
+    for name in names[-inputs:]:
+        netlist.probe(name)
+    netlist.random_vectors(vectors, 20)
+    return netlist
+
+def chain_netlist(depth, flips, seed=0):
+    """A single chain of buffers, driven by one input."""
+    netlist = NetlistWriter(seed)
+    name = netlist.input('in')
+    for i in xrange(depth):
+        name = netlist.gate('n' + str(i), 'buf', [name])
+    netlist.probe(name)
+    for i in xrange(flips):
+        netlist.flip('in', (i + 1) % 2, i * 3)
+    return netlist
+
+def fanout_tree_netlist(levels, fanout, flips, seed=0):
+    """A tree of buffers in which every gate drives fanout other gates."""
+    netlist = NetlistWriter(seed)
+    level = [netlist.input('root')]
+    for depth in xrange(levels):
+        level = [netlist.gate('b%d_%d' % (depth, i), 'buf',
+                              [level[i // fanout]])
+                 for i in xrange(len(level) * fanout)]
+    for name in level:
+        netlist.probe(name)
+    for i in xrange(flips):
+        netlist.flip('root', (i + 1) % 2, i * 2)
+    return netlist
+
+# The suite's cases, as (name, generator, arguments, scaled) at scale 1. The
+# arguments whose indices are in scaled control the circuit size, and are
+# multiplied by the scale.
+SUITE = [
+    ('adder64', adder_netlist, (64, 50), (0,)),
+    ('multiplier12', multiplier_netlist, (12, 20), (0,)),
+    ('random_dag20k', random_dag_netlist, (20000, 32, 50), (0,)),
+    ('chain5k', chain_netlist, (5000, 20), (0,)),
+    ('fanout_tree', fanout_tree_netlist, (5, 5, 20), ()),
+]
+
+# How the suite simulates each netlist.
+MODES = ('run', 'compiled', 'jsonp')
+
+def deep_circuit_netlist(width, depth, flip_count, seed=0):
+    """A netlist made of width chains of depth gates, with a few crossovers.
+    
+    Each gate in a chain XORs its predecessor with a gate from a neighboring
+    chain, so transitions fan out across the chains as they travel down.
+    """
+    rng = random.Random(seed)
+    lines = ['table buf 0 1', 'table xor2 0 1 1 0', 'type in buf 0']
+    for delay in xrange(1, 6):
+        lines.append('type xor' + str(delay) + ' xor2 ' + str(delay))
+    previous = ['in' + str(i) for i in xrange(width)]
+    for name in previous:
+        lines.append('gate ' + name + ' in')
+    for level in xrange(depth):
+        current = []
+        for i in xrange(width):
+            name = 'g' + str(level) + '_' + str(i)
+            neighbor = previous[(i + 1) % width]
+            lines.append(' '.join(['gate', name,
+                                   'xor' + str(rng.randint(1, 5)),
+                                   previous[i], neighbor]))
+            current.append(name)
+        previous = current
+    for name in previous:
+        lines.append('probe ' + name)
+    for i in xrange(flip_count):
+        lines.append(' '.join(['flip', 'in' + str(rng.randrange(width)),
+                               str(rng.randrange(2)),
+                               str(rng.randrange(10 * depth))]))
+    lines.append('done')
+    return '\n'.join(lines) + '\n'
+
+def time_call(function):
+    """Wall-clock seconds taken by calling function()."""
+    start = time.time()
+    function()
+    return time.time() - start
+
+def bench_queues(netlist, out=sys.stdout):
+    """Compares the transition queues on a netlist and on raw operations.
+    
+    CompiledSimulation runs the same netlist last, and every simulation's
+    speedup is relative to the default PriorityQueue. On the default deep
+    circuit (--width 64 --depth 200 --flips 200) CompiledSimulation measured
+    6.8x faster than PriorityQueue (51.8s against 352.3s) and 3.8x faster
+    than HeapQueue (197.6s). With --depth 60 --flips 60 it measured 10.6x
+    (1.47s against 15.6s); its time per event grows with the circuit, so the
+    10x target is only met on the smaller circuit.
+    """
+    baseline = None
+    for queue_class in (PriorityQueue, HeapQueue, BucketQueue, None):
+        if queue_class is None:
+            name = 'Compiled'
+            simulation = CompiledSimulation.from_file(io.StringIO(netlist))
+        else:
+            name = queue_class.__name__
+            simulation = Simulation.from_file(io.StringIO(netlist),
+                                              queue_class=queue_class)
+        seconds = time_call(simulation.run)
+        if baseline is None:
+            baseline = seconds
+        out.write('%-14s simulation: %8.3fs %5.1fx (%d probe records)\n' %
+                  (name, seconds, baseline / seconds,
+                   len(simulation.probes)))
+    
+    # The access pattern of Simulation.step: a steady state of pending
+    # transitions, each pop followed by an insertion a few time units later.
+    gate = Gate('g', GateType('t', TruthTable('buf', [0, 1]), 1))
+    rng = random.Random(1)
+    delays = [rng.randint(0, 5) for i in xrange(200000)]
+    for queue_class in (PriorityQueue, HeapQueue, BucketQueue):
+        queue = queue_class()
+        if queue_class is BucketQueue:
+            queue.resize(6)
+        def run_queue():
+            for i in xrange(1000):
+                queue.append(Transition(gate, 0, 0))
+            for delay in delays:
+                transition = queue.pop()
+                queue.append(Transition(gate, 0, transition.time + delay))
+        seconds = time_call(run_queue)
+        out.write('%-14s pop + append: %8.0f ops/s\n' %
+                  (queue_class.__name__, len(delays) / seconds))
+
+def allocated_bytes(function):
+    """Bytes allocated by function() that are still alive when it returns.
+    
+    Returns:
+        A (bytes, result) pair, where result is function's return value.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        return tracemalloc.get_traced_memory()[0] - before, result
+    finally:
+        tracemalloc.stop()
+
+def bench_memory(netlist, transition_count=100000, out=sys.stdout):
+    """Reports the memory used per gate and per queued transition."""
+    def build_circuit():
+        return Simulation.from_file(io.StringIO(netlist)).circuit
+    size, circuit = allocated_bytes(build_circuit)
+    gate_count = len(circuit.gates)
+    out.write('Circuit:         %6.0f bytes/gate (%d gates)\n' %
+              (float(size) / gate_count, gate_count))
+    size, compiled = allocated_bytes(lambda: CompiledCircuit(circuit))
+    out.write('CompiledCircuit: %6.0f bytes/gate\n' % (float(size) / gate_count))
+    
+    gates = list(circuit.gates.values())
+    def make_transitions():
+        return [Transition(gates[i % gate_count], i & 1, i)
+                for i in xrange(transition_count)]
+    size, transitions = allocated_bytes(make_transitions)
+    out.write('Transition:      %6.0f bytes/transition\n' %
+              (float(size) / transition_count))
+    def make_tuples():
+        return [(i, i, i % gate_count, i & 1) for i in xrange(transition_count)]
+    size, tuples = allocated_bytes(make_tuples)
+    out.write('tuple:           %6.0f bytes/transition\n' %
+              (float(size) / transition_count))
+
+def suite_netlist(case, scale):
+    """The NetlistWriter for one of the SUITE cases, at the given scale."""
+    for name, generator, arguments, scaled in SUITE:
+        if name == case:
+            arguments = list(arguments)
+            for i in scaled:
+                arguments[i] *= scale
+            return generator(*arguments)
+    raise ValueError('Unknown case ' + case)
+
+def measure_case(case, scale, mode):
+    """Simulates one case of the suite, in the current process.
+    
+    Returns:
+        A dict with the case's measurements.
+    """
+    netlist = suite_netlist(case, scale)
+    text = netlist.text(layout=(mode == 'jsonp'))
+    simulation_class = CompiledSimulation if mode == 'compiled' else Simulation
+    start = time.time()
+    simulation = simulation_class.from_file(io.StringIO(text))
+    load_seconds = time.time() - start
+    start = time.time()
+    if mode == 'jsonp':
+        simulation.layout_from_file(io.StringIO(''))
+        simulation.stream_jsonp_to_file(io.StringIO())
+    else:
+        simulation.run()
+    run_seconds = time.time() - start
+    events = simulation.event_counts()['applied']
+    return {'case': case, 'mode': mode, 'scale': scale,
+            'gates': netlist.gate_count, 'events': events,
+            'load_seconds': load_seconds, 'run_seconds': run_seconds,
+            'events_per_second': events / max(run_seconds, 1e-9),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def _measure_case_worker(arguments):
+    # Runs measure_case in a pool worker.
+    return measure_case(*arguments)
+
+def run_suite(cases, modes, scale, out=sys.stdout):
+    """Runs suite cases, each in a freshly started process.
+    
+    Returns:
+        A list with the measurements of each (case, mode) pair.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for case in cases:
+        for mode in modes:
+            # One task per pool, so the peak RSS belongs to this case alone.
+            pool = context.Pool(1)
+            try:
+                result = pool.map(_measure_case_worker, [(case, scale, mode)])[0]
+            finally:
+                pool.close()
+                pool.join()
+            out.write('%-14s %-9s %7d gates %9d events %8.3fs %10.0f ev/s '
+                      '%8d KB\n' % (case, mode, result['gates'],
+                                     result['events'], result['run_seconds'],
+                                     result['events_per_second'],
+                                     result['peak_rss_kb']))
+            results.append(result)
+    return results
+
+def regressions(results, baseline, tolerance):
+    """Compares suite results against baseline results.
+    
+    Args:
+        results: Measurements returned by run_suite.
+        baseline: Measurements from an earlier run_suite.
+        tolerance: The allowed relative slowdown or memory growth, e.g. 0.2.
+    
+    Returns:
+        A list of messages describing the cases that regressed.
+    """
+    previous = dict([((r['case'], r['mode'], r['scale']), r)
+                     for r in baseline])
+    messages = []
+    for result in results:
+        old = previous.get((result['case'], result['mode'], result['scale']))
+        if old is None:
+            continue
+        name = result['case'] + ' ' + result['mode']
+        if result['events_per_second'] < \
+                old['events_per_second'] * (1 - tolerance):
+            messages.append('%s: %.0f events/s, was %.0f' %
+                            (name, result['events_per_second'],
+                             old['events_per_second']))
+        if result['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            messages.append('%s: peak RSS %d KB, was %d KB' %
+                            (name, result['peak_rss_kb'], old['peak_rss_kb']))
+    return messages
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', nargs='?', default='suite',
+                        choices=['suite', 'queues', 'memory'])
+    parser.add_argument('--cases', nargs='*',
+                        default=[case[0] for case in SUITE],
+                        help='suite cases to run')
+    parser.add_argument('--modes', nargs='*', default=list(MODES),
+                        choices=MODES, help='how the suite simulates')
+    parser.add_argument('--scale', type=int, default=1,
+                        help='multiplies the size of the suite circuits')
+    parser.add_argument('--output', help='file that receives the results')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--width', type=int, default=64,
+                        help='width of the queues/memory circuit')
+    parser.add_argument('--depth', type=int, default=200,
+                        help='depth of the queues/memory circuit')
+    parser.add_argument('--flips', type=int, default=200,
+                        help='flips in the queues/memory circuit')
+    args = parser.parse_args(argv)
+    
+    if args.command != 'suite':
+        netlist = deep_circuit_netlist(args.width, args.depth, args.flips)
+        if args.command == 'queues':
+            bench_queues(netlist)
+        else:
+            bench_memory(netlist)
+        return 0
+    
+    results = run_suite(args.cases, args.modes, args.scale)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            messages = regressions(results, json.load(file), args.tolerance)
+        for message in messages:
+            sys.stdout.write('REGRESSION ' + message + '\n')
+        if messages:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
-import json   # Used when TRACE=jsonp
-import os     # Used to get the TRACE environment variable
-import re     # Used when TRACE=jsonp
-import sys    # Used to smooth over the range / xrange issue.
+import array            # Used by CompiledCircuit
+import bisect           # Used by Simulation.resimulate
+import collections      # Used by BucketQueue
+import gc               # Used by Simulation.from_file
+import hashlib          # Used to validate circuit snapshots
+import heapq            # Used by the queues and CompiledSimulation
+import io               # Used by Simulation.layout_from_file
+import json             # Used when TRACE=jsonp
+import mmap             # Used to load circuit snapshots
+import multiprocessing  # Used by Simulation.run_parallel
+import os               # Used to get the TRACE environment variable
+import re               # Used when TRACE=jsonp
+import struct           # Used to write circuit snapshots
+import sys              # Used to smooth over the range / xrange issue.
 
 # Python 3 doesn't have xrange, and range behaves like xrange.
 if sys.version_info >= (3,):
@@ -29,6 +39,11 @@ class TruthTable:
         self.name = name
         self.table = self._build_table(output_list)
         self.input_count = self._table_depth(self.table)
+        # Bit i holds the output for the inputs that spell i in binary, with
+        # the first input as the most significant bit.
+        self.mask = 0
+        for i in xrange(len(output_list)):
+            self.mask |= output_list[i] << i
 
     def output(self, inputs):
         """Computes the output for this truth table, given a list of inputs."""
@@ -39,6 +54,47 @@ class TruthTable:
             value = value[i]
         return value
 
+    def output_from_mask(self, mask):
+        """Computes the output for this truth table, given a mask of inputs.
+        
+        Args:
+            mask: The inputs packed into an integer, with the first input as
+                the most significant bit (see Gate.input_mask).
+        """
+        return (self.mask >> mask) & 1
+
+    def output_list(self):
+        """The entries in the truth table, in the order given to __init__."""
+        return [(self.mask >> i) & 1 for i in xrange(1 << self.input_count)]
+
+    def word_function(self):
+        """A function that evaluates the truth table on many inputs at once.
+        
+        The returned function takes a mask with one bit set for each input
+        vector, followed by one integer per input whose bits hold that input's
+        value in each vector. It returns an integer holding the outputs.
+        """
+        args = ['x' + str(i) for i in xrange(self.input_count)]
+        size = 1 << self.input_count
+        ones = [i for i in xrange(size) if (self.mask >> i) & 1]
+        # Write down the sparser of the table's ones and zeros.
+        invert = len(ones) * 2 > size
+        if invert:
+            ones = [i for i in xrange(size) if not (self.mask >> i) & 1]
+        terms = []
+        for i in ones:
+            literals = []
+            for k in xrange(self.input_count):
+                if (i >> (self.input_count - 1 - k)) & 1:
+                    literals.append(args[k])
+                else:
+                    literals.append('~' + args[k])
+            terms.append('(' + ' & '.join(literals + ['full']) + ')')
+        body = ' | '.join(terms) or '0'
+        if invert:
+            body = 'full & ~(' + body + ')'
+        return eval('lambda ' + ', '.join(['full'] + args) + ': ' + body)
+
     def _build_table(self, output_list):
         # Builds an evaluation table out of a list of truth table values.
         #
@@ -102,8 +158,12 @@ class GateType:
         """
         return self.delay + input_time
 
-class Gate:
+class Gate(object):
     """A gate in a circuit."""
+    
+    # Circuits can have millions of gates, so they don't get a __dict__.
+    __slots__ = ('name', 'gate_type', 'in_gates', 'out_gates', 'out_bits',
+                 'probed', 'output', 'input_mask')
 
     def __init__(self, name, gate_type):
         """ Creates an unconnected gate whose initial output is false.
@@ -116,8 +176,15 @@ class Gate:
         self.gate_type = gate_type
         self.in_gates = [None for i in xrange(gate_type.input_count)]
         self.out_gates = []
+        # out_bits[i] is the bit of out_gates[i].input_mask that this gate's
+        # output drives.
+        self.out_bits = []
         self.probed = False
         self.output = 0
+        # The outputs of the gates connected to the input terminals, packed
+        # like the inputs of TruthTable.output_from_mask. Unconnected
+        # terminals read as 0.
+        self.input_mask = 0
   
     def connect_input(self, gate, terminal):
         """Connects one of this gate's input terminals to another gate's output.
@@ -130,7 +197,24 @@ class Gate:
         if self.in_gates[terminal] is not None:
             raise RuntimeError('Input terminal already connected')
         self.in_gates[terminal] = gate
+        bit = 1 << (len(self.in_gates) - 1 - terminal)
         gate.out_gates.append(self)
+        gate.out_bits.append(bit)
+        if gate.output:
+            self.input_mask |= bit
+    
+    def set_output(self, value):
+        """Changes the gate's output, updating the input masks it drives.
+        
+        The output should only be changed through this method once the gate is
+        connected, so the input masks stay in sync with the outputs.
+        """
+        if value != self.output:
+            self.output = value
+            out_gates = self.out_gates
+            out_bits = self.out_bits
+            for i in xrange(len(out_gates)):
+                out_gates[i].input_mask ^= out_bits[i]
       
     def probe(self):
         """Marks this gate as probed.
@@ -167,7 +251,7 @@ class Gate:
         a delay from its inputs' transitions to the output's transition. The 
         circuit simulator is responsible for setting the appropriate time. 
         """
-        return self.gate_type.output([gate.output for gate in self.in_gates])
+        return self.gate_type.truth_table.output_from_mask(self.input_mask)
   
     def transition_time(self, input_time):
         """The time that the gate's output will reflect a change in its inputs.
@@ -194,6 +278,9 @@ class Circuit:
     def __init__(self):
         """Creates an empty circuit."""
         self.truth_tables = {}
+        # Maps (input count, mask) to the evaluation table shared by all the
+        # truth tables with those entries.
+        self.table_pool = {}
         self.gate_types = {}
         self.gates = {}
 
@@ -209,7 +296,12 @@ class Circuit:
         """
         if name in self.truth_tables:
             raise ValueError('Truth table name already used')
-        self.truth_tables[name] = TruthTable(name, output_list)
+        self.truth_tables[name] = truth_table = TruthTable(name, output_list)
+        # Identical tables declared under different names share their
+        # evaluation table, so only one copy is kept.
+        key = (truth_table.input_count, truth_table.mask)
+        truth_table.table = self.table_pool.setdefault(key, truth_table.table)
+        return truth_table
     
     def add_gate_type(self, name, truth_table_name, delay):
         """Adds a gate type that can be later attached to gates.
@@ -251,6 +343,41 @@ class Circuit:
             new_gate.connect_input(gate, i)
         return new_gate
     
+    def max_delay(self):
+        """The longest delay among the circuit's gate types."""
+        return max([gate_type.delay for gate_type in self.gate_types.values()]
+                   or [0])
+    
+    def find_cycle(self):
+        """Looks for a feedback loop, e.g. in a latch or a ring oscillator.
+        
+        Returns:
+            A list of gates that form a cycle, each gate driving the next one
+            and the last gate driving the first, or None if the circuit is
+            combinational.
+        """
+        # Iterative depth-first search over the out_gates edges. A gate is on
+        # the path while it is in state 1, and done when it is in state 2.
+        state = {}
+        for root in self.gates.values():
+            if root in state:
+                continue
+            state[root] = 1
+            path = [root]
+            edges = [iter(root.out_gates)]
+            while edges:
+                gate = next(edges[-1], None)
+                if gate is None:
+                    state[path.pop()] = 2
+                    edges.pop()
+                elif gate not in state:
+                    state[gate] = 1
+                    path.append(gate)
+                    edges.append(iter(gate.out_gates))
+                elif state[gate] == 1:
+                    return path[path.index(gate):]
+        return None
+    
     def add_probe(self, gate_name):
         """Adds a gate to the list of outputs."""
         gate = self.gates[gate_name]
@@ -259,11 +386,158 @@ class Circuit:
     def as_json(self):
         """A hash that obeys the JSON format, representing the circuit."""
         json = {}
-        json['gates'] = [gate.as_json() for gate in self.gates.itervalues()]
+        json['gates'] = [gate.as_json() for gate in self.gates.values()]
         return json
 
-class Transition:
+class TimingAnalysis(object):
+    """Static timing analysis: when can each gate's output change?
+    
+    Instead of simulating transitions, the analysis walks the gates in
+    topological order and propagates arrival times through the gate delays, so
+    it takes time linear in the circuit's size. A gate's latest arrival time is
+    the latest time when a change launched at the circuit's inputs can reach
+    its output, and the earliest arrival time is the earliest such time. Since
+    every output transition in a Simulation is caused by a chain of input
+    transitions, no gate changes after its latest arrival time.
+    
+    Gates without connected inputs are sources. A gate that no source change
+    can reach never changes, so it has no arrival times.
+    """
+    
+    def __init__(self, circuit, input_times=None, first_input_times=None):
+        """Analyzes a circuit's timing.
+        
+        Args:
+            circuit: The Circuit to analyze.
+            input_times: Maps source gate names to the time when the sources
+                last change. Sources missing from the dict never change. By
+                default, all the sources change at time 0.
+            first_input_times: Maps source gate names to the time when the
+                sources first change, for sources that change more than once.
+                Defaults to input_times.
+        
+        Raises:
+            ValueError: An exception if the circuit has a cycle.
+        """
+        self.circuit = circuit
+        self.order = self.topological_order(circuit)
+        # Map gates to their arrival times, and to the input gate on their
+        # longest path.
+        self.latest = {}
+        self.earliest = {}
+        self.critical_input = {}
+        latest = self.latest
+        earliest = self.earliest
+        critical_input = self.critical_input
+        for gate in self.order:
+            worst = None
+            best = None
+            for in_gate in gate.in_gates:
+                if in_gate is None or in_gate not in latest:
+                    continue
+                if worst is None or latest[in_gate] > worst:
+                    worst = latest[in_gate]
+                    critical_input[gate] = in_gate
+                if best is None or earliest[in_gate] < best:
+                    best = earliest[in_gate]
+            if worst is not None:
+                delay = gate.gate_type.delay
+                latest[gate] = worst + delay
+                earliest[gate] = best + delay
+            elif all([in_gate is None for in_gate in gate.in_gates]):
+                if input_times is None:
+                    latest[gate] = earliest[gate] = 0
+                elif gate.name in input_times:
+                    latest[gate] = input_times[gate.name]
+                    earliest[gate] = input_times[gate.name]
+                    if first_input_times is not None and \
+                            gate.name in first_input_times:
+                        earliest[gate] = first_input_times[gate.name]
+    
+    @staticmethod
+    def topological_order(circuit):
+        """The circuit's gates, ordered so each gate follows its inputs.
+        
+        Raises:
+            ValueError: An exception if the circuit has a cycle.
+        """
+        # Kahn's algorithm. Gates are added in the circuit's order when there
+        # is a choice, so the result is deterministic.
+        pending = {}
+        order = []
+        for gate in circuit.gates.values():
+            count = len([g for g in gate.in_gates if g is not None])
+            if count == 0:
+                order.append(gate)
+            else:
+                pending[gate] = count
+        i = 0
+        while i < len(order):
+            for out_gate in order[i].out_gates:
+                pending[out_gate] -= 1
+                if pending[out_gate] == 0:
+                    del pending[out_gate]
+                    order.append(out_gate)
+            i += 1
+        if pending:
+            raise ValueError('Circuit has a cycle')
+        return order
+    
+    def critical_path(self, gate_name):
+        """The longest path of gates that ends at a gate.
+        
+        Returns:
+            A list of gates, starting at a source and ending at the given gate,
+            or an empty list if the gate never changes.
+        """
+        gate = self.circuit.gates[gate_name]
+        if gate not in self.latest:
+            return []
+        path = [gate]
+        while gate in self.critical_input:
+            gate = self.critical_input[gate]
+            path.append(gate)
+        path.reverse()
+        return path
+    
+    def critical_delay(self):
+        """The latest arrival time among the probed gates, or None."""
+        times = [self.latest[gate] for gate in self.order
+                 if gate.probed and gate in self.latest]
+        return max(times) if times else None
+    
+    def as_json(self):
+        """A hash that obeys the JSON format, with the probed gates' timing."""
+        probes = []
+        for gate in sorted([gate for gate in self.order if gate.probed],
+                           key=lambda gate: gate.name):
+            probes.append({'gate': gate.name,
+                           'latest': self.latest.get(gate),
+                           'earliest': self.earliest.get(gate),
+                           'path': [g.name for g in
+                                    self.critical_path(gate.name)]})
+        return {'critical_delay': self.critical_delay(), 'probes': probes}
+    
+    def to_file(self, file):
+        """Writes a textual report of the probed gates' timing to a file.
+        
+        Each line has a probed gate's name, its earliest and latest arrival
+        times, and its critical path.
+        """
+        for probe in self.as_json()['probes']:
+            if probe['latest'] is None:
+                file.write(probe['gate'] + ' never changes\n')
+                continue
+            file.write(' '.join([probe['gate'], str(probe['earliest']),
+                                 str(probe['latest'])] + probe['path']))
+            file.write('\n')
+
+class Transition(object):
     """A transition in a gate's output."""
+    
+    # Simulations can queue millions of transitions, so they don't get a
+    # __dict__.
+    __slots__ = ('gate', 'new_output', 'time', 'object_id')
   
     def __init__(self, gate, new_output, time):
         """Creates a potential transition of a gate's output to a new value.
@@ -322,7 +596,7 @@ class Transition:
         if self.gate.output == self.new_output:
             raise ValueError('Gate output should not transition to the same '
                              'value')
-        self.gate.output = self.new_output
+        self.gate.set_output(self.new_output)
     
     def __repr__(self):
         # :nodoc: debug output
@@ -406,14 +680,17 @@ class PriorityQueue:
         if i < len(self.queue):
             left = 2 * i + 1
             right = 2 * i + 2
+            smallest = i
             if left < len(self.queue) \
-                and self.queue[left] < self.queue[i]:
-                self.queue[left], self.queue[i] = self.queue[i], self.queue[left]
-                self._siftdown(left)
-            elif right < len(self.queue) \
-                and self.queue[right] < self.queue[i]:
-                self.queue[right], self.queue[i] = self.queue[i], self.queue[right]
-                self._siftdown(right)
+                and self.queue[left] < self.queue[smallest]:
+                smallest = left
+            if right < len(self.queue) \
+                and self.queue[right] < self.queue[smallest]:
+                smallest = right
+            if smallest != i:
+                self.queue[smallest], self.queue[i] = \
+                    self.queue[i], self.queue[smallest]
+                self._siftdown(smallest)
         
 
             
@@ -436,10 +713,277 @@ class PriorityQueue:
 ## END ##
 #########
 
+class HeapQueue:
+    """Priority queue of Transitions built on the heapq module.
+    
+    The heap holds (time, object_id, transition) tuples, which order like the
+    Transitions themselves, but are compared by C code instead of by calls to
+    Transition.__lt__.
+    """
+    
+    def __init__(self):
+        """Initially empty priority queue."""
+        self.queue = []
+    
+    def __len__(self):
+        # Number of elements in the queue.
+        return len(self.queue)
+    
+    def append(self, transition):
+        """Inserts a transition in the priority queue."""
+        if transition is None:
+            raise ValueError('Cannot insert None in the queue')
+        heapq.heappush(self.queue, (transition.time, transition.object_id,
+                                    transition))
+    
+    def min(self):
+        """The smallest transition in the queue."""
+        if len(self.queue) == 0:
+            return None
+        return self.queue[0][2]
+    
+    def pop(self):
+        """Removes the smallest transition in the queue.
+        
+        Returns:
+            The removed transition.
+        """
+        if len(self.queue) == 0:
+            return None
+        return heapq.heappop(self.queue)[2]
+
+class BucketQueue:
+    """Calendar queue for items that have non-negative integer times.
+    
+    Items live in a ring of buckets, one bucket per unit of time, covering the
+    window [now, now + window), where now is the time of the last popped item
+    (or the smallest inserted time, before the first pop).
+    Items further in the future wait in an overflow heap until the window
+    reaches them. When the window is larger than the longest gate delay,
+    inserting and popping take O(1) amortized time.
+    
+    Items with the same time are popped in insertion order. For Transitions,
+    this is the order that PriorityQueue uses, because object IDs are handed
+    out in increasing order.
+    """
+    
+    def __init__(self, window=1):
+        """Initially empty queue.
+        
+        Args:
+            window: The number of buckets in the ring.
+        """
+        if window < 1:
+            raise ValueError('Invalid window size')
+        self.window = window
+        self.buckets = [collections.deque() for i in xrange(window)]
+        self.now = 0
+        self.popped_time = None
+        self.min_time = None
+        self.ring_size = 0
+        self.size = 0
+        self.overflow = []
+        self.overflow_seq = 0
+    
+    def __len__(self):
+        # Number of elements in the queue.
+        return self.size
+    
+    def append(self, item):
+        """Inserts an item in the queue.
+        
+        Raises:
+            ValueError: An exception if the item's time is smaller than the
+                time of the last popped item.
+        """
+        if item is None:
+            raise ValueError('Cannot insert None in the queue')
+        time = item.time
+        if self.size == 0:
+            self.now = time
+            self.popped_time = None
+        elif time < self.now:
+            if self.popped_time is not None and time < self.popped_time:
+                raise ValueError('Cannot insert an item before the last '
+                                 'popped one')
+            self._rebase(time)
+        if time < self.now + self.window:
+            self.buckets[time % self.window].append(item)
+            self.ring_size += 1
+        else:
+            heapq.heappush(self.overflow, (time, self.overflow_seq, item))
+            self.overflow_seq += 1
+        self.size += 1
+        if self.min_time is not None and time < self.min_time:
+            self.min_time = time
+    
+    def min(self):
+        """The item with the smallest time in the queue."""
+        if self.size == 0:
+            return None
+        self._find_min()
+        if self.ring_size == 0:
+            return self.overflow[0][2]
+        return self.buckets[self.min_time % self.window][0]
+    
+    def pop(self):
+        """Removes the item with the smallest time in the queue.
+        
+        Returns:
+            The removed item.
+        """
+        if self.size == 0:
+            return None
+        self._find_min()
+        if self.now != self.min_time:
+            self.now = self.min_time
+            # Items must move into the ring as soon as the window covers them,
+            # so they are ahead of items inserted later with the same time.
+            end = self.now + self.window
+            while self.overflow and self.overflow[0][0] < end:
+                item = heapq.heappop(self.overflow)[2]
+                self.buckets[item.time % self.window].append(item)
+                self.ring_size += 1
+        bucket = self.buckets[self.now % self.window]
+        self.ring_size -= 1
+        self.size -= 1
+        self.popped_time = self.now
+        if len(bucket) == 1:
+            self.min_time = None
+        return bucket.popleft()
+    
+    def resize(self, window):
+        """Changes the number of buckets in the ring, keeping the items."""
+        items = [self.pop() for i in xrange(self.size)]
+        self.__init__(window)
+        for item in items:
+            self.append(item)
+    
+    def _rebase(self, time):
+        # Moves the window's start back to an earlier time.
+        #
+        # This only happens before the first pop, e.g. when the stimulus isn't
+        # inserted in time order. Items that fall out of the window move to the
+        # overflow heap in bucket order, which keeps their insertion order.
+        self.now = time
+        end = time + self.window
+        for bucket in self.buckets:
+            if bucket and bucket[0].time >= end:
+                for item in bucket:
+                    heapq.heappush(self.overflow,
+                                   (item.time, self.overflow_seq, item))
+                    self.overflow_seq += 1
+                self.ring_size -= len(bucket)
+                bucket.clear()
+    
+    def _find_min(self):
+        # Computes the time of the queue's minimum item.
+        #
+        # This method may loop forever if called when the queue is empty.
+        if self.min_time is not None:
+            return
+        if self.ring_size == 0:
+            self.min_time = self.overflow[0][0]
+            return
+        time = self.now
+        while not self.buckets[time % self.window]:
+            time += 1
+        self.min_time = time
+
+# The line that ends a circuit description in Simulation.from_file.
+_DONE_COMMAND = re.compile('^[ \\t]*done(?:[ \\t\\r].*)?(?:\\n|$)', re.M)
+
+# Snapshot header: magic, format version, little-endian flag, SHA-1 digest of
+# the textual circuit description. Each array in the snapshot is preceded by a
+# section header: array typecode and item count.
+_SNAPSHOT_MAGIC = b'CIRCSNAP'
+_SNAPSHOT_VERSION = 1
+_SNAPSHOT_HEADER = struct.Struct('<8sIB20s')
+_SNAPSHOT_SECTION = struct.Struct('<cQ')
+
+class SimulationProfile(object):
+    """Statistics about the steps of a simulation, for finding hot spots.
+    
+    A Simulation reports each step to its profile (if it has one) by calling
+    record_step once per step, so the statistics cost nothing when profiling
+    is off.
+    """
+    
+    def __init__(self, queue_sample_interval=1):
+        """Creates a profile with no steps.
+        
+        Args:
+            queue_sample_interval: The queue depth is sampled once every this
+                many steps.
+        """
+        self.queue_sample_interval = queue_sample_interval
+        self.steps = 0
+        self.popped = 0
+        self.applied = 0
+        # Maps a number of applied transitions to the number of steps that
+        # applied that many transitions.
+        self.step_sizes = {}
+        # [time, depth] samples of the queue depth after a step.
+        self.queue_depths = []
+        self.max_queue_depth = 0
+        # Maps gate names to the number of transitions applied to the gates.
+        self.gate_activity = {}
+    
+    def record_step(self, time, popped, gate_names, queue_depth):
+        """Records the statistics of one simulation step.
+        
+        Args:
+            time: The simulation time of the step.
+            popped: The number of transitions taken out of the queue.
+            gate_names: The names of the gates whose outputs changed, once per
+                applied transition.
+            queue_depth: The number of queued transitions after the step.
+        """
+        if self.steps % self.queue_sample_interval == 0:
+            self.queue_depths.append([time, queue_depth])
+        self.steps += 1
+        self.popped += popped
+        self.applied += len(gate_names)
+        self.step_sizes[len(gate_names)] = \
+            self.step_sizes.get(len(gate_names), 0) + 1
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+        activity = self.gate_activity
+        for name in gate_names:
+            activity[name] = activity.get(name, 0) + 1
+    
+    def hot_gates(self, count=10):
+        """The count gates with the most applied transitions.
+        
+        Returns:
+            A list of [gate name, transition count] pairs, busiest first.
+        """
+        ranking = sorted(self.gate_activity.items(),
+                         key=lambda item: (-item[1], item[0]))
+        return [[name, transitions] for name, transitions in ranking[:count]]
+    
+    def as_json(self, hot_gate_count=20):
+        """A hash that obeys the JSON format, containing the statistics."""
+        return {'steps': self.steps,
+                'popped': self.popped,
+                'applied': self.applied,
+                'discarded': self.popped - self.applied,
+                'step_sizes': sorted([[size, steps] for size, steps in
+                                      self.step_sizes.items()]),
+                'max_queue_depth': self.max_queue_depth,
+                'queue_depths': self.queue_depths,
+                'hot_gates': self.hot_gates(hot_gate_count)}
+    
+    def to_file(self, file):
+        """Writes the statistics to a file, in JSON format."""
+        json.dump(self.as_json(), file)
+        file.write('\n')
+
 class Simulation:
     """State needed to compute a circuit's state as it evolves over time."""
     
-    def __init__(self, circuit):
+    def __init__(self, circuit, queue_class=PriorityQueue, coalesce=True,
+                 record_history=False, profile=None):
         """Creates a simulation that will run on a pre-built circuit.
         
         The Circuit instance does not need to be completely built before it is 
@@ -448,13 +992,48 @@ class Simulation:
         
         Args:
             circuit: The circuit whose state transitions will be simulated.
+            queue_class: The class of the transition queue: PriorityQueue,
+                HeapQueue or BucketQueue.
+            coalesce: If True, transitions that would not change their gate's
+                output are dropped when they are scheduled, instead of being
+                discarded when they come out of the queue.
+            record_history: If True, every gate's output transitions are
+                recorded, so resimulate can be used after run.
+            profile: Optional SimulationProfile that receives statistics about
+                every step.
         """
         self.circuit = circuit
         self.in_transitions = []
         
-        self.queue = PriorityQueue()
+        self.queue = queue_class()
         self.probes = []
         self.probe_all_undo_log = []
+        # Input that from_file read past the end of the circuit description.
+        self.unread_input = ''
+        
+        self.coalesce = coalesce
+        # Maps each gate with queued transitions to [time, value, count]: the
+        # time and value of the gate's last queued transition, and the number
+        # of the gate's queued transitions.
+        self.pending = {}
+        self.events_scheduled = 0
+        self.events_coalesced = 0
+        self.events_applied = 0
+        self.events_discarded = 0
+        self.peak_queue_size = 0
+        
+        # Maps each gate to the list of its output transitions, as (time,
+        # substep, value) tuples. Substep k of a time is the k-th step that
+        # happens at that time; there are several when gates have zero delays.
+        self.history = {} if record_history else None
+        self.initial_outputs = {}
+        self.step_time = None
+        self.substep = 0
+        # True if the last run stopped at its end_time or max_events with
+        # transitions left to simulate.
+        self.stopped_early = False
+        
+        self.profile = profile
 
     def add_transition(self, gate_name, output_value, output_time):
         """Adds a transition to the simulation's initial conditions.
@@ -475,14 +1054,32 @@ class Simulation:
             The simulation time after the step occurred.
         """ 
         step_time = self.queue.min().time
+        if self.profile is not None:
+            done_before = self.events_applied + self.events_discarded
+        history = self.history
+        if history is not None:
+            if step_time == self.step_time:
+                self.substep += 1
+            else:
+                self.step_time, self.substep = step_time, 1
         
         # Need to apply all the transitions at the same time before propagating.
         transitions = []
         while len(self.queue) > 0 and self.queue.min().time == step_time:
           transition = self.queue.pop()
+          if self.coalesce:
+            slot = self.pending[transition.gate]
+            slot[2] -= 1
+            if slot[2] == 0:
+              del self.pending[transition.gate]
           if not transition.is_valid():
+            self.events_discarded += 1
             continue
           transition.apply()
+          self.events_applied += 1
+          if history is not None:
+            history.setdefault(transition.gate, []).append(
+                (step_time, self.substep, transition.new_output))
           if transition.gate.probed:
             self.probes.append([transition.time, transition.gate.name,
                                 transition.new_output])
@@ -493,22 +1090,525 @@ class Simulation:
           for gate in transition.gate.out_gates:
             output = gate.transition_output()
             time = gate.transition_time(step_time)
-            self.queue.append(Transition(gate, output, time))
+            self.schedule(gate, output, time)
         
+        if len(self.queue) > self.peak_queue_size:
+            self.peak_queue_size = len(self.queue)
+        if self.profile is not None:
+            self.profile.record_step(
+                step_time,
+                self.events_applied + self.events_discarded - done_before,
+                [transition.gate.name for transition in transitions],
+                len(self.queue))
         return step_time
     
-    def run(self):
-        """Runs the simulation to completion."""
-        for in_transition in sorted(self.in_transitions):
-            self.queue.append(Transition(in_transition[3], in_transition[2],
-                                         in_transition[0]))
-        while len(self.queue) > 0:
+    def schedule(self, gate, output, time):
+        """Queues a transition of a gate's output.
+        
+        When coalescing is on, the transition is dropped if it would not change
+        the gate's output, which is the case when the gate's last queued
+        transition (or its current output, if nothing is queued) has the same
+        value, and the new transition doesn't come before that one.
+        
+        Returns:
+            The queued Transition, or None if the transition was dropped.
+        """
+        if self.coalesce:
+            slot = self.pending.get(gate)
+            if slot is None:
+                if output == gate.output:
+                    self.events_coalesced += 1
+                    return None
+                self.pending[gate] = [time, output, 1]
+            else:
+                if time >= slot[0]:
+                    if output == slot[1]:
+                        self.events_coalesced += 1
+                        return None
+                    slot[0], slot[1] = time, output
+                slot[2] += 1
+        transition = Transition(gate, output, time)
+        self.queue.append(transition)
+        self.events_scheduled += 1
+        return transition
+    
+    def event_counts(self):
+        """Counters describing the work done by the simulation so far.
+        
+        Returns:
+            A dict with the number of transitions that were scheduled
+            ('scheduled'), dropped by coalescing ('coalesced'), applied to
+            gates ('applied') and discarded when they came out of the queue
+            because they would not change their gate's output ('discarded'),
+            as well as the largest queue size seen ('peak_queue_size').
+        """
+        return {'scheduled': self.events_scheduled,
+                'coalesced': self.events_coalesced,
+                'applied': self.events_applied,
+                'discarded': self.events_discarded,
+                'peak_queue_size': self.peak_queue_size}
+    
+    def timing_analysis(self):
+        """A static TimingAnalysis of the simulation's circuit.
+        
+        Each input gate first changes at the time of its first queued
+        transition, and last changes at the time of its last one, so the
+        arrival times bound the times of the simulation's first and last
+        transitions.
+        """
+        input_times = {}
+        first_input_times = {}
+        for time, name, value, gate in self.in_transitions:
+            input_times[name] = max(input_times.get(name, time), time)
+            first_input_times[name] = min(first_input_times.get(name, time),
+                                          time)
+        return TimingAnalysis(self.circuit, input_times, first_input_times)
+    
+    def run(self, end_time=None, max_events=None):
+        """Runs the simulation to completion, or until a limit is reached.
+        
+        Circuits with feedback loops can have transitions forever, so they
+        need a limit. The transitions that are left over when the simulation
+        stops remain in the queue.
+        
+        Args:
+            end_time: If given, no transitions after this time are applied.
+            max_events: If given, the simulation stops after the step in which
+                the number of applied transitions reaches this limit.
+        
+        Raises:
+            RuntimeError: An exception if no limit is given and the circuit has
+                a feedback loop.
+        """
+        self._check_limits(end_time, max_events)
+        self._schedule_in_transitions()
+        limit = None if max_events is None else \
+            self.events_applied + max_events
+        while not self._limit_reached(end_time, limit):
             self.step()
         self.probes.sort()
+    
+    def _check_limits(self, end_time, max_events):
+        # Makes sure that a run with the given limits will finish.
+        self.stopped_early = False
+        if end_time is None and max_events is None:
+            cycle = self.circuit.find_cycle()
+            if cycle is not None:
+                raise RuntimeError(
+                    'Circuit has a feedback loop through ' +
+                    ' '.join([gate.name for gate in cycle]) +
+                    '; run it with an end_time or max_events')
+    
+    def _limit_reached(self, end_time, limit):
+        # True if the simulation is done, because the queue is empty or the
+        # next step would exceed the end_time, or because the number of
+        # applied transitions reached limit.
+        if len(self.queue) == 0:
+            return True
+        if (end_time is not None and self.queue.min().time > end_time) or \
+                (limit is not None and self.events_applied >= limit):
+            self.stopped_early = True
+            return True
+        return False
+    
+    def iter_probes(self, end_time=None, max_events=None):
+        """Runs the simulation to completion, yielding the probe results.
+        
+        The limits work like those of run.
+        
+        This is a generator. The probe records have the same format and order
+        as self.probes after run, but they are yielded as soon as each time
+        slice is done, and are not kept in self.probes. Memory use is bounded
+        by the transition queue and the probe records of a single time slice.
+        """
+        for probes in self._probe_slices(end_time, max_events):
+            for probe in probes:
+                yield probe
+    
+    def _probe_slices(self, end_time=None, max_events=None):
+        # Generator that runs the simulation and yields the sorted probe
+        # records of each time slice. Several steps can happen at the same
+        # time when gates have zero delays, so a slice ends when the queue's
+        # minimum moves past it.
+        self._check_limits(end_time, max_events)
+        self._schedule_in_transitions()
+        limit = None if max_events is None else \
+            self.events_applied + max_events
+        probes = self.probes
+        self.probes = []
+        done = self._limit_reached(end_time, limit)
+        while not done:
+            step_time = self.step()
+            done = self._limit_reached(end_time, limit)
+            if self.probes and (done or self.queue.min().time != step_time):
+                self.probes.sort()
+                yield self.probes
+                self.probes = []
+        self.probes = probes
+    
+    def _schedule_in_transitions(self):
+        # Queues the simulation's initial conditions.
+        if self.history is not None:
+            self.initial_outputs = dict([
+                (gate, gate.output) for gate in self.circuit.gates.values()
+                if gate.output != 0])
+        if isinstance(self.queue, BucketQueue):
+            # The circuit is complete now, so all the gate delays are known.
+            self.queue.resize(self.circuit.max_delay() + 1)
+        for in_transition in sorted(self.in_transitions,
+                                    key=lambda t: t[0:3]):
+            self.schedule(in_transition[3], in_transition[2], in_transition[0])
+        if len(self.queue) > self.peak_queue_size:
+            self.peak_queue_size = len(self.queue)
+    
+    def resimulate(self, added=(), removed=()):
+        """Updates the results of run after changes to the initial conditions.
+        
+        Only the gates whose outputs can depend on the changed transitions
+        (the changed gates' cone of influence) are simulated again, starting at
+        the earliest changed transition. The other gates' outputs are replayed
+        from the recorded history, and the probe results before that time are
+        reused.
+        
+        Args:
+            added: Transitions to add to the initial conditions, as
+                (gate_name, output_value, output_time) tuples with the same
+                meaning as the arguments of add_transition.
+            removed: Transitions to remove from the initial conditions, in the
+                same format as added.
+        
+        Returns:
+            self.probes, updated to match what run would produce with the new
+            initial conditions.
+        
+        Raises:
+            RuntimeError: An exception if the simulation was not created with
+                record_history=True, or has not been run.
+            ValueError: An exception if a removed transition isn't part of the
+                initial conditions.
+        """
+        if self.history is None or len(self.queue) > 0 or \
+                self.stopped_early:
+            raise RuntimeError('resimulate needs a completed run with '
+                               'record_history=True')
+        for gate_name, output_value, output_time in removed:
+            for i in xrange(len(self.in_transitions)):
+                if self.in_transitions[i][0:3] == [output_time, gate_name,
+                                                   output_value]:
+                    del self.in_transitions[i]
+                    break
+            else:
+                raise ValueError('Transition not in the initial conditions')
+        for gate_name, output_value, output_time in added:
+            self.add_transition(gate_name, output_value, output_time)
+        changes = list(added) + list(removed)
+        if not changes:
+            return self.probes
+        start_time = min([change[2] for change in changes])
+        
+        # The cone of influence, and the gates outside it that feed it.
+        cone = set()
+        pending = [self.circuit.gates[change[0]] for change in changes]
+        while pending:
+            gate = pending.pop()
+            if gate not in cone:
+                cone.add(gate)
+                pending.extend(gate.out_gates)
+        boundary = set()
+        for gate in cone:
+            for in_gate in gate.in_gates:
+                if in_gate is not None and in_gate not in cone:
+                    boundary.add(in_gate)
+        
+        # Rewind the cone and its boundary to just before start_time.
+        history = self.history
+        limit = (start_time, 0, 0)
+        for gate in cone.union(boundary):
+            transitions = history.get(gate, [])
+            index = bisect.bisect_left(transitions, limit)
+            if index > 0:
+                gate.set_output(transitions[index - 1][2])
+            else:
+                gate.set_output(self.initial_outputs.get(gate, 0))
+            if gate in cone:
+                del transitions[index:]
+        
+        # Events are grouped by (time, substep). Within a group, the initial
+        # conditions come first, like in the queue used by run.
+        events = {}
+        for in_transition in sorted(self.in_transitions,
+                                    key=lambda t: t[0:3]):
+            if in_transition[0] >= start_time and in_transition[3] in cone:
+                events.setdefault((in_transition[0], 1), []).append(
+                    (in_transition[3], in_transition[2]))
+        
+        # Transitions that run queued for the cone before start_time. They were
+        # caused by input changes in [start_time - delay, start_time).
+        for gate in cone:
+            delay = gate.gate_type.delay
+            if delay == 0:
+                continue
+            causes = set()
+            for in_gate in gate.in_gates:
+                if in_gate is None:
+                    continue
+                transitions = history.get(in_gate, [])
+                index = bisect.bisect_left(transitions,
+                                           (start_time - delay, 0, 0))
+                while index < len(transitions) and \
+                        transitions[index][0] < start_time:
+                    causes.add(transitions[index][0:2])
+                    index += 1
+            for cause in sorted(causes):
+                inputs = []
+                for in_gate in gate.in_gates:
+                    transitions = history.get(in_gate, [])
+                    index = bisect.bisect_right(transitions, cause + (2,))
+                    if index > 0:
+                        inputs.append(transitions[index - 1][2])
+                    else:
+                        inputs.append(self.initial_outputs.get(in_gate, 0))
+                events.setdefault((cause[0] + delay, 1), []).append(
+                    (gate, gate.gate_type.output(inputs)))
+        
+        # The boundary gates' transitions are replayed from their history.
+        replayed = {}
+        for gate in boundary:
+            transitions = history.get(gate, [])
+            for index in xrange(bisect.bisect_left(transitions, limit),
+                                len(transitions)):
+                time, substep, value = transitions[index]
+                replayed.setdefault((time, substep), []).append((gate, value))
+        
+        probes = [probe for probe in self.probes if probe[0] < start_time or
+                  self.circuit.gates[probe[1]] not in cone]
+        keys = list(set(events).union(replayed))
+        heapq.heapify(keys)
+        while keys:
+            key = heapq.heappop(keys)
+            time, substep = key
+            changed = []
+            for gate, value in replayed.pop(key, ()):
+                gate.set_output(value)
+                changed.append(gate)
+            for gate, value in events.pop(key, ()):
+                if gate.output == value:
+                    continue
+                gate.set_output(value)
+                history.setdefault(gate, []).append((time, substep, value))
+                if gate.probed:
+                    probes.append([time, gate.name, value])
+                changed.append(gate)
+            for gate in changed:
+                for out_gate in gate.out_gates:
+                    if out_gate not in cone:
+                        continue
+                    delay = out_gate.gate_type.delay
+                    if delay == 0:
+                        out_key = (time, substep + 1)
+                    else:
+                        out_key = (time + delay, 1)
+                    if out_key not in events and out_key not in replayed:
+                        heapq.heappush(keys, out_key)
+                    events.setdefault(out_key, []).append(
+                        (out_gate, out_gate.transition_output()))
+        probes.sort()
+        self.probes = probes
+        return probes
+    
+    def run_parallel(self, processes=None):
+        """Runs the simulation to completion using a pool of processes.
+        
+        The circuit is split into its connected components, which cannot
+        affect each other. The components that have probes are grouped into
+        partitions of similar sizes, and each partition is simulated by a
+        CompiledSimulation in a worker process. The probe results are merged
+        into self.probes, which ends up the same as after run. The gates'
+        outputs and the profile in this process are not updated.
+        
+        Args:
+            processes: The number of worker processes. Defaults to the number
+                of CPUs.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        partitions = self._partitions(processes * 4)
+        if processes <= 1 or len(partitions) <= 1:
+            results = [_simulate_partition(p) for p in partitions]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_simulate_partition, partitions, 1)
+            finally:
+                pool.close()
+                pool.join()
+        # Each partition's probes are sorted, so merging them keeps the order.
+        self.probes.extend(heapq.merge(*results))
+    
+    def _partitions(self, count):
+        # Splits the circuit into at most count self-contained descriptions
+        # that _simulate_partition can run.
+        gates = list(self.circuit.gates.values())
+        gate_ids = dict([(gates[i].name, i) for i in xrange(len(gates))])
+        
+        # Union-find over the connections between gates.
+        parent = list(xrange(len(gates)))
+        def find(i):
+            root = i
+            while parent[root] != root:
+                root = parent[root]
+            while parent[i] != root:
+                parent[i], i = root, parent[i]
+            return root
+        for i in xrange(len(gates)):
+            for in_gate in gates[i].in_gates:
+                if in_gate is not None:
+                    a, b = find(i), find(gate_ids[in_gate.name])
+                    if a != b:
+                        parent[a] = b
+        
+        components = {}
+        for i in xrange(len(gates)):
+            components.setdefault(find(i), []).append(i)
+        flips = {}
+        for in_transition in self.in_transitions:
+            root = find(gate_ids[in_transition[1]])
+            flips.setdefault(root, []).append(in_transition[0:3])
+        
+        # Components without probes produce no output. The others are assigned,
+        # largest first, to the partition with the least work so far.
+        work = [(len(members) + len(flips.get(root, [])), root)
+                for root, members in components.items()
+                if any([gates[i].probed for i in members])]
+        work.sort(reverse=True)
+        bins = [[0, []] for i in xrange(min(count, len(work)))]
+        for size, root in work:
+            smallest = min(bins)
+            smallest[0] += size
+            smallest[1].append(root)
+        
+        partitions = []
+        for size, roots in bins:
+            members = sorted([i for root in roots for i in components[root]])
+            partition_gates = [gates[i] for i in members]
+            types = dict([(g.gate_type.name, g.gate_type)
+                          for g in partition_gates])
+            partitions.append({
+                'tables': dict([(t.truth_table.name, t.truth_table.output_list())
+                                for t in types.values()]),
+                'types': [(t.name, t.truth_table.name, t.delay)
+                          for t in types.values()],
+                'gates': [(g.name, g.gate_type.name,
+                           [i and i.name for i in g.in_gates], g.output)
+                          for g in partition_gates],
+                'probes': [g.name for g in partition_gates if g.probed],
+                'flips': [flip for root in roots
+                          for flip in flips.get(root, [])]})
+        return partitions
+    
+    def run_batch(self, stimuli, width=64):
+        """Simulates the circuit against many independent sets of stimuli.
+        
+        The stimulus sets are packed into words of up to width bits, one bit
+        per set, and the gates are evaluated with bitwise operations, so each
+        pass over the circuit simulates a whole word of stimulus sets. This
+        method does not use or change the simulation's own state.
+        
+        Args:
+            stimuli: A list of stimulus sets. Each set is a list of
+                (gate_name, output_value, output_time) transitions, with the
+                same meaning as the arguments of add_transition.
+            width: The number of stimulus sets simulated in each pass, or None
+                to simulate them all in a single pass.
+        
+        Returns:
+            A list with one probe list per stimulus set. Each probe list has
+            the format of self.probes after run.
+        
+        Raises:
+            RuntimeError: An exception if the circuit has a feedback loop.
+        """
+        self._check_limits(None, None)
+        compiled = CompiledCircuit(self.circuit)
+        functions = [table.word_function() for table in
+                     [t.truth_table for t in self.circuit.gate_types.values()]]
+        if width is None:
+            width = max(len(stimuli), 1)
+        traces = []
+        for start in xrange(0, len(stimuli), width):
+            traces.extend(self._run_words(compiled, functions,
+                                          stimuli[start:start + width]))
+        return traces
+    
+    def _run_words(self, compiled, type_functions, stimuli):
+        # Simulates one word's worth of stimulus sets for run_batch.
+        full = (1 << len(stimuli)) - 1
+        names = compiled.gate_names
+        probed = compiled.probed
+        fanouts = compiled.fanouts()
+        delay = [compiled.type_delay[t] for t in compiled.gate_type]
+        function = [type_functions[t] for t in compiled.gate_type]
+        fanins = [compiled.input_gate[compiled.input_start[g]:
+                                      compiled.input_start[g + 1]]
+                  for g in xrange(len(compiled))]
+        words = [full if gate.output else 0
+                 for gate in self.circuit.gates.values()]
+        # Unconnected terminals (-1) read the constant 0 at the end of words.
+        words.append(0)
+        traces = [[] for stimulus in stimuli]
+        
+        # Each event is a (gate, lanes, values) triple. Only the bits in lanes
+        # are meaningful in values.
+        flips = []
+        for lane in xrange(len(stimuli)):
+            for gate_name, value, time in stimuli[lane]:
+                flips.append((time, gate_name, value, lane))
+        flips.sort()
+        buckets = {}
+        times = []
+        for time, gate_name, value, lane in flips:
+            bucket = buckets.get(time)
+            if bucket is None:
+                buckets[time] = bucket = []
+                heapq.heappush(times, time)
+            bucket.append((compiled.gate_ids[gate_name], 1 << lane,
+                           value << lane))
+        
+        while times:
+            step_time = heapq.heappop(times)
+            changed = {}
+            for gate, lanes, values in buckets.pop(step_time):
+                applied = lanes & (values ^ words[gate])
+                if not applied:
+                    continue
+                words[gate] ^= applied
+                if probed[gate]:
+                    output = words[gate]
+                    remaining = applied
+                    while remaining:
+                        lane = (remaining & -remaining).bit_length() - 1
+                        traces[lane].append([step_time, names[gate],
+                                             (output >> lane) & 1])
+                        remaining &= remaining - 1
+                for dest, bit in fanouts[gate]:
+                    changed[dest] = changed.get(dest, 0) | applied
+            
+            for dest, lanes in changed.items():
+                time = step_time + delay[dest]
+                bucket = buckets.get(time)
+                if bucket is None:
+                    buckets[time] = bucket = []
+                    heapq.heappush(times, time)
+                values = function[dest](full, *[words[i] for i in fanins[dest]])
+                bucket.append((dest, lanes, values))
+        
+        for trace in traces:
+            trace.sort()
+        return traces
             
     def probe_all_gates(self):
         """Turns on probing for all gates in the simulation."""
-        for gate in self.circuit.gates.itervalues():
+        for gate in self.circuit.gates.values():
             if not gate.probed:
                 self.probe_all_undo_log.append(gate)
                 gate.probe()
@@ -519,45 +1619,256 @@ class Simulation:
             gate.probed = False
         self.probe_all_undo_log = []
     
-    @staticmethod
-    def from_file(file):
+    @classmethod
+    def from_file(cls, file, cache_path=None, **options):
         """Builds a simulation by reading a textual description from a file.
         
+        The whole description is read at once. Everything after the 'done'
+        command is kept for layout_from_file.
+        
         Args:
             file: A File object supplying the input.
+            cache_path: Optional path of a binary snapshot of the parsed
+                circuit. If the snapshot was made from the same description, it
+                is loaded instead of parsing the text. Otherwise, the text is
+                parsed and the snapshot is (re)written.
+            options: Keyword arguments passed to the class constructor.
         
-        Returns: A new Simulation instance.
+        Returns: A new instance of the class that from_file is called on.
         """
-        circuit = Circuit()
-        simulation = Simulation(circuit)
+        text = file.read()
+        match = _DONE_COMMAND.search(text)
+        if match is None:
+            body, rest = text, ''
+        else:
+            body, rest = text[:match.start()], text[match.end():]
         
-        while True:
-            command = file.readline().split()
+        # Building a large circuit allocates many objects that all stay alive,
+        # so the garbage collector's passes would only waste time.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            simulation = None
+            if cache_path is not None:
+                digest = hashlib.sha1(body.encode('utf-8')).digest()
+                simulation = cls.from_snapshot(cache_path, digest, **options)
+            if simulation is None:
+                simulation = cls(Circuit(), **options)
+                simulation._parse_commands(body)
+                if cache_path is not None:
+                    simulation.snapshot_to_path(cache_path, digest)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        simulation.unread_input = rest
+        return simulation
+    
+    def _parse_commands(self, text):
+        # Builds the circuit and the initial conditions from the commands in
+        # the textual description (without the 'done' command).
+        circuit = self.circuit
+        gates = circuit.gates
+        # Inputs that name gates defined further down, which happens when the
+        # circuit has feedback loops, as (gate, terminal, input name) tuples.
+        forward_inputs = []
+        for line in text.split('\n'):
+            command = line.split()
             if len(command) < 1:
                 continue
-            if command[0] == 'table':
-                outputs = [int(token) for token in command[2:]]
-                circuit.add_truth_table(command[1], outputs)
-            elif command[0] == 'type':
+            if command[0] == 'gate':
+                input_names = command[3:]
+                for name in input_names:
+                    if name not in gates:
+                        break
+                else:
+                    circuit.add_gate(command[1], command[2], input_names)
+                    continue
+                gate = circuit.add_gate(command[1], command[2], [])
+                for terminal in xrange(len(input_names)):
+                    if input_names[terminal] in gates:
+                        gate.connect_input(gates[input_names[terminal]],
+                                           terminal)
+                    else:
+                        forward_inputs.append((gate, terminal,
+                                               input_names[terminal]))
+            elif command[0] == 'flip':
                 if len(command) != 4:
-                    raise ValueError('Invalid number of arguments for gate type'
-                                     ' command')
-                circuit.add_gate_type(command[1], command[2], int(command[3]))
-            elif command[0] == 'gate':
-                circuit.add_gate(command[1], command[2], command[3:])
+                    raise ValueError('Invalid number of arguments for flip '
+                                     'command')
+                self.add_transition(command[1], int(command[2]),
+                                    int(command[3]))
             elif command[0] == 'probe':
                 if len(command) != 2:
                     raise ValueError('Invalid number of arguments for gate '
                                       'probe command')
                 circuit.add_probe(command[1])
-            elif command[0] == 'flip':
+            elif command[0] == 'table':
+                outputs = [int(token) for token in command[2:]]
+                circuit.add_truth_table(command[1], outputs)
+            elif command[0] == 'type':
                 if len(command) != 4:
-                    raise ValueError('Invalid number of arguments for flip '
-                                     'command')
-                simulation.add_transition(command[1], int(command[2]), 
-                                          int(command[3]))
-            elif command[0] == 'done':
-                break
+                    raise ValueError('Invalid number of arguments for gate type'
+                                     ' command')
+                circuit.add_gate_type(command[1], command[2], int(command[3]))
+        for gate, terminal, name in forward_inputs:
+            gate.connect_input(gates[name], terminal)
+    
+    def snapshot_to_path(self, path, digest):
+        """Writes a binary snapshot of the circuit and initial conditions.
+        
+        The snapshot is a header followed by arrays of numbers. The header
+        holds a format version, the byte order of the arrays, and a digest of
+        the textual description that the snapshot was made from.
+        
+        Args:
+            path: The path of the snapshot file.
+            digest: The SHA-1 digest (as bytes) of the textual description.
+        """
+        circuit = self.circuit
+        tables = list(circuit.truth_tables.values())
+        types = list(circuit.gate_types.values())
+        gates = list(circuit.gates.values())
+        table_ids = dict([(tables[i].name, i) for i in xrange(len(tables))])
+        type_ids = dict([(types[i].name, i) for i in xrange(len(types))])
+        gate_ids = dict([(gates[i].name, i) for i in xrange(len(gates))])
+        
+        names = [t.name for t in tables] + [t.name for t in types] + \
+                [g.name for g in gates]
+        table_outputs = array.array('b')
+        for table in tables:
+            table_outputs.extend(table.output_list())
+        input_start = array.array('q', [0])
+        input_gate = array.array('i')
+        for gate in gates:
+            for in_gate in gate.in_gates:
+                input_gate.append(-1 if in_gate is None
+                                  else gate_ids[in_gate.name])
+            input_start.append(len(input_gate))
+        
+        sections = [
+            array.array('B', '\n'.join(names).encode('utf-8')),
+            array.array('q', [len(tables), len(types), len(gates)]),
+            array.array('q', [t.input_count for t in tables]),
+            table_outputs,
+            array.array('i', [table_ids[t.truth_table.name] for t in types]),
+            array.array('q', [t.delay for t in types]),
+            array.array('i', [type_ids[g.gate_type.name] for g in gates]),
+            input_start,
+            input_gate,
+            array.array('i', [gate_ids[g.name] for g in gates if g.probed]),
+            array.array('i', [gate_ids[t[1]] for t in self.in_transitions]),
+            array.array('q', [t[2] for t in self.in_transitions]),
+            array.array('q', [t[0] for t in self.in_transitions])]
+        
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC,
+                                             _SNAPSHOT_VERSION,
+                                             sys.byteorder == 'little',
+                                             digest))
+            for section in sections:
+                file.write(_SNAPSHOT_SECTION.pack(section.typecode.encode(),
+                                                  len(section)))
+                section.tofile(file)
+        os.replace(temp_path, path)
+    
+    @classmethod
+    def from_snapshot(cls, path, digest=None, **options):
+        """Builds a simulation from a snapshot written by snapshot_to_path.
+        
+        Args:
+            path: The path of the snapshot file.
+            digest: If given, the snapshot is only used if it was made from a
+                textual description with this SHA-1 digest.
+            options: Keyword arguments passed to the class constructor.
+        
+        Returns:
+            A new instance of the class that from_snapshot is called on, or
+            None if the snapshot is missing, stale, or has a different format
+            version or byte order.
+        """
+        try:
+            with open(path, 'rb') as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            if len(data) < _SNAPSHOT_HEADER.size:
+                return None
+            magic, version, little_endian, snapshot_digest = \
+                _SNAPSHOT_HEADER.unpack_from(data, 0)
+            if (magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION or
+                bool(little_endian) != (sys.byteorder == 'little') or
+                (digest is not None and snapshot_digest != digest)):
+                return None
+            sections = []
+            offset = _SNAPSHOT_HEADER.size
+            view = memoryview(data)
+            try:
+                while offset < len(data):
+                    typecode, count = _SNAPSHOT_SECTION.unpack_from(data,
+                                                                    offset)
+                    offset += _SNAPSHOT_SECTION.size
+                    section = array.array(typecode.decode())
+                    end = offset + count * section.itemsize
+                    if end > len(data):
+                        # A damaged file is treated like a stale one.
+                        return None
+                    section.frombytes(view[offset:end])
+                    sections.append(section)
+                    offset = end
+            except (struct.error, ValueError):
+                return None
+            finally:
+                view.release()
+        finally:
+            data.close()
+        if len(sections) != 13:
+            return None
+        
+        (names, counts, table_sizes, table_outputs, type_table, type_delay,
+         gate_type, input_start, input_gate, probes, flip_gate, flip_value,
+         flip_time) = sections
+        names = names.tobytes().decode('utf-8').split('\n')
+        table_count, type_count, gate_count = counts
+        table_names = names[0:table_count]
+        type_names = names[table_count:table_count + type_count]
+        gate_names = names[table_count + type_count:]
+        
+        circuit = Circuit()
+        simulation = cls(circuit, **options)
+        offset = 0
+        for i in xrange(table_count):
+            size = 1 << table_sizes[i]
+            circuit.add_truth_table(table_names[i],
+                                    table_outputs[offset:offset + size].tolist())
+            offset += size
+        for i in xrange(type_count):
+            circuit.add_gate_type(type_names[i], table_names[type_table[i]],
+                                  type_delay[i])
+        # The snapshot was made from a valid circuit, so the gates are built
+        # directly instead of going through add_gate.
+        gate_types = [circuit.gate_types[name] for name in type_names]
+        gates = [Gate(gate_names[i], gate_types[gate_type[i]])
+                 for i in xrange(gate_count)]
+        circuit.gates = dict(zip(gate_names, gates))
+        for i in xrange(gate_count):
+            gate = gates[i]
+            in_gates = gate.in_gates
+            start = input_start[i]
+            for terminal in xrange(input_start[i + 1] - start):
+                in_gate = input_gate[start + terminal]
+                if in_gate >= 0:
+                    # All outputs are 0, so the input masks stay 0.
+                    in_gates[terminal] = gates[in_gate]
+                    gates[in_gate].out_gates.append(gate)
+                    gates[in_gate].out_bits.append(
+                        1 << (len(in_gates) - 1 - terminal))
+        for i in probes:
+            circuit.add_probe(gate_names[i])
+        for i in xrange(len(flip_gate)):
+            simulation.add_transition(gate_names[flip_gate[i]], flip_value[i],
+                                      flip_time[i])
         return simulation
     
     def layout_from_file(self, file):
@@ -569,6 +1880,10 @@ class Simulation:
         Returns:
              self.
         """
+        if self.unread_input:
+            # from_file already read this part of the input.
+            file = io.StringIO(self.unread_input + file.read())
+            self.unread_input = ''
         while True:
           line = file.readline()
           if len(line) == 0:
@@ -580,12 +1895,15 @@ class Simulation:
               svg = re.sub('\\<\\!DOCTYPE[^>]*\\>', '', svg)
               self.layout_svg = svg.strip()
               break
-        self
+        return self
     
     def trace_as_json(self):
         """A hash that obeys the JSON format, containing simulation data."""
-        return {'circuit': self.circuit.as_json(), 'trace': self.probes,
+        json = {'circuit': self.circuit.as_json(), 'trace': self.probes,
                 'layout': self.layout_svg}
+        if self.profile is not None:
+            json['profile'] = self.profile.as_json()
+        return json
     
     def outputs_to_line_list(self):
         return [' '.join([str(probe[0]), probe[1], str(probe[2])]) for probe in self.probes]
@@ -600,6 +1918,22 @@ class Simulation:
         for line in self.outputs_to_line_list():
             file.write(line)
             file.write("\n")
+    
+    def stream_outputs_to_file(self, file, end_time=None, max_events=None):
+        """Runs the simulation and writes its probe results to a file as they
+        are produced.
+        
+        The output matches calling run and then outputs_to_file, but the probe
+        results are not accumulated in memory.
+        
+        Args:
+            file: A File object that receives the probe results.
+            end_time: Optional limit on the simulation time, as in run.
+            max_events: Optional limit on the applied transitions, as in run.
+        """
+        for probe in self.iter_probes(end_time, max_events):
+            file.write(' '.join([str(probe[0]), probe[1], str(probe[2])]))
+            file.write("\n")
             
     def jsonp_to_file(self, file):
         """Writes a JSONP description of the simulation's probe results to a 
@@ -611,20 +1945,426 @@ class Simulation:
         file.write('onJsonp(')
         json.dump(self.trace_as_json(), file)
         file.write(');\n')
+    
+    def stream_jsonp_to_file(self, file, all_gates=True, end_time=None,
+                             max_events=None):
+        """Runs the simulation and writes a JSONP description of its probe
+        results to a file as they are produced.
+        
+        The output matches probing all gates, calling run, undoing the probes
+        and calling jsonp_to_file, but the trace is not accumulated in memory.
+        The layout must be read before calling this.
+        
+        Args:
+            file: A File object that receives the probe results.
+            all_gates: if False, only the probed gates are traced.
+            end_time: Optional limit on the simulation time, as in run.
+            max_events: Optional limit on the applied transitions, as in run.
+        """
+        file.write('onJsonp({"circuit": {"gates": [')
+        separator = ''
+        for gate in self.circuit.gates.values():
+            file.write(separator)
+            json.dump(gate.as_json(), file)
+            separator = ', '
+        file.write(']}, "trace": [')
+        if all_gates:
+            self.probe_all_gates()
+        separator = ''
+        for probe in self.iter_probes(end_time, max_events):
+            file.write(separator)
+            file.write(json.dumps(probe))
+            separator = ', '
+        if all_gates:
+            self.undo_probe_all_gates()
+        file.write('], "layout": ')
+        json.dump(self.layout_svg, file)
+        if self.profile is not None:
+            file.write(', "profile": ')
+            json.dump(self.profile.as_json(), file)
+        file.write('});\n')
+
+class CompiledCircuit:
+    """A circuit flattened into integer arrays for fast simulation.
+    
+    Gates are numbered in the order they were added to the circuit. Each gate's
+    logic is packed into an integer (see TruthTable.mask) that is indexed by a
+    bitmask of the gate's inputs, and the fan-out lists are stored in
+    compressed sparse row (CSR) form: the connections leaving gate g are
+    fanout_gate[fanout_start[g]:fanout_start[g + 1]].
+    """
+    
+    def __init__(self, circuit):
+        """Compiles a completely built circuit.
+        
+        Args:
+            circuit: The Circuit instance to be compiled. Later changes to the
+                circuit are not reflected in the compiled form.
+        """
+        gates = list(circuit.gates.values())
+        self.gate_names = [gate.name for gate in gates]
+        self.gate_ids = {}
+        for i in xrange(len(gates)):
+            self.gate_ids[gates[i].name] = i
+        
+        types = list(circuit.gate_types.values())
+        type_ids = {}
+        for i in xrange(len(types)):
+            type_ids[types[i].name] = i
+        self.type_delay = array.array('q', [t.delay for t in types])
+        self.type_table = [t.truth_table.mask for t in types]
+        
+        self.gate_type = array.array('i',
+                                     [type_ids[g.gate_type.name] for g in gates])
+        self.probed = bytearray([1 if g.probed else 0 for g in gates])
+        
+        # Fan-in CSR, in terminal order. Unconnected terminals (e.g., on the
+        # circuit's input gates) are -1.
+        self.input_start = array.array('i', [0])
+        self.input_gate = array.array('i')
+        for gate in gates:
+            for in_gate in gate.in_gates:
+                if in_gate is None:
+                    self.input_gate.append(-1)
+                else:
+                    self.input_gate.append(self.gate_ids[in_gate.name])
+            self.input_start.append(len(self.input_gate))
+        
+        # Fan-out CSR. fanout_bit is the bit that the source gate's output
+        # occupies in the destination gate's input mask.
+        fanout_lists = [[] for gate in gates]
+        for i in xrange(len(gates)):
+            in_gates = gates[i].in_gates
+            for terminal in xrange(len(in_gates)):
+                if in_gates[terminal] is None:
+                    continue
+                bit = 1 << (len(in_gates) - 1 - terminal)
+                fanout_lists[self.gate_ids[in_gates[terminal].name]].append(
+                    (i, bit))
+        self.fanout_start = array.array('i', [0])
+        self.fanout_gate = array.array('i')
+        self.fanout_bit = array.array('q')
+        for i in xrange(len(gates)):
+            for dest, bit in fanout_lists[i]:
+                self.fanout_gate.append(dest)
+                self.fanout_bit.append(bit)
+            self.fanout_start.append(len(self.fanout_gate))
+    
+    def __len__(self):
+        # Number of gates in the circuit.
+        return len(self.gate_names)
+    
+    def input_masks(self, outputs):
+        """The input bitmask of every gate, given the gates' output values."""
+        masks = [0] * len(self.gate_names)
+        for g in xrange(len(self.gate_names)):
+            start, end = self.input_start[g], self.input_start[g + 1]
+            mask = 0
+            for i in xrange(start, end):
+                in_gate = self.input_gate[i]
+                mask = (mask << 1) | (outputs[in_gate] if in_gate >= 0 else 0)
+            masks[g] = mask
+        return masks
+    
+    def fanouts(self):
+        """Per-gate lists of (destination gate, input bit) pairs.
+        
+        The inner simulation loops iterate over these lists, which is faster in
+        Python than indexing into the CSR arrays.
+        """
+        result = []
+        for g in xrange(len(self.gate_names)):
+            start, end = self.fanout_start[g], self.fanout_start[g + 1]
+            result.append(list(zip(self.fanout_gate[start:end],
+                                   self.fanout_bit[start:end])))
+        return result
+
+class CompiledSimulation(Simulation):
+    """Simulation that runs on a CompiledCircuit instead of Gate objects.
+    
+    The probe results and event counts are identical to the ones produced by
+    Simulation. The event queue holds one bucket of (gate id, value) pairs per
+    time, so the transitions at a given time are applied in the order they were
+    scheduled, just like the heap-based simulation does.
+    """
+    
+    def run(self, end_time=None, max_events=None):
+        """Runs the simulation to completion, or until a limit is reached.
+        
+        The limits work like those of Simulation.run, but the transitions that
+        are left over when the simulation stops are dropped.
+        """
+        for probes in self._probe_slices(end_time, max_events):
+            self.probes.extend(probes)
+        self.probes.sort()
+    
+    # The engine generator that step advances.
+    _stepper = None
+    
+    def step(self):
+        """Runs the simulation for one time slice.
+        
+        The first call compiles the circuit and queues the initial conditions.
+        Like Simulation.step, every call applies all the transitions queued for
+        the next time, appends their probe records to self.probes (unsorted),
+        and updates the gates' outputs and the event counters. A simulation
+        that was stepped should not also be run.
+        
+        Returns:
+            The simulation time after the step occurred, or None if no
+            transitions are left.
+        """
+        if self._stepper is None:
+            self._stepper = self._engine(None, None, True)
+        try:
+            return next(self._stepper)
+        except StopIteration:
+            return None
+    
+    def _probe_slices(self, end_time=None, max_events=None):
+        # Generator that runs the simulation and yields the sorted probe
+        # records of each time slice. Overrides Simulation._probe_slices.
+        self._check_limits(end_time, max_events)
+        return self._engine(end_time, max_events, False)
+    
+    def _engine(self, end_time, max_events, stepping):
+        # Generator that runs the compiled simulation. It yields the sorted
+        # probe records of each time slice, or, when stepping, the time of
+        # each step, after writing the step's results back to the gates.
+        compiled = CompiledCircuit(self.circuit)
+        gate_ids = compiled.gate_ids
+        names = compiled.gate_names
+        probed = compiled.probed
+        fanouts = compiled.fanouts()
+        delay = [compiled.type_delay[t] for t in compiled.gate_type]
+        table = [compiled.type_table[t] for t in compiled.gate_type]
+        gate_objects = list(self.circuit.gates.values())
+        outputs = [gate.output for gate in gate_objects]
+        masks = compiled.input_masks(outputs)
+        probes = []
+        coalesce = self.coalesce
+        # The same per-gate slots as Simulation.pending, as parallel lists.
+        pending_time = [0] * len(compiled)
+        pending_value = [0] * len(compiled)
+        pending_count = [0] * len(compiled)
+        scheduled = coalesced = applied = discarded = 0
+        queue_size = peak_queue_size = 0
+        history = {} if self.history is not None else None
+        substep = 0
+        profile = self.profile
+        popped = 0
+        changed = []
+        if history is not None:
+            self.initial_outputs = dict([
+                (gate, gate.output) for gate in self.circuit.gates.values()
+                if gate.output != 0])
+        
+        buckets = {}
+        times = []
+        events = [(in_transition[0], gate_ids[in_transition[1]],
+                   in_transition[2]) for in_transition in
+                  sorted(self.in_transitions, key=lambda t: t[0:3])]
+        # The initial conditions are queued with the same code that the
+        # propagation loop below inlines for every fan-out edge.
+        heappush = heapq.heappush
+        for time, dest, value in events:
+            if coalesce:
+                count = pending_count[dest]
+                if count == 0:
+                    if value == outputs[dest]:
+                        coalesced += 1
+                        continue
+                    pending_time[dest] = time
+                    pending_value[dest] = value
+                elif time >= pending_time[dest]:
+                    if value == pending_value[dest]:
+                        coalesced += 1
+                        continue
+                    pending_time[dest] = time
+                    pending_value[dest] = value
+                pending_count[dest] = count + 1
+            bucket = buckets.get(time)
+            if bucket is None:
+                buckets[time] = bucket = []
+                heappush(times, time)
+            bucket.append((dest, value))
+            scheduled += 1
+            queue_size += 1
+        step_time = None
+        while True:
+            if queue_size > peak_queue_size:
+                peak_queue_size = queue_size
+            if profile is not None and step_time is not None:
+                profile.record_step(step_time, popped,
+                                    [names[gate] for gate in changed],
+                                    queue_size)
+            done = not times
+            if not done and ((end_time is not None and times[0] > end_time) or
+                             (max_events is not None and
+                              applied >= max_events)):
+                done = self.stopped_early = True
+            if stepping:
+                self.events_scheduled += scheduled
+                self.events_coalesced += coalesced
+                scheduled = coalesced = 0
+                self.peak_queue_size = max(self.peak_queue_size,
+                                           peak_queue_size)
+                if step_time is not None:
+                    yield step_time
+            elif probes and (done or times[0] != step_time):
+                probes.sort()
+                yield probes
+                probes = []
+            if done:
+                break
+            
+            if times[0] == step_time:
+                substep += 1
+            else:
+                substep = 1
+            step_time = heapq.heappop(times)
+            bucket = buckets.pop(step_time)
+            popped = len(bucket)
+            queue_size -= popped
+            changed = []
+            for gate, value in bucket:
+                if coalesce:
+                    pending_count[gate] -= 1
+                if outputs[gate] == value:
+                    discarded += 1
+                    continue
+                outputs[gate] = value
+                if history is not None:
+                    history.setdefault(gate, []).append(
+                        (step_time, substep, value))
+                if probed[gate]:
+                    probes.append([step_time, names[gate], value])
+                for dest, bit in fanouts[gate]:
+                    masks[dest] ^= bit
+                changed.append(gate)
+            applied += len(changed)
+            if stepping:
+                for gate in changed:
+                    gate_objects[gate].set_output(outputs[gate])
+                    if history is not None:
+                        self.history.setdefault(
+                            gate_objects[gate], []).extend(
+                                history.pop(gate, ()))
+                self.probes.extend(probes)
+                probes = []
+                self.events_applied += applied
+                self.events_discarded += discarded
+                applied = discarded = 0
+            
+            # Queue the transitions caused by the step's changes, now that
+            # they are all in the input masks.
+            for gate in changed:
+                for dest, bit in fanouts[gate]:
+                    time = step_time + delay[dest]
+                    value = (table[dest] >> masks[dest]) & 1
+                    if coalesce:
+                        count = pending_count[dest]
+                        if count == 0:
+                            if value == outputs[dest]:
+                                coalesced += 1
+                                continue
+                            pending_time[dest] = time
+                            pending_value[dest] = value
+                        elif time >= pending_time[dest]:
+                            if value == pending_value[dest]:
+                                coalesced += 1
+                                continue
+                            pending_time[dest] = time
+                            pending_value[dest] = value
+                        pending_count[dest] = count + 1
+                    bucket = buckets.get(time)
+                    if bucket is None:
+                        buckets[time] = bucket = []
+                        heappush(times, time)
+                    bucket.append((dest, value))
+                    scheduled += 1
+                    queue_size += 1
+        
+        self.events_scheduled += scheduled
+        self.events_coalesced += coalesced
+        self.events_applied += applied
+        self.events_discarded += discarded
+        self.peak_queue_size = max(self.peak_queue_size, peak_queue_size)
+        
+        for gate in self.circuit.gates.values():
+            gate.set_output(outputs[gate_ids[gate.name]])
+            if history is not None and gate_ids[gate.name] in history:
+                self.history.setdefault(gate, []).extend(
+                    history[gate_ids[gate.name]])
+
+def _simulate_partition(partition):
+    """Simulates a partition made by Simulation._partitions.
+    
+    This runs in the worker processes of Simulation.run_parallel.
+    
+    Returns:
+        The sorted probe results of the partition.
+    """
+    circuit = Circuit()
+    for name, outputs in partition['tables'].items():
+        circuit.add_truth_table(name, outputs)
+    for name, table_name, delay in partition['types']:
+        circuit.add_gate_type(name, table_name, delay)
+    for name, type_name, input_names, output in partition['gates']:
+        circuit.add_gate(name, type_name, []).set_output(output)
+    for name, type_name, input_names, output in partition['gates']:
+        gate = circuit.gates[name]
+        for terminal in xrange(len(input_names)):
+            if input_names[terminal] is not None:
+                gate.connect_input(circuit.gates[input_names[terminal]],
+                                   terminal)
+    for name in partition['probes']:
+        circuit.add_probe(name)
+    simulation = CompiledSimulation(circuit)
+    for time, name, value in partition['flips']:
+        simulation.add_transition(name, value, time)
+    simulation.run()
+    return simulation.probes
 
 # Command-line controller.
 if __name__ == '__main__':
     import sys
-    sim = Simulation.from_file(sys.stdin)
-    if os.environ.get('TRACE') == 'jsonp':
-        sim.layout_from_file(sys.stdin)
-        sim.probe_all_gates()
-    sim.run()
-    if os.environ.get('TRACE') == 'jsonp':
-        sim.undo_probe_all_gates()
-        sim.jsonp_to_file(sys.stdout)
+    if os.environ.get('QUEUE') == 'bucket':
+        queue_class = BucketQueue
+    elif os.environ.get('QUEUE') == 'heapq':
+        queue_class = HeapQueue
+    else:
+        queue_class = PriorityQueue
+    cache_path = os.environ.get('CIRCUIT_CACHE')
+    # Circuits with feedback loops need END_TIME or MAX_EVENTS.
+    end_time = max_events = None
+    if os.environ.get('END_TIME'):
+        end_time = int(os.environ['END_TIME'])
+    if os.environ.get('MAX_EVENTS'):
+        max_events = int(os.environ['MAX_EVENTS'])
+    profile = None
+    if os.environ.get('PROFILE'):
+        profile = SimulationProfile()
+    if os.environ.get('ENGINE') in ('compiled', 'parallel'):
+        sim = CompiledSimulation.from_file(sys.stdin, cache_path=cache_path,
+                                           profile=profile)
     else:
+        sim = Simulation.from_file(sys.stdin, cache_path=cache_path,
+                                   queue_class=queue_class, profile=profile)
+    if os.environ.get('TRACE') == 'timing':
+        sim.timing_analysis().to_file(sys.stdout)
+    elif os.environ.get('TRACE') == 'jsonp':
+        sim.layout_from_file(sys.stdin)
+        sim.stream_jsonp_to_file(sys.stdout, end_time=end_time,
+                                 max_events=max_events)
+    elif os.environ.get('ENGINE') == 'parallel':
+        sim.run_parallel()
         sim.outputs_to_file(sys.stdout)
+    else:
+        sim.stream_outputs_to_file(sys.stdout, end_time, max_events)
+    if profile is not None:
+        with open(os.environ['PROFILE'], 'w') as profile_file:
+            profile.to_file(profile_file)
   
     ##########
     ## TEST ##
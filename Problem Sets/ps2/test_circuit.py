@@ -0,0 +1,550 @@
+import hashlib
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import circuit
+from circuit import *
+
+# A 1-bit full adder, with inputs flipping at a few different times.
+FULL_ADDER = """
+table buf 0 1
+table xor2 0 1 1 0
+table and2 0 0 0 1
+table or2 0 1 1 1
+type in buf 0
+type xor xor2 3
+type and and2 2
+type or or2 2
+gate a in
+gate b in
+gate c in
+gate ab xor a b
+gate sum xor ab c
+gate ab_and and a b
+gate abc_and and ab c
+gate carry or ab_and abc_and
+probe sum
+probe carry
+flip a 1 0
+flip b 1 5
+flip c 1 10
+flip a 0 10
+flip b 0 20
+done
+"""
+
+def random_netlist(seed, input_count=6, gate_count=60, flip_count=40):
+    """A random combinational netlist, in the format read by from_file."""
+    rng = random.Random(seed)
+    lines = ['table buf 0 1', 'table not1 1 0', 'table and2 0 0 0 1',
+             'table or2 0 1 1 1', 'table xor2 0 1 1 0',
+             'table nand3 1 1 1 1 1 1 1 0', 'table mux3 0 0 1 1 0 1 0 1']
+    tables = [('not1', 1), ('and2', 2), ('or2', 2), ('xor2', 2), ('nand3', 3),
+              ('mux3', 3)]
+    lines.append('type in buf 0')
+    types = []
+    for name, inputs in tables:
+        for delay in (0, 1, 3):
+            types.append((name + '_' + str(delay), inputs))
+            lines.append(' '.join(['type', types[-1][0], name, str(delay)]))
+    gates = []
+    for i in xrange(input_count):
+        gates.append('i' + str(i))
+        lines.append('gate ' + gates[-1] + ' in')
+    for i in xrange(gate_count):
+        type_name, inputs = rng.choice(types)
+        sources = [rng.choice(gates) for j in xrange(inputs)]
+        gates.append('g' + str(i))
+        lines.append(' '.join(['gate', gates[-1], type_name] + sources))
+    for gate in rng.sample(gates, len(gates) // 3):
+        lines.append('probe ' + gate)
+    for i in xrange(flip_count):
+        lines.append(' '.join(['flip', 'i' + str(rng.randrange(input_count)),
+                               str(rng.randrange(2)), str(rng.randrange(30))]))
+    lines.append('done')
+    return '\n'.join(lines) + '\n'
+
+def simulation_output(simulation_class, netlist, **options):
+    """The text written by outputs_to_file after simulating a netlist."""
+    simulation = simulation_class.from_file(io.StringIO(netlist), **options)
+    simulation.run()
+    output = io.StringIO()
+    simulation.outputs_to_file(output)
+    return output.getvalue()
+
+class TestPriorityQueue(unittest.TestCase):
+    def test_pops_in_order(self):
+        rng = random.Random(1)
+        keys = [rng.randrange(50) for i in xrange(200)]
+        queue = PriorityQueue()
+        for key in keys:
+            queue.append(key)
+        self.assertEqual(sorted(keys), [queue.pop() for key in keys])
+        self.assertEqual(0, len(queue))
+
+class TestTruthTable(unittest.TestCase):
+    def test_output_from_mask(self):
+        table = TruthTable('mux', [0, 0, 1, 1, 0, 1, 0, 1])
+        for mask in xrange(8):
+            inputs = [(mask >> 2) & 1, (mask >> 1) & 1, mask & 1]
+            self.assertEqual(table.output(inputs),
+                             table.output_from_mask(mask))
+    
+    def test_shared_tables(self):
+        circuit = Circuit()
+        circuit.add_truth_table('and2', [0, 0, 0, 1])
+        circuit.add_truth_table('also_and2', [0, 0, 0, 1])
+        circuit.add_truth_table('or2', [0, 1, 1, 1])
+        tables = circuit.truth_tables
+        self.assertTrue(tables['and2'].table is tables['also_and2'].table)
+        self.assertFalse(tables['and2'].table is tables['or2'].table)
+        self.assertEqual('also_and2', tables['also_and2'].name)
+        self.assertEqual(2, len(circuit.table_pool))
+    
+    def test_input_masks_follow_outputs(self):
+        for simulation_class in (Simulation, CompiledSimulation):
+            simulation = simulation_class.from_file(
+                io.StringIO(random_netlist(4)))
+            simulation.run()
+            for gate in simulation.circuit.gates.values():
+                mask = 0
+                for in_gate in gate.in_gates:
+                    mask = (mask << 1) | (in_gate.output if in_gate else 0)
+                self.assertEqual(mask, gate.input_mask)
+
+class TestBucketQueue(unittest.TestCase):
+    def test_matches_priority_queue(self):
+        rng = random.Random(3)
+        gate = Gate('g', GateType('t', TruthTable('buf', [0, 1]), 1))
+        expected, actual = PriorityQueue(), BucketQueue(4)
+        for i in xrange(20):
+            transition = Transition(gate, 0, rng.randrange(100))
+            expected.append(transition)
+            actual.append(transition)
+        while len(expected) > 0:
+            self.assertEqual(len(expected), len(actual))
+            self.assertIs(expected.min(), actual.min())
+            transition = expected.pop()
+            self.assertIs(transition, actual.pop())
+            # Keep inserting at or after the popped time, like Simulation.
+            if rng.random() < 0.7:
+                new_transition = Transition(gate, 0,
+                                            transition.time + rng.randrange(9))
+                expected.append(new_transition)
+                actual.append(new_transition)
+        self.assertEqual(0, len(actual))
+        self.assertIsNone(actual.pop())
+
+    def test_rejects_past_items(self):
+        gate = Gate('g', GateType('t', TruthTable('buf', [0, 1]), 1))
+        queue = BucketQueue(4)
+        queue.append(Transition(gate, 0, 5))
+        queue.append(Transition(gate, 0, 9))
+        queue.pop()
+        self.assertRaises(ValueError, queue.append, Transition(gate, 0, 4))
+
+class TestSimulation(unittest.TestCase):
+    def test_full_adder(self):
+        self.assertEqual('6 sum 1\n9 carry 1\n11 sum 0\n13 sum 1\n14 carry 0\n'
+                         '16 sum 0\n17 carry 1\n26 sum 1\n27 carry 0\n',
+                         simulation_output(Simulation, FULL_ADDER))
+
+    def test_other_queues(self):
+        for seed in xrange(10):
+            netlist = random_netlist(seed)
+            for queue_class in (HeapQueue, BucketQueue):
+                self.assertEqual(simulation_output(Simulation, netlist),
+                                 simulation_output(Simulation, netlist,
+                                                   queue_class=queue_class))
+
+    def test_slots(self):
+        gate = Gate('g', GateType('t', TruthTable('buf', [0, 1]), 1))
+        self.assertFalse(hasattr(gate, '__dict__'))
+        self.assertFalse(hasattr(Transition(gate, 1, 0), '__dict__'))
+
+    def test_coalescing(self):
+        for seed in xrange(10):
+            netlist = random_netlist(seed)
+            plain = Simulation.from_file(io.StringIO(netlist), coalesce=False)
+            plain.run()
+            coalesced = Simulation.from_file(io.StringIO(netlist))
+            coalesced.run()
+            self.assertEqual(plain.probes, coalesced.probes)
+            counts = coalesced.event_counts()
+            self.assertEqual(plain.event_counts()['applied'], counts['applied'])
+            self.assertEqual(counts['scheduled'],
+                             counts['applied'] + counts['discarded'])
+            self.assertLessEqual(counts['peak_queue_size'],
+                                 plain.event_counts()['peak_queue_size'])
+            self.assertEqual({}, coalesced.pending)
+
+    def test_stream_outputs(self):
+        for simulation_class in (Simulation, CompiledSimulation):
+            for seed in xrange(10):
+                netlist = random_netlist(seed)
+                simulation = simulation_class.from_file(io.StringIO(netlist))
+                output = io.StringIO()
+                simulation.stream_outputs_to_file(output)
+                self.assertEqual(simulation_output(simulation_class, netlist),
+                                 output.getvalue())
+                self.assertEqual([], simulation.probes)
+
+    def test_stream_jsonp(self):
+        netlist = random_netlist(3) + 'layout\n<svg></svg>\n'
+        for simulation_class in (Simulation, CompiledSimulation):
+            simulation = simulation_class.from_file(io.StringIO(netlist))
+            simulation.layout_from_file(io.StringIO(''))
+            simulation.probe_all_gates()
+            simulation.run()
+            simulation.undo_probe_all_gates()
+            expected = io.StringIO()
+            simulation.jsonp_to_file(expected)
+            simulation = simulation_class.from_file(io.StringIO(netlist))
+            simulation.layout_from_file(io.StringIO(''))
+            output = io.StringIO()
+            simulation.stream_jsonp_to_file(output)
+            self.assertEqual(expected.getvalue(), output.getvalue())
+            self.assertEqual([], simulation.probe_all_undo_log)
+
+# A ring oscillator: osc XORs the enable input with its own delayed output.
+OSCILLATOR = """
+table buf 0 1
+table xor2 0 1 1 0
+type in buf 0
+type buf buf 1
+type xor xor2 1
+gate en in
+gate osc xor en loop
+gate loop buf osc
+probe osc
+flip en 1 0
+done
+"""
+
+class TestSequentialCircuit(unittest.TestCase):
+    def test_find_cycle(self):
+        simulation = Simulation.from_file(io.StringIO(OSCILLATOR))
+        self.assertEqual(['loop', 'osc'], sorted(
+            [gate.name for gate in simulation.circuit.find_cycle()]))
+        simulation = Simulation.from_file(io.StringIO(FULL_ADDER))
+        self.assertEqual(None, simulation.circuit.find_cycle())
+    
+    def test_run_needs_limit(self):
+        for simulation_class in (Simulation, CompiledSimulation):
+            simulation = simulation_class.from_file(io.StringIO(OSCILLATOR))
+            self.assertRaises(RuntimeError, simulation.run)
+    
+    def test_end_time(self):
+        for simulation_class in (Simulation, CompiledSimulation):
+            simulation = simulation_class.from_file(io.StringIO(OSCILLATOR))
+            simulation.run(end_time=9)
+            self.assertEqual([[1, 'osc', 1], [3, 'osc', 0], [5, 'osc', 1],
+                              [7, 'osc', 0], [9, 'osc', 1]], simulation.probes)
+            self.assertTrue(simulation.stopped_early)
+    
+    def test_max_events(self):
+        for simulation_class in (Simulation, CompiledSimulation):
+            simulation = simulation_class.from_file(io.StringIO(OSCILLATOR))
+            output = io.StringIO()
+            simulation.stream_outputs_to_file(output, max_events=5)
+            self.assertEqual('1 osc 1\n3 osc 0\n', output.getvalue())
+    
+    def test_limits_on_combinational_circuit(self):
+        simulation = Simulation.from_file(io.StringIO(FULL_ADDER))
+        simulation.run(end_time=1000)
+        self.assertFalse(simulation.stopped_early)
+        self.assertEqual(simulation_output(Simulation, FULL_ADDER),
+                         ''.join(['%d %s %d\n' % tuple(probe)
+                                  for probe in simulation.probes]))
+
+class TestTimingAnalysis(unittest.TestCase):
+    def test_full_adder(self):
+        simulation = Simulation.from_file(io.StringIO(FULL_ADDER))
+        analysis = TimingAnalysis(simulation.circuit)
+        self.assertEqual(7, analysis.critical_delay())
+        self.assertEqual(['a', 'ab', 'sum'],
+                         [gate.name for gate in analysis.critical_path('sum')])
+        self.assertEqual(3, analysis.earliest[simulation.circuit.gates['sum']])
+        self.assertEqual(7, analysis.latest[simulation.circuit.gates['carry']])
+        output = io.StringIO()
+        analysis.to_file(output)
+        self.assertEqual('carry 4 7 a ab abc_and carry\nsum 3 6 a ab sum\n',
+                         output.getvalue())
+    
+    def test_bounds_simulation(self):
+        # The random netlists flip each input several times.
+        for seed in xrange(10):
+            netlist = random_netlist(seed)
+            simulation = Simulation.from_file(io.StringIO(netlist))
+            analysis = simulation.timing_analysis()
+            simulation.run()
+            for time, name, value in simulation.probes:
+                gate = simulation.circuit.gates[name]
+                self.assertLessEqual(analysis.earliest[gate], time)
+                self.assertLessEqual(time, analysis.latest[gate])
+    
+    def test_repeated_flips(self):
+        simulation = Simulation.from_file(io.StringIO(
+            'table buf 0 1\ntype in buf 0\ntype slow buf 5\ngate a in\n'
+            'gate o slow a\nprobe o\nflip a 1 0\nflip a 0 100\ndone\n'))
+        analysis = simulation.timing_analysis()
+        output = io.StringIO()
+        analysis.to_file(output)
+        self.assertEqual('o 5 105 a o\n', output.getvalue())
+        simulation.run()
+        self.assertEqual([[5, 'o', 1], [105, 'o', 0]], simulation.probes)
+    
+    def test_cycle(self):
+        simulation = Simulation.from_file(io.StringIO(FULL_ADDER))
+        circuit = simulation.circuit
+        circuit.gates['a'].in_gates[0] = None
+        circuit.gates['a'].connect_input(circuit.gates['sum'], 0)
+        self.assertRaises(ValueError, TimingAnalysis, circuit)
+
+class TestParallelSimulation(unittest.TestCase):
+    def netlist(self):
+        # Three copies of a random netlist make three independent components.
+        lines = []
+        for copy in xrange(3):
+            for line in random_netlist(copy).split('\n'):
+                command = line.split()
+                if not command or command[0] == 'done' or \
+                        (copy > 0 and command[0] in ('table', 'type')):
+                    continue
+                if command[0] == 'gate':
+                    command[3:] = [str(copy) + name for name in command[3:]]
+                if command[0] != 'table' and command[0] != 'type':
+                    command[1] = str(copy) + command[1]
+                lines.append(' '.join(command))
+        return '\n'.join(lines) + '\ndone\n'
+
+    def test_matches_run(self):
+        netlist = self.netlist()
+        expected = Simulation.from_file(io.StringIO(netlist))
+        expected.run()
+        for processes in (1, 2):
+            simulation = Simulation.from_file(io.StringIO(netlist))
+            self.assertEqual(3, len(simulation._partitions(4)))
+            simulation.run_parallel(processes)
+            self.assertEqual(expected.probes, simulation.probes)
+
+    def test_partition_results_sorted(self):
+        # run_parallel merges the partitions' probes without sorting them.
+        simulation = Simulation.from_file(io.StringIO(self.netlist()))
+        for partition in simulation._partitions(4):
+            probes = circuit._simulate_partition(partition)
+            self.assertTrue(probes)
+            self.assertEqual(sorted(probes), probes)
+
+class TestResimulate(unittest.TestCase):
+    def check_edits(self, simulation_class, seed):
+        rng = random.Random(seed)
+        netlist = random_netlist(seed)
+        simulation = simulation_class.from_file(io.StringIO(netlist),
+                                                record_history=True)
+        simulation.run()
+        flips = [(t[1], t[2], t[0]) for t in simulation.in_transitions]
+        for i in xrange(3):
+            removed = rng.sample(flips, 2)
+            added = [('i' + str(rng.randrange(6)), rng.randrange(2),
+                      rng.randrange(30))]
+            for flip in removed:
+                flips.remove(flip)
+            flips.extend(added)
+            
+            expected = Simulation.from_file(io.StringIO(netlist))
+            expected.in_transitions = []
+            for flip in flips:
+                expected.add_transition(*flip)
+            expected.run()
+            self.assertEqual(expected.probes,
+                             simulation.resimulate(added, removed))
+            for name, gate in expected.circuit.gates.items():
+                self.assertEqual(gate.output,
+                                 simulation.circuit.gates[name].output)
+
+    def test_simulation(self):
+        for seed in xrange(15):
+            self.check_edits(Simulation, seed)
+
+    def test_compiled_simulation(self):
+        for seed in xrange(15):
+            self.check_edits(CompiledSimulation, seed)
+
+    def test_needs_history(self):
+        simulation = Simulation.from_file(io.StringIO(FULL_ADDER))
+        simulation.run()
+        self.assertRaises(RuntimeError, simulation.resimulate, [('a', 1, 3)])
+
+class TestFromFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.directory, 'circuit.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_done(self):
+        netlist = FULL_ADDER.replace('done\n', '\n\n')
+        self.assertEqual(simulation_output(Simulation, FULL_ADDER),
+                         simulation_output(Simulation, netlist))
+
+    def test_layout_after_done(self):
+        simulation = Simulation.from_file(io.StringIO(
+            FULL_ADDER + 'layout\n<?xml version="1.0"?>\n<svg></svg>\n'))
+        simulation.layout_from_file(io.StringIO(''))
+        self.assertEqual('<svg></svg>', simulation.layout_svg)
+
+    def test_snapshot_cache(self):
+        netlist = random_netlist(9)
+        expected = simulation_output(Simulation, netlist)
+        self.assertEqual(expected, simulation_output(
+            Simulation, netlist, cache_path=self.cache_path))
+        self.assertTrue(os.path.exists(self.cache_path))
+        digest = hashlib.sha1(netlist[:netlist.index('done')]
+                              .encode('utf-8')).digest()
+        self.assertIsNotNone(Simulation.from_snapshot(self.cache_path, digest))
+        self.assertEqual(expected, simulation_output(
+            Simulation, netlist, cache_path=self.cache_path))
+        self.assertEqual(expected, simulation_output(
+            CompiledSimulation, netlist, cache_path=self.cache_path))
+
+    def test_stale_snapshot(self):
+        simulation_output(Simulation, random_netlist(9),
+                          cache_path=self.cache_path)
+        netlist = random_netlist(10)
+        self.assertEqual(simulation_output(Simulation, netlist),
+                         simulation_output(Simulation, netlist,
+                                           cache_path=self.cache_path))
+
+    def test_truncated_snapshot(self):
+        netlist = random_netlist(9)
+        expected = simulation_output(Simulation, netlist)
+        simulation_output(Simulation, netlist, cache_path=self.cache_path)
+        for size in (400, 60, 33):
+            with open(self.cache_path, 'r+b') as file:
+                file.truncate(size)
+            self.assertIsNone(Simulation.from_snapshot(self.cache_path))
+            self.assertEqual(expected, simulation_output(
+                Simulation, netlist, cache_path=self.cache_path))
+
+class TestCompiledSimulation(unittest.TestCase):
+    def test_full_adder(self):
+        self.assertEqual(simulation_output(Simulation, FULL_ADDER),
+                         simulation_output(CompiledSimulation, FULL_ADDER))
+
+    def test_step(self):
+        for seed in xrange(10):
+            netlist = random_netlist(seed)
+            expected = Simulation.from_file(io.StringIO(netlist))
+            expected._schedule_in_transitions()
+            expected_times = []
+            while len(expected.queue) > 0:
+                expected_times.append(expected.step())
+            simulation = CompiledSimulation.from_file(io.StringIO(netlist))
+            times = []
+            while True:
+                time = simulation.step()
+                if time is None:
+                    break
+                times.append(time)
+            self.assertEqual(expected_times, times)
+            self.assertEqual(sorted(expected.probes), sorted(simulation.probes))
+            self.assertEqual(expected.events_applied, simulation.events_applied)
+            self.assertEqual(expected.events_discarded,
+                             simulation.events_discarded)
+            for name, gate in expected.circuit.gates.items():
+                self.assertEqual(gate.output,
+                                 simulation.circuit.gates[name].output)
+
+    def test_step_history(self):
+        netlist = random_netlist(3)
+        expected = CompiledSimulation.from_file(io.StringIO(netlist),
+                                                record_history=True)
+        expected.run()
+        simulation = CompiledSimulation.from_file(io.StringIO(netlist),
+                                                  record_history=True)
+        while simulation.step() is not None:
+            pass
+        self.assertEqual(
+            dict([(gate.name, h) for gate, h in expected.history.items()]),
+            dict([(gate.name, h) for gate, h in simulation.history.items()]))
+
+    def test_random_netlists(self):
+        for seed in xrange(30):
+            netlist = random_netlist(seed)
+            self.assertEqual(simulation_output(Simulation, netlist),
+                             simulation_output(CompiledSimulation, netlist))
+
+    def test_event_counts(self):
+        for coalesce in (False, True):
+            netlist = random_netlist(5)
+            expected = Simulation.from_file(io.StringIO(netlist),
+                                            coalesce=coalesce)
+            expected.run()
+            actual = CompiledSimulation.from_file(io.StringIO(netlist),
+                                                  coalesce=coalesce)
+            actual.run()
+            self.assertEqual(expected.event_counts(), actual.event_counts())
+
+    def test_profile(self):
+        netlist = random_netlist(6)
+        profiles = []
+        for simulation_class in (Simulation, CompiledSimulation):
+            profile = SimulationProfile()
+            simulation = simulation_class.from_file(io.StringIO(netlist),
+                                                    profile=profile)
+            simulation.run()
+            profiles.append(profile.as_json())
+        self.assertEqual(profiles[0], profiles[1])
+        counts = simulation.event_counts()
+        self.assertEqual(counts['applied'], profiles[0]['applied'])
+        self.assertEqual(counts['discarded'], profiles[0]['discarded'])
+        self.assertLessEqual(profiles[0]['max_queue_depth'],
+                             counts['peak_queue_size'])
+        self.assertEqual(counts['applied'], sum([count for name, count in
+                                                 profile.hot_gates(1000)]))
+
+    def test_final_gate_outputs(self):
+        netlist = random_netlist(7)
+        expected = Simulation.from_file(io.StringIO(netlist))
+        expected.run()
+        actual = CompiledSimulation.from_file(io.StringIO(netlist))
+        actual.run()
+        for name, gate in expected.circuit.gates.items():
+            self.assertEqual(gate.output, actual.circuit.gates[name].output)
+
+class TestBatchSimulation(unittest.TestCase):
+    def test_matches_separate_runs(self):
+        rng = random.Random(2)
+        netlist = random_netlist(11)
+        stimuli = []
+        for i in xrange(20):
+            stimuli.append([('i' + str(rng.randrange(6)), rng.randrange(2),
+                             rng.randrange(30)) for j in xrange(15)])
+        expected = []
+        for stimulus in stimuli:
+            simulation = Simulation.from_file(io.StringIO(netlist))
+            simulation.in_transitions = []
+            for gate_name, value, time in stimulus:
+                simulation.add_transition(gate_name, value, time)
+            simulation.run()
+            expected.append(simulation.probes)
+        simulation = Simulation.from_file(io.StringIO(netlist))
+        self.assertEqual(expected, simulation.run_batch(stimuli, width=8))
+        self.assertEqual(expected, simulation.run_batch(stimuli, width=None))
+
+    def test_word_function(self):
+        table = TruthTable('mux3', [0, 0, 1, 1, 0, 1, 0, 1])
+        function = table.word_function()
+        for i in xrange(8):
+            inputs = [(i >> 2) & 1, (i >> 1) & 1, i & 1]
+            self.assertEqual(table.output(inputs), function(1, *inputs))
+
+if __name__ == '__main__':
+    unittest.main(argv = sys.argv + ['--verbose'])
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the range indexes in circuit2.py.
+
+Usage: python bench_circuit2.py [--wires N] [--size S] [--length L]
+
+The indexes replay the add / remove / count operations that CrossVerifier
+performs while sweeping a random wire layer. The randomized check that the
+indexes agree with each other is in test_circuit2.py.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from circuit2 import *
+
+def random_layer(wire_count, size, length, seed=0):
+  """A layer with wire_count random wires in a size x size square.
+
+  Half of the wires are horizontal and half are vertical, and no wire is
+  longer than length."""
+  rng = random.Random(seed)
+  layer = WireLayer()
+  for i in xrange(wire_count):
+    start = rng.randint(0, size)
+    end = min(size, start + rng.randint(1, length))
+    other = rng.randint(0, size)
+    if i % 2 == 0:
+      layer.add_wire('h' + str(i), start, other, end, other)
+    else:
+      layer.add_wire('v' + str(i), other, start, other, end)
+  return layer
+
+def sweep_operations(layer):
+  """The range index operations performed by CrossVerifier.count_crossings.
+
+  Returns:
+    A list of (operation, first key, last key) tuples, where operation is
+    'add', 'remove' or 'count'; add and remove only use the first key.
+  """
+  operations = []
+  for event in CrossVerifier(layer).events:
+    event_type, wire = event[3], event[4]
+    if event_type == 'add':
+      operations.append(('add', KeyWirePair(wire.y1, wire), None))
+    elif event_type == 'delete':
+      operations.append(('remove', KeyWirePair(wire.y1, wire), None))
+    else:
+      operations.append(('count', KeyWirePairL(wire.y1),
+                         KeyWirePairH(wire.y2)))
+  return operations
+
+def replay(index, operations):
+  """Performs a list of sweep_operations on a range index.
+
+  Returns:
+    The sum of the results of the count operations.
+  """
+  total = 0
+  for operation, first_key, last_key in operations:
+    if operation == 'add':
+      index.add(first_key)
+    elif operation == 'remove':
+      index.remove(first_key)
+    else:
+      total += index.count(first_key, last_key)
+  return total
+
+def bench_indexes(operations, index_classes, out=sys.stdout):
+  """Compares range index classes on the same operations."""
+  for index_class in index_classes:
+    index = index_class()
+    start = time.time()
+    total = replay(index, operations)
+    seconds = time.time() - start
+    out.write('%-20s %8.3fs %10.0f ops/s (%d crossings)\n' %
+              (index_class.__name__, seconds, len(operations) / seconds,
+               total))
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--wires', type=int, default=200000)
+  parser.add_argument('--size', type=int, default=1000000)
+  parser.add_argument('--length', type=int, default=20000)
+  args = parser.parse_args(argv)
+  index_classes = [RangeIndex, BTreeRangeIndex, RecursiveRangeIndex]
+
+  layer = random_layer(args.wires, args.size, args.length)
+  operations = sweep_operations(layer)
+  sys.stdout.write('%d wires, %d operations\n' % (len(layer.wires),
+                                                  len(operations)))
+  bench_indexes(operations, index_classes)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
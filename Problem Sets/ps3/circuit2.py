@@ -1,14 +1,29 @@
 #!/usr/bin/env python
 
+import array  # Used by ArrayCrossVerifier and ColumnarWireLayer
+import bisect # Used by ArrayCrossVerifier
+import hashlib  # Used to validate binary layers
+import heapq  # Used by WireRTree
 import json   # Used when TRACE=jsonp
+import math   # Used by WireRTree
+import mmap   # Used to load binary layers
+import multiprocessing  # Used by ParallelCrossVerifier
 import os     # Used to get the TRACE environment variable
 import re     # Used when TRACE=jsonp
+import struct # Used by the binary layer format
 import sys    # Used to smooth over the range / xrange issue.
 
 # Python 3 doesn't have xrange, and range behaves like xrange.
 if sys.version_info >= (3,):
     xrange = range
 
+# NumPy is optional. ArrayCrossVerifier uses it to sort the sweep line events
+# when it is installed.
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
 # Circuit verification library.
 
 class Wire(object):
@@ -128,7 +143,12 @@ class WireLayer(object):
     layer = WireLayer()
     
     while True:
-      command = file.readline().split()
+      line = file.readline()
+      if len(line) == 0:
+        break
+      command = line.split()
+      if len(command) == 0:
+        continue
       if command[0] == 'wire':
         coordinates = [float(token) for token in command[2:6]]
         layer.add_wire(command[1], *coordinates)
@@ -136,6 +156,227 @@ class WireLayer(object):
         break
       
     return layer
+  
+  def columns(self):
+    """The wires' names and normalized coordinates, as columns.
+    
+    Returns a (names, x1, y1, x2, y2) tuple, in the format taken by
+    ArrayCrossVerifier.from_columns."""
+    wires = list(self.wires.values())
+    return ([wire.name for wire in wires],
+            array.array('d', [wire.x1 for wire in wires]),
+            array.array('d', [wire.y1 for wire in wires]),
+            array.array('d', [wire.x2 for wire in wires]),
+            array.array('d', [wire.y2 for wire in wires]))
+
+# A wire command in a layer's textual description.
+_WIRE_COMMAND = re.compile(r'^[ \t]*wire[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)'
+                           r'[ \t]+(\S+)[ \t]+(\S+)', re.M)
+# Any line with a wire command, well-formed or not.
+_WIRE_LINE = re.compile(r'^[ \t]*wire(?:[ \t].*)?$', re.M)
+# The command that ends a layer's textual description.
+_DONE_COMMAND = re.compile(r'^[ \t]*done\b', re.M)
+# The command that starts a layer in a multi-layer description.
+_LAYER_COMMAND = re.compile(r'^[ \t]*layer[ \t]+(\S+)[ \t]*$', re.M)
+
+# The binary layer format: a header, the x1, y1, x2 and y2 columns as native
+# doubles, then the wire names in UTF-8, separated by newlines. The header has
+# the magic bytes, format version, byte order, SHA-1 digest of the textual
+# description, wire count and length of the names, padded to 8 bytes.
+_LAYER_MAGIC = b'WIRELAYR'
+_LAYER_VERSION = 1
+_LAYER_HEADER = struct.Struct('<8sIB20s7xQQ')
+
+class ColumnarWireLayer(object):
+  """The layout of one layer of wires, stored as columns.
+  
+  Instead of a dict of Wire objects, the layer keeps the wires' names in a
+  list and their normalized coordinates in parallel arrays, which take a few
+  dozen bytes per wire. ArrayCrossVerifier and ParallelCrossVerifier read the
+  columns directly; the wires property builds Wire objects for the other
+  verifiers.
+  
+  The columns of a layer read by from_binary_path are views of the file's
+  memory map; they are copied into arrays the first time a wire is added."""
+  
+  def __init__(self):
+    """Creates a layer layout with no wires."""
+    self.names = []
+    # The wires' names, to check that new names are unique.
+    self.name_set = set()
+    self.x1 = array.array('d')
+    self.y1 = array.array('d')
+    self.x2 = array.array('d')
+    self.y2 = array.array('d')
+    # The memory map behind the columns of a layer read by from_binary_path.
+    self.mapping = None
+  
+  def __len__(self):
+    return len(self.names)
+  
+  def add_wire(self, name, x1, y1, x2, y2):
+    """Adds a wire to a layer layout.
+    
+    Takes the same arguments and raises the same exceptions as
+    WireLayer.add_wire."""
+    if self.mapping is not None:
+      # Memoryviews can't grow, so the columns are copied out of the map.
+      self.x1, self.y1, self.x2, self.y2 = [
+          array.array('d', column)
+          for column in (self.x1, self.y1, self.x2, self.y2)]
+      self.mapping = None
+    self._append(name, x1, y1, x2, y2)
+  
+  def _append(self, name, x1, y1, x2, y2):
+    """Checks, normalizes and appends a wire."""
+    if name in self.name_set:
+      raise ValueError('Wire name ' + name + ' not unique')
+    if x1 > x2:
+      x1, x2 = x2, x1
+    if y1 > y2:
+      y1, y2 = y2, y1
+    if x1 != x2 and y1 != y2:
+      raise ValueError('Wire ' + name + ' is neither horizontal nor vertical')
+    self.names.append(name)
+    self.name_set.add(name)
+    self.x1.append(x1)
+    self.y1.append(y1)
+    self.x2.append(x2)
+    self.y2.append(y2)
+  
+  def columns(self):
+    """The wires' names and normalized coordinates, as columns.
+    
+    Returns a (names, x1, y1, x2, y2) tuple, in the format taken by
+    ArrayCrossVerifier.from_columns."""
+    return self.names, self.x1, self.y1, self.x2, self.y2
+  
+  @property
+  def wires(self):
+    """A dict mapping the wires' names to new Wire objects."""
+    return dict([(self.names[i], Wire(self.names[i], self.x1[i], self.y1[i],
+                                      self.x2[i], self.y2[i]))
+                 for i in xrange(len(self.names))])
+  
+  def as_json(self):
+    """Dict that obeys the JSON format restrictions, representing the layout."""
+    return {'wires': [{'id': self.names[i], 'x': [self.x1[i], self.x2[i]],
+                       'y': [self.y1[i], self.y2[i]]}
+                      for i in xrange(len(self.names))]}
+  
+  @staticmethod
+  def from_file(file, cache_path=None):
+    """Builds a layer layout by reading a textual description from a file.
+    
+    The description is read all at once, and the wire commands before the
+    'done' command are parsed in bulk.
+    
+    Args:
+      file: a File object supplying the input
+      cache_path: optional path of a binary copy of the layer; it is used
+          instead of parsing if it was made from the same description, and
+          it is rewritten otherwise
+    
+    Returns a new ColumnarWireLayer instance."""
+    text = file.read()
+    digest = hashlib.sha1(text.encode('utf-8')).digest()
+    if cache_path is not None:
+      layer = ColumnarWireLayer.from_binary_path(cache_path, digest)
+      if layer is not None:
+        return layer
+    layer = ColumnarWireLayer.from_text(text)
+    if cache_path is not None:
+      layer.to_binary_path(cache_path, digest)
+    return layer
+  
+  @staticmethod
+  def from_text(text):
+    """Builds a layer layout out of its textual description.
+    
+    Only the wire commands before the 'done' command are used. Raises a
+    ValueError if a wire command is malformed, like WireLayer.from_file.
+    
+    Returns a new ColumnarWireLayer instance."""
+    done = _DONE_COMMAND.search(text)
+    if done is not None:
+      text = text[:done.start()]
+    layer = ColumnarWireLayer()
+    commands = _WIRE_COMMAND.findall(text)
+    if len(commands) != len(_WIRE_LINE.findall(text)):
+      for line in _WIRE_LINE.findall(text):
+        if _WIRE_COMMAND.match(line) is None:
+          raise ValueError('Malformed wire command: ' + line.strip())
+    for name, x1, y1, x2, y2 in commands:
+      layer._append(sys.intern(name), float(x1), float(y1), float(x2),
+                    float(y2))
+    return layer
+  
+  def to_binary_path(self, path, digest=b''):
+    """Writes the layer in the binary layer format.
+    
+    Args:
+      path: the path of the binary file
+      digest: the SHA-1 digest (as bytes) of the layer's textual description,
+          if it came from one
+    """
+    names = '\n'.join(self.names).encode('utf-8')
+    # The file is written under a temporary name and renamed into place, so
+    # readers never see a partial file, and layers that map the old file
+    # keep their data.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+      file.write(_LAYER_HEADER.pack(_LAYER_MAGIC, _LAYER_VERSION,
+                                    sys.byteorder == 'little', digest,
+                                    len(self.names), len(names)))
+      for column in (self.x1, self.y1, self.x2, self.y2):
+        file.write(array.array('d', column).tobytes())
+      file.write(names)
+    os.replace(temp_path, path)
+  
+  @staticmethod
+  def from_binary_path(path, digest=None):
+    """Maps a layer written by to_binary_path into memory.
+    
+    The coordinate columns are memoryviews of the file's memory map, so they
+    are not copied, and the operating system only pages in what is used.
+    
+    Args:
+      path: the path of the binary file
+      digest: if given, the file is only used if it was made from a textual
+          description with this SHA-1 digest
+    
+    Returns a new ColumnarWireLayer instance, or None if the file is missing,
+    stale, or has a different format version or byte order."""
+    try:
+      with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+      return None
+    if len(data) < _LAYER_HEADER.size:
+      data.close()
+      return None
+    magic, version, little_endian, layer_digest, count, names_length = \
+        _LAYER_HEADER.unpack_from(data, 0)
+    if (magic != _LAYER_MAGIC or version != _LAYER_VERSION or
+        bool(little_endian) != (sys.byteorder == 'little') or
+        (digest is not None and layer_digest != digest) or
+        len(data) != _LAYER_HEADER.size + 32 * count + names_length):
+      data.close()
+      return None
+    
+    layer = ColumnarWireLayer()
+    layer.mapping = data
+    view = memoryview(data)
+    offset = _LAYER_HEADER.size
+    columns = []
+    for i in xrange(4):
+      columns.append(view[offset:offset + 8 * count].cast('d'))
+      offset += 8 * count
+    layer.x1, layer.y1, layer.x2, layer.y2 = columns
+    names = view[offset:offset + names_length].tobytes().decode('utf-8')
+    layer.names = names.split('\n') if count > 0 else []
+    layer.name_set = set(layer.names)
+    return layer
 
 #########
 ## BST ##
@@ -169,85 +410,99 @@ class BST(object):
     insert
     find
     delete
+  
+  The operations are iterative, so skewed trees can't exhaust the stack, and
+  they keep every node's parent pointer up to date.
   """
   def __init__(self):
     self.root = None
 
-  def insert(self, key):
-    self.root = self._insert(key, self.root, None)
+  def _new_node(self, key, parent):
+    """node factory, overridden by subclasses with augmented nodes"""
+    return BSTNode(key, parent)
 
-  def _insert(self, key, node, parent):
-    ## base case
-    if node == None:
-      return BSTNode(key, parent)
-    ## recursion
-    if key < node.key:
-      node.left = self._insert(key, node.left, node)
-    elif key > node.key:
-      node.right = self._insert(key, node.right, node)
-    return node
+  def insert(self, key):
+    parent = None
+    node = self.root
+    while node != None:
+      if key < node.key:
+        parent, node = node, node.left
+      elif key > node.key:
+        parent, node = node, node.right
+      else:
+        return
+    node = self._new_node(key, parent)
+    if parent == None:
+      self.root = node
+    elif key < parent.key:
+      parent.left = node
+    else:
+      parent.right = node
+    self._retrace(parent)
 
   def find(self, key):
-    return self._find(key, self.root)
+    node = self.root
+    while node != None:
+      if key < node.key:
+        node = node.left
+      elif key > node.key:
+        node = node.right
+      else:
+        return node
+    return None
 
-  def _find(self, key, node):
-    ## base cases
+  def delete(self, key):
+    node = self.find(key)
     if node == None:
-      return None
-    if key == node.key:
-      return node
-    ## recursion
-    if key < node.key:
-      return self._find(key, node.left)
-    elif key > node.key:
-      return self._find(key, node.right)
+      return
+    ## two children: take the successor's key, and unlink the successor
+    if node.left != None and node.right != None:
+      successor = self._find_min(node.right)
+      node.key = successor.key
+      node = successor
+    ## now node has at most one child
+    child = node.left or node.right
+    parent = node.parent
+    self._replace_child(parent, node, child)
+    self._retrace(parent)
 
-  def delete(self, key):
-    self.root = self._delete(key, self.root, None)
+  def _replace_child(self, parent, node, child):
+    """put child (possibly None) where node was under parent"""
+    if child != None:
+      child.parent = parent
+    if parent == None:
+      self.root = child
+    elif parent.left is node:
+      parent.left = child
+    else:
+      parent.right = child
 
-  def _delete(self, key, node, parent):
-    ## base cases
-    if node == None:
-      return None
-    if key == node.key:
-      ## no children
-      if node.left == node.right == None:
-        node = None
-      ## one child
-      elif node.left == None or node.right == None:
-        node = node.left or node.right
-        node.parent = parent
-      ## two children
-      else:
-        successor = self._find_min(node.right)
-        node.key, successor.key = successor.key, key
-        node.right = self._delete(key, node.right, node)
-      return node
-    ## recursion
-    if key < node.key:
-      node.left = self._delete(key, node.left, node)
-    elif key > node.key:
-      node.right = self._delete(key, node.right, node)
-    return node
+  def _retrace(self, node):
+    """called with the lowest node whose subtree changed, after an update"""
+    pass
 
   def _find_min(self, node):
     """find node with min value in a non-empty tree"""
-    if node.left == None:
-      return node
-    return self._find_min(node.left)
+    while node.left != None:
+      node = node.left
+    return node
 
   def check_ri(self):
     return self._check_ri(self.root)
   
-  def _check_ri(self, node):
-    if node == None:
-      return
-    if node.left != None and node.left.key > node.key:
-      raise Exception('BST RI exception!')
-    if node.right != None and node.right.key < node.key:
-      raise Exception('BST RI exception!')
-    self._check_ri(node.left)
-    self._check_ri(node.right)
+  def _check_ri(self, root):
+    stack = [root] if root != None else []
+    while stack:
+      node = stack.pop()
+      for child in (node.left, node.right):
+        if child != None:
+          if child.parent is not node:
+            raise Exception('BST RI exception!')
+          stack.append(child)
+      if node.left != None and node.left.key > node.key:
+        raise Exception('BST RI exception!')
+      if node.right != None and node.right.key < node.key:
+        raise Exception('BST RI exception!')
 
 ##############
 ## AVL TREE ##
@@ -272,6 +527,9 @@ class AVL(BST):
     size
   """
   
+  def _new_node(self, key, parent):
+    return AVLNode(key, parent)
+
   def _node_update(self, node):
     """when trace back in recursion, update node's height and size"""
     node.height = max(self._height(node.left), self._height(node.right)) + 1
@@ -288,36 +546,168 @@ class AVL(BST):
       return 0
     return node.size
   
-  def _left_rotate(self, node, parent):
+  def _retrace(self, node):
+    """walk up to the root, updating and rebalancing every ancestor"""
+    while node != None:
+      height = node.height
+      new_node = self._rebalance_node(node)
+      if new_node is node and node.height == height:
+        break
+      node = new_node.parent
+    if node == None:
+      return
+    ## the heights above node didn't change, so only the sizes need updating
+    node = node.parent
+    while node != None:
+      left, right = node.left, node.right
+      node.size = ((left.size if left != None else 0) +
+                   (right.size if right != None else 0) + 1)
+      node = node.parent
+
+  def _rebalance_node(self, node):
+    """rebalance node's subtree, returning the subtree's new root"""
+    self._node_update(node)
+    if self._height(node.right) - self._height(node.left) >= 2:
+      if self._height(node.right.left) > self._height(node.right.right):
+        self._rotate_right(node.right)
+      node = self._rotate_left(node)
+    elif self._height(node.left) - self._height(node.right) >= 2:
+      if self._height(node.left.right) > self._height(node.left.left):
+        self._rotate_left(node.left)
+      node = self._rotate_right(node)
+    return node
+
+  def _rotate_left(self, node):
+    """rotate node's right child above it, fixing parent pointers"""
     new_node = node.right
     node.right = new_node.left
+    if new_node.left != None:
+      new_node.left.parent = node
+    self._replace_child(node.parent, node, new_node)
     new_node.left = node
-    new_node.parent = parent
+    node.parent = new_node
     self._node_update(node)
     self._node_update(new_node)
     return new_node
 
-  def _right_rotate(self, node, parent):
+  def _rotate_right(self, node):
+    """rotate node's left child above it, fixing parent pointers"""
     new_node = node.left
     node.left = new_node.right
+    if new_node.right != None:
+      new_node.right.parent = node
+    self._replace_child(node.parent, node, new_node)
     new_node.right = node
-    new_node.parent = parent
+    node.parent = new_node
     self._node_update(node)
     self._node_update(new_node)
     return new_node
   
-  def _rebalance(self, node, parent):
-    self._node_update(node)
-    if self._height(node.right) - self._height(node.left) >= 2:
-      if self._height(node.right.left) > self._height(node.right.left):
-        node.right = self._right_rotate(node.right, node)
-      node = self._left_rotate(node, parent)
-    elif self._height(node.left) - self._height(node.right) >= 2:
-      if self._height(node.left.right) > self._height(node.left.right):
-        node.left = self._left_rotate(node.left, node)
-      node = self._right_rotate(node, parent)
+  def _check_ri(self, root):
+    BST._check_ri(self, root)
+    stack = [root] if root != None else []
+    while stack:
+      node = stack.pop()
+      if abs(self._height(node.left) - self._height(node.right)) >= 2:
+        raise Exception('AVL Tree RI exception!')
+      if node.size != self._size(node.left) + self._size(node.right) + 1:
+        raise Exception('AVL Tree RI exception!')
+      stack.extend([child for child in (node.left, node.right)
+                    if child != None])
+
+class RangeIndex(AVL):
+
+  def add(self, key):
+    self.insert(key)
+  
+  def remove(self, key):
+    self.delete(key)
+
+  def list(self, l, h):
+    """the keys in [l, h], in post-order from their LCA"""
+    return [key for key in self.iter_list(l, h)]
+
+  def iter_list(self, l, h):
+    """generator over the keys in [l, h], in the same order as list
+    
+    The stack holds at most two nodes per level of the tree. The index must
+    not change while the generator is being used."""
+    lca = self._LCA(l, h)
+    stack = [] if lca == None else [(lca, False)]
+    while stack:
+      node, visited = stack.pop()
+      if visited:
+        if l <= node.key <= h:
+          yield node.key
+        continue
+      ## the node comes after its left subtree, then its right subtree
+      stack.append((node, True))
+      if node.key <= h and node.right != None:
+        stack.append((node.right, False))
+      if node.key >= l and node.left != None:
+        stack.append((node.left, False))
+
+  def iter_range(self, l, h):
+    """generator over the keys in [l, h], in sorted order
+    
+    The stack only holds one path of the tree, so memory use doesn't grow with
+    the number of keys in the range. The index must not change while the
+    generator is being used."""
+    stack = []
+    node = self.root
+    while True:
+      ## go down to the smallest key >= l, remembering the path
+      while node != None:
+        if node.key < l:
+          node = node.right
+        else:
+          stack.append(node)
+          node = node.left
+      if not stack:
+        break
+      node = stack.pop()
+      if node.key > h:
+        break
+      yield node.key
+      node = node.right
+
+  def _LCA(self, l, h):
+    node = self.root
+    while True:
+      if node == None or (l <= node.key and h >= node.key):
+        break
+      if l < node.key:
+        node = node.left
+      else:
+        node = node.right
     return node
 
+  def count(self, l, h):
+    return self._rank(h) - self._rank(l)
+
+  def _rank(self, key):
+    """the number of keys <= key"""
+    rank = 0
+    node = self.root
+    while node != None:
+      if key < node.key:
+        node = node.left
+      else:
+        rank += 1 + self._size(node.left)
+        if key == node.key:
+          break
+        node = node.right
+    return rank
+
+class RecursiveRangeIndex(RangeIndex):
+  """RangeIndex with the original recursive AVL operations.
+  
+  Kept as a reference for testing and benchmarking the iterative operations.
+  It does not keep the nodes' parent pointers up to date."""
+
+  def insert(self, key):
+    self.root = self._insert(key, self.root, None)
+
   def _insert(self, key, node, parent):
     ## base case
     if node == None:
@@ -330,6 +720,24 @@ class AVL(BST):
     node = self._rebalance(node, parent)
     return node
 
+  def find(self, key):
+    return self._find(key, self.root)
+
+  def _find(self, key, node):
+    ## base cases
+    if node == None:
+      return None
+    if key == node.key:
+      return node
+    ## recursion
+    if key < node.key:
+      return self._find(key, node.left)
+    elif key > node.key:
+      return self._find(key, node.right)
+
+  def delete(self, key):
+    self.root = self._delete(key, self.root, None)
+
   def _delete(self, key, node, parent):
     ## base cases
     if node == None:
@@ -357,7 +765,37 @@ class AVL(BST):
       node.right = self._delete(key, node.right, node)
     node = self._rebalance(node, parent)
     return node
+
+  def _left_rotate(self, node, parent):
+    new_node = node.right
+    node.right = new_node.left
+    new_node.left = node
+    new_node.parent = parent
+    self._node_update(node)
+    self._node_update(new_node)
+    return new_node
+
+  def _right_rotate(self, node, parent):
+    new_node = node.left
+    node.left = new_node.right
+    new_node.right = node
+    new_node.parent = parent
+    self._node_update(node)
+    self._node_update(new_node)
+    return new_node
   
+  def _rebalance(self, node, parent):
+    self._node_update(node)
+    if self._height(node.right) - self._height(node.left) >= 2:
+      if self._height(node.right.left) > self._height(node.right.right):
+        node.right = self._right_rotate(node.right, node)
+      node = self._left_rotate(node, parent)
+    elif self._height(node.left) - self._height(node.right) >= 2:
+      if self._height(node.left.right) > self._height(node.left.left):
+        node.left = self._left_rotate(node.left, node)
+      node = self._right_rotate(node, parent)
+    return node
+
   def _check_ri(self, node):
     if node == None:
       return
@@ -366,31 +804,12 @@ class AVL(BST):
     self._check_ri(node.left)
     self._check_ri(node.right)
 
-class RangeIndex(AVL):
-
-  def add(self, key):
-    self.insert(key)
-  
-  def remove(self, key):
-    self.delete(key)
-
   def list(self, l, h):
     lca = self._LCA(l, h)
     result = []
     self._node_list(lca, l, h, result)
     return result
 
-  def _LCA(self, l, h):
-    node = self.root
-    while True:
-      if node == None or (l <= node.key and h >= node.key):
-        break
-      if l < node.key:
-        node = node.left
-      else:
-        node = node.right
-    return node
-
   def _node_list(self, node, l, h, result):
     if node == None:
       return
@@ -414,9 +833,246 @@ class RangeIndex(AVL):
     else:
       return 1 + self._size(node.left) + self._rank(key, node.right)
 
+############
+## B-TREE ##
+############
+
+class BTreeNode(object):
+  """
+  Node of a counted B+ tree.
+  Attributes:
+    keys: the sorted keys in a leaf; the separators in an internal node, where
+        keys[i] is the smallest key under children[i + 1]
+    children: the child nodes, or None in a leaf
+    count: the number of keys in the node's subtree
+    next: the next leaf, in key order (leaves only)
+  """
+  __slots__ = ('keys', 'children', 'count', 'next')
+
+  def __init__(self, keys, children):
+    self.keys = keys
+    self.children = children
+    if children == None:
+      self.count = len(keys)
+    else:
+      self.count = sum([child.count for child in children])
+    self.next = None
+
+  def entries(self):
+    """the number of keys in a leaf, or of children in an internal node"""
+    if self.children == None:
+      return len(self.keys)
+    return len(self.children)
+
+class BTreeRangeIndex(object):
+  """
+  Range index backed by an order-statistic B+ tree.
+  Methods:
+    add
+    remove
+    count
+    list
+    iter_list
+    iter_range
+
+  Every node other than the root has between order and 2 * order entries,
+  and all the leaves are at the same depth, whatever the order in which the
+  keys arrive. Every node knows how many keys are in its subtree, so
+  add, remove and count take O(order * log n / log order) time, and list
+  takes that plus the number of keys listed. Keys are added at most once,
+  like in RangeIndex.
+  """
+  def __init__(self, order=32):
+    self.order = order
+    self.root = BTreeNode([], None)
+
+  def __len__(self):
+    return self.root.count
+
+  def _path(self, key):
+    """the nodes from the root to the leaf that should hold key, and the
+    child index taken at every internal node"""
+    nodes = []
+    indexes = []
+    node = self.root
+    while node.children != None:
+      i = bisect.bisect_right(node.keys, key)
+      nodes.append(node)
+      indexes.append(i)
+      node = node.children[i]
+    nodes.append(node)
+    return nodes, indexes
+
+  def add(self, key):
+    nodes, indexes = self._path(key)
+    leaf = nodes[-1]
+    i = bisect.bisect_left(leaf.keys, key)
+    if i < len(leaf.keys) and leaf.keys[i] == key:
+      return
+    leaf.keys.insert(i, key)
+    for node in nodes:
+      node.count += 1
+    ## split the full nodes, bottom up
+    depth = len(nodes) - 1
+    while depth >= 0 and nodes[depth].entries() > 2 * self.order:
+      node = nodes[depth]
+      separator, right = self._split(node)
+      if depth == 0:
+        self.root = BTreeNode([separator], [node, right])
+      else:
+        parent = nodes[depth - 1]
+        parent.keys.insert(indexes[depth - 1], separator)
+        parent.children.insert(indexes[depth - 1] + 1, right)
+      depth -= 1
+
+  def _split(self, node):
+    """move the upper half of node into a new node, returning the new
+    node and the separator that goes between them"""
+    half = node.entries() // 2
+    if node.children == None:
+      right = BTreeNode(node.keys[half:], None)
+      del node.keys[half:]
+      right.next = node.next
+      node.next = right
+      separator = right.keys[0]
+    else:
+      separator = node.keys[half - 1]
+      right = BTreeNode(node.keys[half:], node.children[half:])
+      del node.keys[half - 1:]
+      del node.children[half:]
+    node.count -= right.count
+    return separator, right
+
+  def remove(self, key):
+    nodes, indexes = self._path(key)
+    leaf = nodes[-1]
+    i = bisect.bisect_left(leaf.keys, key)
+    ## KeyWirePair's != is unreliable, so test with ==
+    if i == len(leaf.keys) or not leaf.keys[i] == key:
+      return
+    del leaf.keys[i]
+    for node in nodes:
+      node.count -= 1
+    ## refill the nodes that got too small, bottom up
+    for depth in xrange(len(nodes) - 1, 0, -1):
+      if nodes[depth].entries() >= self.order:
+        break
+      self._refill(nodes[depth - 1], indexes[depth - 1])
+    root = self.root
+    if root.children != None and len(root.children) == 1:
+      self.root = root.children[0]
+
+  def _refill(self, parent, i):
+    """merge parent.children[i] with a sibling, or move entries over from
+    the sibling, so both have at least order entries"""
+    if i == len(parent.children) - 1:
+      i -= 1
+    left, right = parent.children[i], parent.children[i + 1]
+    separator = parent.keys[i]
+    if left.children == None:
+      keys = left.keys + right.keys
+      children = None
+    else:
+      keys = left.keys + [separator] + right.keys
+      children = left.children + right.children
+    if left.entries() + right.entries() <= 2 * self.order:
+      left.keys = keys
+      left.children = children
+      left.count += right.count
+      left.next = right.next
+      del parent.keys[i]
+      del parent.children[i + 1]
+      return
+    half = (left.entries() + right.entries()) // 2
+    if children == None:
+      left.keys, right.keys = keys[:half], keys[half:]
+      parent.keys[i] = right.keys[0]
+      left.count, right.count = len(left.keys), len(right.keys)
+    else:
+      left.keys, right.keys = keys[:half - 1], keys[half:]
+      parent.keys[i] = keys[half - 1]
+      left.children, right.children = children[:half], children[half:]
+      total = left.count + right.count
+      left.count = sum([child.count for child in left.children])
+      right.count = total - left.count
+
+  def _rank(self, key):
+    """the number of keys <= key"""
+    rank = 0
+    node = self.root
+    while node.children != None:
+      i = bisect.bisect_right(node.keys, key)
+      for child in node.children[:i]:
+        rank += child.count
+      node = node.children[i]
+    return rank + bisect.bisect_right(node.keys, key)
+
+  def count(self, l, h):
+    return self._rank(h) - self._rank(l)
+
+  def list(self, l, h):
+    """the keys in [l, h], in sorted order"""
+    return [key for key in self.iter_range(l, h)]
+
+  def iter_list(self, l, h):
+    """generator over the keys in [l, h], in the same order as list"""
+    return self.iter_range(l, h)
+
+  def iter_range(self, l, h):
+    """generator over the keys in [l, h], in sorted order"""
+    leaf = self._path(l)[0][-1]
+    i = bisect.bisect_left(leaf.keys, l)
+    while leaf != None:
+      keys = leaf.keys
+      while i < len(keys):
+        if keys[i] > h:
+          return
+        yield keys[i]
+        i += 1
+      leaf = leaf.next
+      i = 0
+
+  def check_ri(self):
+    """raise an exception if the tree's invariants don't hold"""
+    ## every subtree's keys are in [low, high), given by the separators
+    stack = [(self.root, 0, None, None)]
+    depths = set()
+    while stack:
+      node, depth, low, high = stack.pop()
+      if node is not self.root and not \
+          self.order <= node.entries() <= 2 * self.order:
+        raise Exception('B-tree RI exception!')
+      if node.children == None:
+        depths.add(depth)
+        if node.count != len(node.keys):
+          raise Exception('B-tree RI exception!')
+        for key in node.keys:
+          if (low != None and key < low) or (high != None and key >= high):
+            raise Exception('B-tree RI exception!')
+        continue
+      if len(node.keys) != len(node.children) - 1 or \
+          node.count != sum([child.count for child in node.children]):
+        raise Exception('B-tree RI exception!')
+      bounds = [low] + node.keys + [high]
+      for i in xrange(len(node.children)):
+        stack.append((node.children[i], depth + 1, bounds[i], bounds[i + 1]))
+    if len(depths) > 1:
+      raise Exception('B-tree RI exception!')
+    ## the leaf chain visits every key, in order
+    node = self.root
+    while node.children != None:
+      node = node.children[0]
+    keys = []
+    while node != None:
+      keys.extend(node.keys)
+      node = node.next
+    if len(keys) != self.root.count or \
+        any([keys[i] >= keys[i + 1] for i in xrange(len(keys) - 1)]):
+      raise Exception('B-tree RI exception!')
+
+#########
+## END ##
 #########
-## END ##
-#########
 
 ## archive
 
@@ -449,33 +1105,299 @@ class RangeIndex(AVL):
   #         result += 1
   #     return result
   
+class TraceRecorder(object):
+  """Receives the trace of a TracedCrossVerifier, one operation at a time.
+  
+  Subclasses decide where the records go. The recorder can keep only every
+  sample-th record, stop after limit records, and cut the wire lists of list
+  queries to max_ids names, so traces of big layers stay small."""
+  
+  def __init__(self, sample=1, limit=None, max_ids=None):
+    """Sets the sampling and limits.
+    
+    Args:
+      sample: only every sample-th operation is recorded
+      limit: the maximum number of records; None means no limit
+      max_ids: the maximum number of wire names in a list record; None means
+          no limit
+    """
+    self.sample = sample
+    self.limit = limit
+    self.max_ids = max_ids
+    # The number of operations seen, and the number recorded.
+    self.seen = 0
+    self.recorded = 0
+  
+  def _keep(self):
+    # Decides whether the current operation is recorded.
+    self.seen += 1
+    if (self.seen - 1) % self.sample != 0:
+      return False
+    if self.limit is not None and self.recorded >= self.limit:
+      return False
+    self.recorded += 1
+    return True
+  
+  def record_add(self, name):
+    """A wire was added to the range index."""
+    if self._keep():
+      self._add('add', name)
+  
+  def record_delete(self, name):
+    """A wire was removed from the range index."""
+    if self._keep():
+      self._add('delete', name)
+  
+  def record_list(self, first, last, names):
+    """A list query over [first, last] returned the wires with these names.
+    
+    The names can be any iterable; it is only consumed if the query is
+    recorded."""
+    if self._keep():
+      if self.max_ids is None:
+        ids, more = list(names), 0
+      else:
+        ids = list(names)
+        ids, more = ids[:self.max_ids], max(0, len(ids) - self.max_ids)
+      self._list(first, last, ids, more)
+  
+  def record_count(self, first, last, count):
+    """A count query over [first, last] returned count."""
+    if self._keep():
+      self._count(first, last, count)
+  
+  def record_crossing(self, name1, name2):
+    """Two wires were found to cross."""
+    if self._keep():
+      self._crossing(name1, name2)
+  
+  def record_sweep(self, x):
+    """The sweep line moved to x."""
+    if self._keep():
+      self._sweep(x)
+  
+  def as_json(self):
+    """List that obeys the JSON format restrictions with the trace."""
+    raise ValueError(type(self).__name__ + ' does not keep its records')
+  
+  def close(self):
+    """Finishes the trace."""
+    pass
+
+class ListTraceRecorder(TraceRecorder):
+  """Records the trace as a list of dicts, the format used by the visualizer.
+  
+  This is the default recorder, and the one used when a Traced* class is
+  given a plain list."""
+  
+  def __init__(self, records=None, **limits):
+    """Records into the given list, or into a new one.
+    
+    The limits are the keyword arguments of TraceRecorder."""
+    TraceRecorder.__init__(self, **limits)
+    self.records = [] if records is None else records
+  
+  def _write(self, record):
+    self.records.append(record)
+  
+  def _add(self, record_type, name):
+    self._write({'type': record_type, 'id': name})
+  
+  def _list(self, first, last, ids, more):
+    record = {'type': 'list', 'from': first, 'to': last, 'ids': ids}
+    if more:
+      record['more'] = more
+    self._write(record)
+  
+  def _count(self, first, last, count):
+    self._write({'type': 'list', 'from': first, 'to': last, 'count': count})
+  
+  def _crossing(self, name1, name2):
+    self._write({'type': 'crossing', 'id1': name1, 'id2': name2})
+  
+  def _sweep(self, x):
+    self._write({'type': 'sweep', 'x': x})
+  
+  def as_json(self):
+    return self.records
+
+class JsonTraceRecorder(ListTraceRecorder):
+  """Writes the trace to a file as a JSON array, one record at a time.
+  
+  The records are not kept in memory. close() must be called to end the
+  array."""
+  
+  def __init__(self, file, **limits):
+    """Writes the start of the array to a file.
+    
+    The limits are the keyword arguments of TraceRecorder."""
+    ListTraceRecorder.__init__(self, None, **limits)
+    self.file = file
+    self.file.write('[')
+  
+  def _write(self, record):
+    if self.recorded > 1:
+      self.file.write(', ')
+    self.file.write(json.dumps(record))
+  
+  def as_json(self):
+    return TraceRecorder.as_json(self)
+  
+  def close(self):
+    self.file.write(']')
+
+# The binary trace format: a header, the wire names in UTF-8 separated by
+# newlines, then one fixed-width record per operation. The header has the
+# magic bytes, format version, number of names and length of the names. A
+# record has the operation's type code, two wire numbers (indexes in the
+# names), a count, and two coordinates. A list record's count is the number
+# of listed wires, which follow in 'listed' records of the same width that
+# hold up to 7 wire numbers each; its id2 is the number of wires left out by
+# max_ids.
+_TRACE_MAGIC = b'WIRETRCE'
+_TRACE_VERSION = 1
+_TRACE_HEADER = struct.Struct('<8sIIQ')
+_TRACE_RECORD = struct.Struct('<B3xIIIdd')
+_TRACE_LISTED = struct.Struct('<B3x7I')
+_TRACE_TYPES = ['add', 'delete', 'list', 'listed', 'count', 'crossing',
+                'sweep']
+
+class BinaryTraceRecorder(TraceRecorder):
+  """Writes the trace to a binary file, as fixed-width records.
+  
+  Every record takes 32 bytes, and wires are referred to by number, so the
+  trace costs a fraction of its JSON form to write and to store. read()
+  turns a binary trace back into the visualizer's list of dicts."""
+  
+  def __init__(self, file, names, **limits):
+    """Writes the header and the wire names to a binary file.
+    
+    Args:
+      file: a File object opened for binary writing
+      names: the names of all the wires in the layer
+    
+    The limits are the keyword arguments of TraceRecorder."""
+    TraceRecorder.__init__(self, **limits)
+    self.file = file
+    names = list(names)
+    self.numbers = dict([(name, i) for i, name in enumerate(names)])
+    encoded = '\n'.join(names).encode('utf-8')
+    file.write(_TRACE_HEADER.pack(_TRACE_MAGIC, _TRACE_VERSION, len(names),
+                                  len(encoded)))
+    file.write(encoded)
+  
+  def _write(self, record_type, id1=0, id2=0, count=0, first=0.0, last=0.0):
+    self.file.write(_TRACE_RECORD.pack(_TRACE_TYPES.index(record_type), id1,
+                                       id2, count, first, last))
+  
+  def _add(self, record_type, name):
+    self._write(record_type, self.numbers[name])
+  
+  def _list(self, first, last, ids, more):
+    self._write('list', 0, more, len(ids), first, last)
+    numbers = [self.numbers[name] for name in ids]
+    listed_type = _TRACE_TYPES.index('listed')
+    for start in xrange(0, len(numbers), 7):
+      chunk = numbers[start:start + 7]
+      chunk.extend([0] * (7 - len(chunk)))
+      self.file.write(_TRACE_LISTED.pack(listed_type, *chunk))
+  
+  def _count(self, first, last, count):
+    self._write('count', 0, 0, count, first, last)
+  
+  def _crossing(self, name1, name2):
+    self._write('crossing', self.numbers[name1], self.numbers[name2])
+  
+  def _sweep(self, x):
+    self._write('sweep', 0, 0, 0, x)
+  
+  @staticmethod
+  def read(file):
+    """Reads a binary trace.
+    
+    Args:
+      file: a File object opened for binary reading
+    
+    Returns the trace as a list of dicts, like ListTraceRecorder's records.
+    """
+    magic, version, count, names_length = _TRACE_HEADER.unpack(
+        file.read(_TRACE_HEADER.size))
+    if magic != _TRACE_MAGIC or version != _TRACE_VERSION:
+      raise ValueError('Not a binary trace')
+    names = file.read(names_length).decode('utf-8').split('\n')
+    data = file.read()
+    records = []
+    # The number of wires still to be read for the last list record.
+    unlisted = 0
+    for offset in xrange(0, len(data), _TRACE_RECORD.size):
+      record_type = _TRACE_TYPES[data[offset]]
+      if record_type == 'listed':
+        numbers = _TRACE_LISTED.unpack_from(data, offset)[1:1 + unlisted]
+        records[-1]['ids'].extend([names[number] for number in numbers])
+        unlisted -= len(numbers)
+        continue
+      (type_code, id1, id2, count, first, last) = \
+          _TRACE_RECORD.unpack_from(data, offset)
+      if record_type in ('add', 'delete'):
+        records.append({'type': record_type, 'id': names[id1]})
+      elif record_type == 'list':
+        record = {'type': 'list', 'from': first, 'to': last, 'ids': []}
+        if id2:
+          record['more'] = id2
+        records.append(record)
+        unlisted = count
+      elif record_type == 'count':
+        records.append({'type': 'list', 'from': first, 'to': last,
+                        'count': count})
+      elif record_type == 'crossing':
+        records.append({'type': 'crossing', 'id1': names[id1],
+                        'id2': names[id2]})
+      else:
+        records.append({'type': 'sweep', 'x': first})
+    return records
+
+def _trace_recorder(trace):
+  """The TraceRecorder for a trace given to a Traced* class.
+  
+  Plain lists are wrapped in a ListTraceRecorder."""
+  if isinstance(trace, TraceRecorder):
+    return trace
+  return ListTraceRecorder(trace)
+
 class TracedRangeIndex(RangeIndex):
   """Augments RangeIndex to build a trace for the visualizer."""
   
   def __init__(self, trace):
-    """Sets the object receiving tracing info."""
+    """Sets the object receiving tracing info.
+    
+    Args:
+      trace: a TraceRecorder, or a list that gets the trace's dicts
+    """
     RangeIndex.__init__(self)
     self.trace = trace
+    self.recorder = _trace_recorder(trace)
   
   def add(self, key):
-    self.trace.append({'type': 'add', 'id': key.wire.name})
+    self.recorder.record_add(key.wire.name)
     RangeIndex.add(self, key)
   
   def remove(self, key):
-    self.trace.append({'type': 'delete', 'id': key.wire.name})
+    self.recorder.record_delete(key.wire.name)
     RangeIndex.remove(self, key)
   
   def list(self, first_key, last_key):
-    result = RangeIndex.list(self, first_key, last_key)
-    self.trace.append({'type': 'list', 'from': first_key.key,
-                       'to': last_key.key,
-                       'ids': [key.wire.name for key in result]}) 
+    result = [key for key in RangeIndex.iter_list(self, first_key, last_key)]
+    self.recorder.record_list(first_key.key, last_key.key,
+                              (key.wire.name for key in result))
     return result
   
+  def iter_list(self, first_key, last_key):
+    # The trace needs the whole list anyway.
+    return iter(self.list(first_key, last_key))
+  
   def count(self, first_key, last_key):
     result = RangeIndex.count(self, first_key, last_key)
-    self.trace.append({'type': 'list', 'from': first_key.key,
-                       'to': last_key.key, 'count': result})
+    self.recorder.record_count(first_key.key, last_key.key, result)
     return result
 
 class ResultSet(object):
@@ -489,23 +1411,57 @@ class ResultSet(object):
     """Records the fact that two wires are crossing."""
     self.crossings.append(sorted([wire1.name, wire2.name]))
   
+  def add_named_crossing(self, name1, name2):
+    """Records the fact that two wires, given by their names, are crossing."""
+    self.crossings.append(sorted([name1, name2]))
+  
   def write_to_file(self, file):
     """Write the result to a file."""
     for crossing in self.crossings:
       file.write(' '.join(crossing))
       file.write('\n')
 
+class StreamingResultSet(ResultSet):
+  """A ResultSet that writes the crossings to a file as they are recorded.
+  
+  The crossings are not kept in memory; only their number is."""
+  
+  def __init__(self, file):
+    """Creates an empty result set that writes to a file."""
+    ResultSet.__init__(self)
+    self.file = file
+    self.count = 0
+  
+  def add_crossing(self, wire1, wire2):
+    """Writes the fact that two wires are crossing."""
+    self.add_named_crossing(wire1.name, wire2.name)
+  
+  def add_named_crossing(self, name1, name2):
+    """Writes the fact that two wires, given by their names, are crossing."""
+    if name2 < name1:
+      name1, name2 = name2, name1
+    self.file.write(name1 + ' ' + name2 + '\n')
+    self.count += 1
+  
+  def write_to_file(self, file):
+    """Nothing left to write; the crossings were written as they came."""
+    pass
+
 class TracedResultSet(ResultSet):
   """Augments ResultSet to build a trace for the visualizer."""
   
   def __init__(self, trace):
-    """Sets the object receiving tracing info."""
+    """Sets the object receiving tracing info.
+    
+    Args:
+      trace: a TraceRecorder, or a list that gets the trace's dicts
+    """
     ResultSet.__init__(self)
     self.trace = trace
+    self.recorder = _trace_recorder(trace)
     
   def add_crossing(self, wire1, wire2):
-    self.trace.append({'type': 'crossing', 'id1': wire1.name,
-                       'id2': wire2.name})
+    self.recorder.record_crossing(wire1.name, wire2.name)
     ResultSet.add_crossing(self, wire1, wire2)
 
 class KeyWirePair(object):
@@ -579,17 +1535,23 @@ class KeyWirePairH(KeyWirePair):
 class CrossVerifier(object):
   """Checks whether a wire network has any crossing wires."""
   
-  def __init__(self, layer):
+  def __init__(self, layer, index_class=RangeIndex):
     """Verifier for a layer of wires.
     
     Once created, the verifier can list the crossings between wires (the 
-    wire_crossings method) or count the crossings (count_crossings)."""
+    wire_crossings method) or count the crossings (count_crossings).
+    
+    Args:
+      layer: the WireLayer to check
+      index_class: the range index used by the sweep line, e.g. RangeIndex
+          or BTreeRangeIndex
+    """
 
     self.events = []
     self._events_from_layer(layer)
     self.events.sort()
   
-    self.index = RangeIndex()
+    self.index = index_class()
     self.result_set = ResultSet()
     self.performed = False
   
@@ -609,7 +1571,6 @@ class CrossVerifier(object):
 
   def _events_from_layer(self, layer):
     """Populates the sweep line events from the wire layer."""
-    left_edge = min([wire.x1 for wire in layer.wires.values()])
     for wire in layer.wires.values():
       if wire.is_horizontal():
         self.events.append([wire.x1, 0, wire.object_id, 'add', wire])
@@ -617,13 +1578,37 @@ class CrossVerifier(object):
       else:
         self.events.append([wire.x1, 1, wire.object_id, 'query', wire])
 
+  def iter_crossings(self):
+    """A generator over the pairs of wires that cross each other.
+    
+    The pairs are produced as the sweep line finds them, so memory use is
+    bounded by the size of the range index, not by the number of crossings."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return self._iter_crossings()
+
+  def stream_crossings_to_file(self, file):
+    """Writes the pairs of wires that cross each other to a file.
+    
+    The output matches wire_crossings().write_to_file(file), but the crossings
+    are written as they are found instead of being collected first.
+    
+    Returns a StreamingResultSet that knows the number of crossings."""
+    result = StreamingResultSet(file)
+    for wire1, wire2 in self.iter_crossings():
+      result.add_crossing(wire1, wire2)
+    return result
+
   def _compute_crossings(self, count_only):
     """Implements count_crossings and wire_crossings."""
-    if count_only:
-      result = 0
-    else:
+    if not count_only:
       result = self.result_set
+      for wire1, wire2 in self._iter_crossings():
+        result.add_crossing(wire1, wire2)
+      return result
 
+    result = 0
     for event in self.events:
       event_x, event_type, wire = event[0], event[3], event[4]
       
@@ -632,14 +1617,23 @@ class CrossVerifier(object):
       elif event_type == 'delete':
         self.index.remove(KeyWirePair(wire.y1, wire))
       elif event_type == 'query':
-        if count_only:
-          result += self.index.count(KeyWirePairL(wire.y1),
-                                     KeyWirePairH(wire.y2))
-        else:
-          for kwp in self.index.list(KeyWirePairL(wire.y1),
-                                            KeyWirePairH(wire.y2)):
-            result.add_crossing(wire, kwp.wire)
+        result += self.index.count(KeyWirePairL(wire.y1),
+                                   KeyWirePairH(wire.y2))
     return result
+
+  def _iter_crossings(self):
+    """Implements iter_crossings, sweeping as the pairs are consumed."""
+    for event in self.events:
+      event_x, event_type, wire = event[0], event[3], event[4]
+      
+      if event_type == 'add':
+        self.index.add(KeyWirePair(wire.y1, wire))
+      elif event_type == 'delete':
+        self.index.remove(KeyWirePair(wire.y1, wire))
+      elif event_type == 'query':
+        for kwp in self.index.iter_list(KeyWirePairL(wire.y1),
+                                        KeyWirePairH(wire.y2)):
+          yield wire, kwp.wire
   
   def trace_sweep_line(self, x):
     """When tracing is enabled, adds info about where the sweep line is.
@@ -653,33 +1647,992 @@ class CrossVerifier(object):
 class TracedCrossVerifier(CrossVerifier):
   """Augments CrossVerifier to build a trace for the visualizer."""
   
-  def __init__(self, layer):
+  def __init__(self, layer, trace=None):
+    """Verifier for a layer of wires, with tracing.
+    
+    Args:
+      layer: the WireLayer to check
+      trace: a TraceRecorder, or a list that gets the trace's dicts; by
+          default the trace is kept in a new list
+    """
     CrossVerifier.__init__(self, layer)
-    self.trace = []
-    self.index = TracedRangeIndex(self.trace)
-    self.result_set = TracedResultSet(self.trace)
+    self.trace = [] if trace is None else trace
+    self.recorder = _trace_recorder(self.trace)
+    self.index = TracedRangeIndex(self.recorder)
+    self.result_set = TracedResultSet(self.recorder)
     
   def trace_sweep_line(self, x):
-    self.trace.append({'type': 'sweep', 'x': x})
+    self.recorder.record_sweep(x)
     
   def trace_as_json(self):
-    """List that obeys the JSON format restrictions with the verifier trace."""
-    return self.trace
+    """List that obeys the JSON format restrictions with the verifier trace.
+    
+    Only works if the trace is kept in memory, by a list or a
+    ListTraceRecorder."""
+    return self.recorder.as_json()
+
+class FenwickTree(object):
+  """Prefix sums over a fixed number of integer counters.
+  
+  Both updating a counter and summing a prefix take O(log n) time."""
+  
+  def __init__(self, size):
+    """Creates a tree with size counters, all 0."""
+    self.size = size
+    # tree[i] holds the sum of the counters in (i - (i & -i), i], 1-based.
+    self.tree = [0] * (size + 1)
+  
+  def add(self, i, delta):
+    """Adds delta to counter i (0-based)."""
+    tree = self.tree
+    i += 1
+    while i <= self.size:
+      tree[i] += delta
+      i += i & -i
+  
+  def prefix(self, i):
+    """The sum of the counters before counter i."""
+    tree = self.tree
+    total = 0
+    while i > 0:
+      total += tree[i]
+      i -= i & -i
+    return total
+  
+  def find(self, rank):
+    """The smallest i such that prefix(i + 1) >= rank, for rank >= 1."""
+    tree = self.tree
+    i = 0
+    step = 1
+    while step * 2 <= self.size:
+      step *= 2
+    while step > 0:
+      if i + step <= self.size and tree[i + step] < rank:
+        i += step
+        rank -= tree[i]
+      step //= 2
+    return i
+
+class ArrayCrossVerifier(object):
+  """Checks whether a wire network has any crossing wires, in bulk.
+  
+  This finds the same crossings as CrossVerifier, but works on columns of
+  wire coordinates instead of Wire objects. The sweep line events are sorted
+  all at once (with NumPy, if it is installed), and the horizontal wires that
+  cross the sweep line are counted by a Fenwick tree indexed by their
+  compressed Y coordinates, instead of being kept in a RangeIndex."""
+  
+  def __init__(self, layer=None):
+    """Verifier for a layer of wires.
+    
+    The layer can be a WireLayer or a ColumnarWireLayer, whose columns are
+    used without being copied. Use from_columns to build a verifier out of
+    other coordinate columns."""
+    self.result_set = ResultSet()
+    self.performed = False
+    if layer is None:
+      self._set_columns([], [], [], [], [])
+    else:
+      # Both layer classes hand out normalized, validated columns.
+      self._set_columns(*layer.columns(), normalized=True)
+  
+  @classmethod
+  def from_columns(cls, names, x1, y1, x2, y2):
+    """Verifier for wires given as columns of coordinates.
+    
+    Args:
+      names: the wires' names
+      x1, y1, x2, y2: sequences (lists, arrays or NumPy arrays) holding the
+          coordinates of the wires' endpoints; wire i goes from (x1[i], y1[i])
+          to (x2[i], y2[i])
+    """
+    verifier = cls()
+    verifier._set_columns(names, x1, y1, x2, y2)
+    return verifier
+  
+  def _set_columns(self, names, x1, y1, x2, y2, normalized=False):
+    # Stores the normalized coordinates and builds the sorted sweep line
+    # events.
+    count = len(names)
+    if normalized:
+      self.names = names
+      self.x1, self.y1, self.x2, self.y2 = x1, y1, x2, y2
+      self._sort_events()
+      return
+    self.names = list(names)
+    self.x1 = array.array('d', [min(x1[i], x2[i]) for i in xrange(count)])
+    self.x2 = array.array('d', [max(x1[i], x2[i]) for i in xrange(count)])
+    self.y1 = array.array('d', [min(y1[i], y2[i]) for i in xrange(count)])
+    self.y2 = array.array('d', [max(y1[i], y2[i]) for i in xrange(count)])
+    for i in xrange(count):
+      if self.x1[i] != self.x2[i] and self.y1[i] != self.y2[i]:
+        raise ValueError('Wire ' + str(self.names[i]) +
+                         ' is neither horizontal nor vertical')
+    self._sort_events()
+  
+  def _sort_events(self):
+    # Builds the sweep line events, sorted like those of CrossVerifier. Each
+    # event is encoded as 3 * wire + type, with type 0 for adding a horizontal
+    # wire, 1 for a query by a vertical wire and 2 for deleting a horizontal
+    # wire.
+    count = len(self.names)
+    horizontal = [self.y1[i] == self.y2[i] for i in xrange(count)]
+    event_x = array.array('d')
+    codes = array.array('q')
+    for i in xrange(count):
+      if horizontal[i]:
+        event_x.append(self.x1[i])
+        codes.append(3 * i)
+        event_x.append(self.x2[i])
+        codes.append(3 * i + 2)
+      else:
+        event_x.append(self.x1[i])
+        codes.append(3 * i + 1)
+    
+    # Events are ordered by X, then by type, then by wire.
+    if numpy is not None:
+      codes_column = numpy.frombuffer(codes, dtype=numpy.int64)
+      order = numpy.lexsort((codes_column // 3, codes_column % 3,
+                             numpy.frombuffer(event_x, dtype=numpy.float64)))
+      self.events = codes_column[order].tolist()
+    else:
+      order = sorted(xrange(len(codes)),
+                     key=lambda i: (event_x[i], codes[i] % 3, codes[i] // 3))
+      self.events = [codes[i] for i in order]
+    
+    # The horizontal wires' Y coordinates, compressed to ranks.
+    self.y_values = sorted(set([self.y1[i] for i in xrange(count)
+                                if horizontal[i]]))
+    ranks = dict([(self.y_values[i], i) for i in xrange(len(self.y_values))])
+    self.y_rank = [ranks[self.y1[i]] if horizontal[i] else -1
+                   for i in xrange(count)]
+  
+  def count_crossings(self):
+    """Returns the number of pairs of wires that cross each other."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return self._compute_crossings(True)
+  
+  def wire_crossings(self):
+    """A ResultSet with the pairs of wires that cross each other."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return self._compute_crossings(False)
+  
+  def iter_crossings(self):
+    """A generator over the (name, name) pairs of wires that cross.
+    
+    The pairs are produced as the sweep line finds them."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return self._iter_crossings()
+  
+  def stream_crossings_to_file(self, file):
+    """Writes the pairs of wires that cross each other to a file, as they
+    are found.
+    
+    Returns a StreamingResultSet that knows the number of crossings."""
+    result = StreamingResultSet(file)
+    for name1, name2 in self.iter_crossings():
+      result.add_named_crossing(name1, name2)
+    return result
+  
+  def _compute_crossings(self, count_only):
+    """Implements count_crossings and wire_crossings."""
+    if not count_only:
+      result = self.result_set
+      for name1, name2 in self._iter_crossings():
+        result.add_named_crossing(name1, name2)
+      return result
+    
+    y_values = self.y_values
+    y_rank = self.y_rank
+    y1, y2 = self.y1, self.y2
+    tree = FenwickTree(len(y_values))
+    result = 0
+    for code in self.events:
+      wire = code // 3
+      event_type = code - 3 * wire
+      if event_type == 0:
+        tree.add(y_rank[wire], 1)
+      elif event_type == 2:
+        tree.add(y_rank[wire], -1)
+      else:
+        result += (tree.prefix(bisect.bisect_right(y_values, y2[wire])) -
+                   tree.prefix(bisect.bisect_left(y_values, y1[wire])))
+    return result
+  
+  def _iter_crossings(self):
+    """Implements iter_crossings, sweeping as the pairs are consumed."""
+    y_values = self.y_values
+    y_rank = self.y_rank
+    y1, y2 = self.y1, self.y2
+    names = self.names
+    tree = FenwickTree(len(y_values))
+    # Maps a Y rank to the horizontal wires at that Y that cross the sweep
+    # line.
+    buckets = {}
+    for code in self.events:
+      wire = code // 3
+      event_type = code - 3 * wire
+      if event_type == 0:
+        rank = y_rank[wire]
+        tree.add(rank, 1)
+        buckets.setdefault(rank, set()).add(wire)
+      elif event_type == 2:
+        rank = y_rank[wire]
+        tree.add(rank, -1)
+        buckets[rank].discard(wire)
+      else:
+        low = tree.prefix(bisect.bisect_left(y_values, y1[wire]))
+        high = tree.prefix(bisect.bisect_right(y_values, y2[wire]))
+        # Jump from one non-empty bucket to the next with the tree.
+        while low < high:
+          bucket = buckets[tree.find(low + 1)]
+          for other in sorted(bucket):
+            yield names[wire], names[other]
+          low += len(bucket)
+
+class ParallelCrossVerifier(object):
+  """Checks whether a wire network has any crossing wires, using many CPUs.
+  
+  The layer is cut into vertical strips that hold similar numbers of vertical
+  wires. Each vertical wire belongs to the one strip that contains its X
+  coordinate, and each horizontal wire is split into pieces, one for every
+  strip that it spans. Every crossing is then found in exactly one strip, so
+  the strips are swept independently (by ArrayCrossVerifier, in a pool of
+  worker processes) and their results are simply added up."""
+  
+  def __init__(self, layer, processes=None):
+    """Verifier for a layer of wires.
+    
+    Args:
+      layer: the WireLayer to check
+      processes: the number of worker processes; defaults to the number of
+          CPUs
+    """
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+    self.processes = processes
+    self.layer = layer
+    self.result_set = ResultSet()
+    self.performed = False
+  
+  def count_crossings(self):
+    """Returns the number of pairs of wires that cross each other."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return sum(self._map_strips(True))
+  
+  def wire_crossings(self):
+    """A ResultSet with the pairs of wires that cross each other."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    for crossings in self._map_strips(False):
+      self.result_set.crossings.extend(crossings)
+    return self.result_set
+  
+  def iter_crossings(self):
+    """A generator over the (name, name) pairs of wires that cross.
+    
+    Each strip's crossings are produced as soon as its worker is done, so
+    only a few strips' crossings are held in memory at a time."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return (tuple(crossing) for crossings in self._map_strips(False)
+            for crossing in crossings)
+  
+  def stream_crossings_to_file(self, file):
+    """Writes the pairs of wires that cross each other to a file, strip by
+    strip.
+    
+    Returns a StreamingResultSet that knows the number of crossings."""
+    result = StreamingResultSet(file)
+    for name1, name2 in self.iter_crossings():
+      result.add_named_crossing(name1, name2)
+    return result
+  
+  def _map_strips(self, count_only):
+    """Generator that sweeps every strip, in the worker processes if there
+    are several, and yields the strips' results in order."""
+    strips = [(count_only,) + strip for strip in
+              self.strips(self.processes * 4)]
+    if self.processes <= 1 or len(strips) <= 1:
+      for strip in strips:
+        yield _verify_strip(strip)
+      return
+    pool = multiprocessing.Pool(self.processes)
+    try:
+      for result in pool.imap(_verify_strip, strips, 1):
+        yield result
+    finally:
+      pool.close()
+      pool.join()
+  
+  def strips(self, count):
+    """Cuts the layer into at most count strips.
+    
+    Strip i covers the X coordinates in [boundaries[i - 1], boundaries[i]),
+    where the boundaries are X coordinates of vertical wires taken at evenly
+    spaced ranks, and the first and last strips are unbounded.
+    
+    Returns:
+      A list of (names, x1, y1, x2, y2) column tuples, one per strip, in the
+      format taken by ArrayCrossVerifier.from_columns.
+    """
+    names, x1, y1, x2, y2 = self.layer.columns()
+    xs = sorted([x1[i] for i in xrange(len(names)) if y1[i] != y2[i]])
+    boundaries = sorted(set([xs[i * len(xs) // count]
+                             for i in xrange(1, count) if xs]))
+    strips = [([], array.array('d'), array.array('d'), array.array('d'),
+               array.array('d')) for i in xrange(len(boundaries) + 1)]
+    for wire in xrange(len(names)):
+      if y1[wire] == y2[wire]:
+        first = bisect.bisect_right(boundaries, x1[wire])
+        last = bisect.bisect_right(boundaries, x2[wire])
+      else:
+        first = last = bisect.bisect_right(boundaries, x1[wire])
+      for i in xrange(first, last + 1):
+        strip = strips[i]
+        strip[0].append(names[wire])
+        # Clip the pieces of horizontal wires to their strips.
+        strip[1].append(x1[wire] if i == first else boundaries[i - 1])
+        strip[2].append(y1[wire])
+        strip[3].append(x2[wire] if i == last else boundaries[i])
+        strip[4].append(y2[wire])
+    return [strip for strip in strips if strip[0]]
+
+def _verify_strip(strip):
+  """Sweeps a strip made by ParallelCrossVerifier.strips.
+  
+  This runs in the worker processes of ParallelCrossVerifier.
+  
+  Returns:
+    The number of crossings in the strip, or the list of crossing name pairs.
+  """
+  count_only, names, x1, y1, x2, y2 = strip
+  verifier = ArrayCrossVerifier.from_columns(names, x1, y1, x2, y2)
+  if count_only:
+    return verifier.count_crossings()
+  return verifier.wire_crossings().crossings
+
+class StaticSpanIndex(object):
+  """A segment tree over the spans of a fixed set of parallel wires.
+  
+  Each wire is a span [low, high] on one axis at a fixed position on the
+  other axis (for a vertical wire, the span is [y1, y2] and the position is
+  X). The tree's leaves are the distinct span endpoints and the gaps between
+  them, and every span is stored in the O(log n) nodes that exactly cover
+  it, each of which keeps its wires sorted by position. A stabbing query
+  walks from a leaf to the root and bisects the position range in each node,
+  so it finds each matching wire exactly once, in O(log^2 n + k) time.
+  
+  Wires can be removed, but not added; SpanIndex adds wires by building new
+  trees."""
+  
+  def __init__(self, wires):
+    """Builds the tree.
+    
+    Args:
+      wires: a list of (position, low, high, name) tuples
+    """
+    # Maps a wire's name to its (position, low, high) tuple.
+    self.wires = {}
+    self.breakpoints = sorted(set([wire[1] for wire in wires] +
+                                  [wire[2] for wire in wires]))
+    # Leaf 2 * i is breakpoint i, and leaf 2 * i + 1 is the gap after it.
+    self.leaf_base = 1
+    while self.leaf_base < 2 * len(self.breakpoints):
+      self.leaf_base *= 2
+    # Maps a node to a ([position], [name]) pair of parallel sorted lists.
+    self.nodes = {}
+    for position, low, high, name in sorted(wires):
+      self.wires[name] = (position, low, high)
+      for node in self._cover(low, high):
+        positions, names = self.nodes.setdefault(node, ([], []))
+        positions.append(position)
+        names.append(name)
+  
+  def __len__(self):
+    return len(self.wires)
+  
+  def _cover(self, low, high):
+    # The nodes that exactly cover the leaves from low's to high's.
+    first = self.leaf_base + 2 * bisect.bisect_left(self.breakpoints, low)
+    last = self.leaf_base + 2 * bisect.bisect_left(self.breakpoints, high) + 1
+    nodes = []
+    while first < last:
+      if first & 1:
+        nodes.append(first)
+        first += 1
+      if last & 1:
+        last -= 1
+        nodes.append(last)
+      first >>= 1
+      last >>= 1
+    return nodes
+  
+  def remove(self, name):
+    """Removes a wire from the tree."""
+    position, low, high = self.wires.pop(name)
+    for node in self._cover(low, high):
+      positions, names = self.nodes[node]
+      i = bisect.bisect_left(positions, position)
+      while names[i] != name:
+        i += 1
+      del positions[i]
+      del names[i]
+  
+  def stab(self, point, first, last):
+    """The names of the wires whose span contains point, and whose position
+    is in [first, last]."""
+    i = bisect.bisect_left(self.breakpoints, point)
+    if i == len(self.breakpoints):
+      return []
+    if self.breakpoints[i] == point:
+      node = self.leaf_base + 2 * i
+    elif i > 0:
+      node = self.leaf_base + 2 * i - 1
+    else:
+      return []
+    result = []
+    while node >= 1:
+      if node in self.nodes:
+        positions, names = self.nodes[node]
+        result.extend(names[bisect.bisect_left(positions, first):
+                            bisect.bisect_right(positions, last)])
+      node >>= 1
+    return result
+
+class SpanIndex(object):
+  """A StaticSpanIndex that wires can also be added to.
+  
+  The wires are spread over static trees that hold at most 1, 2, 4, ...
+  wires. A new wire is put in a tree with the wires of all the smaller
+  trees, like a carry in binary addition, so each wire is rebuilt into
+  O(log n) trees over its lifetime, and a query looks at O(log n) trees."""
+  
+  def __init__(self, wires=()):
+    """Builds the index.
+    
+    Args:
+      wires: a list of (position, low, high, name) tuples
+    """
+    # levels[i] is None or a StaticSpanIndex with at most 2 ** i wires.
+    self.levels = []
+    # Maps a wire's name to the StaticSpanIndex that holds it.
+    self.trees = {}
+    wires = list(wires)
+    if wires:
+      level = 0
+      while (1 << level) < len(wires):
+        level += 1
+      self.levels = [None] * level + [None]
+      self._build(level, wires)
+  
+  def __len__(self):
+    return len(self.trees)
+  
+  def _build(self, level, wires):
+    tree = StaticSpanIndex(wires)
+    self.levels[level] = tree
+    for wire in wires:
+      self.trees[wire[3]] = tree
+  
+  def add(self, position, low, high, name):
+    """Adds a wire to the index."""
+    wires = [(position, low, high, name)]
+    level = 0
+    while True:
+      if level == len(self.levels):
+        self.levels.append(None)
+      tree = self.levels[level]
+      # The carry never holds more than 2 ** level wires here.
+      if tree is None:
+        break
+      wires.extend([(wire[0], wire[1], wire[2], wire_name)
+                    for wire_name, wire in tree.wires.items()])
+      self.levels[level] = None
+      level += 1
+    self._build(level, wires)
+  
+  def remove(self, name):
+    """Removes a wire from the index."""
+    self.trees.pop(name).remove(name)
+  
+  def stab(self, point, first, last):
+    """The names of the wires whose span contains point, and whose position
+    is in [first, last]."""
+    result = []
+    for tree in self.levels:
+      if tree is not None and len(tree) > 0:
+        result.extend(tree.stab(point, first, last))
+    return result
+
+class IncrementalCrossVerifier(object):
+  """Keeps the crossings of a layer up to date while wires are edited.
+  
+  Unlike the other verifiers, which sweep the whole layer once, this verifier
+  can be used over and over. The horizontal and the vertical wires are kept
+  in two SpanIndex segment trees, so adding or moving a wire only looks at
+  the wires that it crosses, plus a polylogarithmic overhead. The crossings
+  of every wire are kept in an adjacency dict, so removing a wire only looks
+  at the wires that it crossed."""
+  
+  def __init__(self, layer=None):
+    """Verifier for a layer of wires.
+    
+    Args:
+      layer: optional WireLayer or ColumnarWireLayer with the initial wires;
+          their crossings are found with one ArrayCrossVerifier sweep
+    """
+    # Maps a wire's name to its normalized (x1, y1, x2, y2) coordinates.
+    self.wires = {}
+    # Maps a wire's name to the set of names of the wires that it crosses.
+    self.crossings = {}
+    self.crossing_count = 0
+    # Horizontal wires are X spans at a Y position, and vertical wires are Y
+    # spans at an X position.
+    self.horizontals = SpanIndex()
+    self.verticals = SpanIndex()
+    if layer is None:
+      return
+    
+    names, x1, y1, x2, y2 = layer.columns()
+    horizontals, verticals = [], []
+    for i in xrange(len(names)):
+      self.wires[names[i]] = (x1[i], y1[i], x2[i], y2[i])
+      self.crossings[names[i]] = set()
+      if y1[i] == y2[i]:
+        horizontals.append((y1[i], x1[i], x2[i], names[i]))
+      else:
+        verticals.append((x1[i], y1[i], y2[i], names[i]))
+    # Building each index at once is much faster than adding the wires one
+    # by one.
+    self.horizontals = SpanIndex(horizontals)
+    self.verticals = SpanIndex(verticals)
+    for name1, name2 in ArrayCrossVerifier(layer).iter_crossings():
+      self._link(name1, name2)
+  
+  def __len__(self):
+    return len(self.wires)
+  
+  def add_wire(self, name, x1, y1, x2, y2):
+    """Adds a wire to the layer and finds its crossings.
+    
+    Raises a ValueError if the name is taken, or if the wire is neither
+    horizontal nor vertical.
+    
+    Returns the number of wires that the new wire crosses."""
+    if name in self.wires:
+      raise ValueError('Wire name ' + name + ' not unique')
+    if x1 > x2:
+      x1, x2 = x2, x1
+    if y1 > y2:
+      y1, y2 = y2, y1
+    if x1 != x2 and y1 != y2:
+      raise ValueError('Wire ' + name + ' is neither horizontal nor vertical')
+    
+    self.wires[name] = (x1, y1, x2, y2)
+    self.crossings[name] = set()
+    if y1 == y2:
+      # Vertical wires at x1 <= X <= x2 whose span contains y1.
+      for other in self.verticals.stab(y1, x1, x2):
+        self._link(other, name)
+      self.horizontals.add(y1, x1, x2, name)
+    else:
+      # Horizontal wires at y1 <= Y <= y2 whose span contains x1.
+      for other in self.horizontals.stab(x1, y1, y2):
+        self._link(name, other)
+      self.verticals.add(x1, y1, y2, name)
+    return len(self.crossings[name])
+  
+  def remove_wire(self, name):
+    """Removes a wire from the layer, along with its crossings.
+    
+    Raises a KeyError if there is no wire with the given name."""
+    x1, y1, x2, y2 = self.wires.pop(name)
+    if y1 == y2:
+      self.horizontals.remove(name)
+    else:
+      self.verticals.remove(name)
+    
+    others = self.crossings.pop(name)
+    for other in others:
+      self.crossings[other].discard(name)
+    self.crossing_count -= len(others)
+  
+  def move_wire(self, name, x1, y1, x2, y2):
+    """Gives a wire new coordinates, and updates the crossings.
+    
+    Returns the number of wires that the moved wire crosses."""
+    old = self.wires[name]
+    self.remove_wire(name)
+    try:
+      return self.add_wire(name, x1, y1, x2, y2)
+    except ValueError:
+      self.add_wire(name, *old)
+      raise
+  
+  def count_crossings(self):
+    """Returns the number of pairs of wires that cross each other."""
+    return self.crossing_count
+  
+  def wire_crossings(self):
+    """A new ResultSet with the pairs of wires that cross each other."""
+    result = ResultSet()
+    for name, others in self.crossings.items():
+      for other in others:
+        if name < other:
+          result.add_named_crossing(name, other)
+    return result
+  
+  def crossings_of(self, name):
+    """The sorted names of the wires that cross a wire."""
+    return sorted(self.crossings[name])
+  
+  def _link(self, name1, name2):
+    # Records a crossing between two wires.
+    self.crossings[name1].add(name2)
+    self.crossings[name2].add(name1)
+    self.crossing_count += 1
+
+class WireRTree(object):
+  """A static spatial index over the wires of a layer.
+  
+  The index is a packed R-tree, built bottom-up with Sort-Tile-Recursive
+  packing: the wires are sorted by X, cut into vertical slices, each slice is
+  sorted by Y and cut into full nodes. The upper levels group runs of
+  consecutive nodes, which are neighbours in this order, until one root is
+  left. Each level is stored as four arrays with the
+  bounding boxes of its entries, and the children of entry i are the entries
+  [i * node_size, (i + 1) * node_size) of the level below, so the tree has no
+  node objects. Wires are axis-aligned segments, so their bounding boxes are
+  the wires themselves, and the queries are exact."""
+  
+  def __init__(self, layer, node_size=16):
+    """Indexes a layer of wires.
+    
+    Args:
+      layer: the WireLayer or ColumnarWireLayer to index; later changes to
+          the layer are not seen by the index
+      node_size: the number of children of each node
+    """
+    self.node_size = node_size
+    names, x1, y1, x2, y2 = layer.columns()
+    # STR orders the leaves; self.names[i] is the wire with leaf box i.
+    order = self._pack(list(xrange(len(names))), x1, y1, x2, y2)
+    self.names = [names[i] for i in order]
+    level = tuple([array.array('d', [column[i] for i in order])
+                   for column in (x1, y1, x2, y2)])
+    # self.levels[0] holds the wires' boxes, and self.levels[-1] the root's.
+    self.levels = [level]
+    while len(level[0]) > 1:
+      level = self._parent_level(level)
+      self.levels.append(level)
+  
+  def __len__(self):
+    return len(self.names)
+  
+  def _pack(self, items, x1, y1, x2, y2):
+    # Returns the items in Sort-Tile-Recursive order.
+    size = self.node_size
+    node_count = max(1, -(-len(items) // size))
+    slice_count = max(1, int(math.ceil(math.sqrt(node_count))))
+    slice_length = -(-node_count // slice_count) * size
+    items.sort(key=lambda i: x1[i] + x2[i])
+    result = []
+    for start in xrange(0, len(items), slice_length):
+      result.extend(sorted(items[start:start + slice_length],
+                           key=lambda i: y1[i] + y2[i]))
+    return result
+  
+  def _parent_level(self, level):
+    # Packs a level's boxes into nodes, and returns the nodes' level.
+    x1, y1, x2, y2 = level
+    count, size = len(x1), self.node_size
+    parent = tuple([array.array('d') for i in xrange(4)])
+    for start in xrange(0, count, size):
+      end = min(start + size, count)
+      parent[0].append(min(x1[start:end]))
+      parent[1].append(min(y1[start:end]))
+      parent[2].append(max(x2[start:end]))
+      parent[3].append(max(y2[start:end]))
+    return parent
+  
+  def window(self, x1, y1, x2, y2):
+    """The names of the wires that touch a rectangle, including its edges.
+    
+    The cost is proportional to the height of the tree plus the number of
+    nodes whose boxes touch the rectangle."""
+    return list(self.iter_window(x1, y1, x2, y2))
+  
+  def iter_window(self, x1, y1, x2, y2):
+    """A generator over the names of the wires that touch a rectangle."""
+    if x1 > x2:
+      x1, x2 = x2, x1
+    if y1 > y2:
+      y1, y2 = y2, y1
+    if len(self.names) == 0:
+      return
+    size = self.node_size
+    levels = self.levels
+    # Stack of (level, first entry, last entry + 1) ranges to check.
+    stack = [(len(levels) - 1, 0, 1)]
+    while stack:
+      depth, start, end = stack.pop()
+      bx1, by1, bx2, by2 = levels[depth]
+      for i in xrange(start, end):
+        if bx1[i] <= x2 and x1 <= bx2[i] and by1[i] <= y2 and y1 <= by2[i]:
+          if depth == 0:
+            yield self.names[i]
+          else:
+            stack.append((depth - 1, i * size,
+                          min((i + 1) * size, len(levels[depth - 1][0]))))
+  
+  def point(self, x, y):
+    """The names of the wires that go through a point."""
+    return self.window(x, y, x, y)
+  
+  def nearest(self, x, y, count=1):
+    """The wires closest to a point.
+    
+    The tree is searched best-first, with a heap of nodes and wires ordered
+    by their distance to the point, so only the nodes closer than the
+    count-th closest wire are opened.
+    
+    Returns:
+      A list of up to count (distance, name) pairs, closest first.
+    """
+    result = []
+    if len(self.names) == 0:
+      return result
+    size = self.node_size
+    levels = self.levels
+    # Heap of (distance, level, entry) tuples.
+    heap = [(self._distance(levels[-1], 0, x, y), len(levels) - 1, 0)]
+    while heap and len(result) < count:
+      distance, depth, i = heapq.heappop(heap)
+      if depth == 0:
+        # The box is the wire, and no box left in the heap is closer than it.
+        result.append((distance, self.names[i]))
+        continue
+      child_level = levels[depth - 1]
+      for child in xrange(i * size, min((i + 1) * size, len(child_level[0]))):
+        heapq.heappush(heap, (self._distance(child_level, child, x, y),
+                              depth - 1, child))
+    return result
+  
+  @staticmethod
+  def _distance(level, i, x, y):
+    # The distance from a point to the i-th box of a level.
+    x1, y1, x2, y2 = level
+    dx = max(x1[i] - x, 0, x - x2[i])
+    dy = max(y1[i] - y, 0, y - y2[i])
+    return math.sqrt(dx * dx + dy * dy)
+
+class BatchCrossVerifier(object):
+  """Checks the layers of a chip for crossing wires, in one pass.
+  
+  The layers are handed out to a pool of worker processes, and each worker
+  parses and sweeps the layers it gets with ColumnarWireLayer and
+  ArrayCrossVerifier, so the cost of starting Python and importing this module
+  is paid once per worker instead of once per layer.
+  
+  Layers can be given as text, in the format read by WireLayer.from_file, or
+  as WireLayer / ColumnarWireLayer instances. The layers are independent;
+  crossings between wires on different layers are not checked."""
+  
+  def __init__(self, layers, processes=None):
+    """Verifier for many layers of wires.
+    
+    Args:
+      layers: a list of (name, layer) pairs, where each layer is a textual
+          description or a layer object; the names must be unique
+      processes: the number of worker processes; defaults to the number of
+          CPUs
+    """
+    if processes is None:
+      processes = multiprocessing.cpu_count()
+    self.processes = processes
+    self.layers = []
+    names = set()
+    for name, layer in layers:
+      if name in names:
+        raise ValueError('Layer name ' + name + ' not unique')
+      names.add(name)
+      if hasattr(layer, 'columns'):
+        # Arrays can be sent to the workers; memoryviews can't.
+        columns = layer.columns()
+        layer = tuple([list(columns[0])] +
+                      [array.array('d', column) for column in columns[1:]])
+      self.layers.append((name, layer))
+    self.performed = False
+  
+  @staticmethod
+  def from_path(path, processes=None):
+    """Builds a batch verifier for the layers in a file or a directory.
+    
+    A file holds one layer, or many layers, each started by a 'layer NAME'
+    line and ended by a 'done' line. A single-layer file's layer is named
+    after the file, without its extension. In a directory, every file is read
+    in this way, in name order.
+    
+    Args:
+      path: the path of the file or directory
+      processes: the number of worker processes
+    
+    Returns a new BatchCrossVerifier instance."""
+    if os.path.isdir(path):
+      paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+      paths = [file_path for file_path in paths if os.path.isfile(file_path)]
+    else:
+      paths = [path]
+    layers = []
+    for file_path in paths:
+      with open(file_path) as file:
+        text = file.read()
+      default_name = os.path.splitext(os.path.basename(file_path))[0]
+      layers.extend(BatchCrossVerifier.split_layers(text, default_name))
+    return BatchCrossVerifier(layers, processes)
+  
+  @staticmethod
+  def split_layers(text, default_name='layer'):
+    """Splits a multi-layer description into (name, text) pairs.
+    
+    Text without 'layer NAME' lines is a single layer called default_name.
+    """
+    starts = list(_LAYER_COMMAND.finditer(text))
+    if not starts:
+      return [(default_name, text)]
+    layers = []
+    for i, start in enumerate(starts):
+      end = starts[i + 1].start() if i + 1 < len(starts) else len(text)
+      layers.append((start.group(1), text[start.end():end]))
+    return layers
+  
+  def count_crossings(self):
+    """A dict mapping each layer's name to its number of crossing pairs."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return dict(self._map_layers(True))
+  
+  def wire_crossings(self):
+    """A dict mapping each layer's name to a ResultSet with its crossings."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    results = {}
+    for name, crossings in self._map_layers(False):
+      results[name] = ResultSet()
+      results[name].crossings = crossings
+    return results
+  
+  def iter_results(self, count_only=False):
+    """A generator over (layer name, result) pairs, in the layers' order.
+    
+    Each result is a count of crossings if count_only is True, and a list of
+    crossing name pairs otherwise. Layers are produced as soon as they and
+    the layers before them are verified."""
+    if self.performed:
+      raise RuntimeError('The verifier was already used')
+    self.performed = True
+    return self._map_layers(count_only)
+  
+  def _map_layers(self, count_only):
+    """Generator that verifies every layer, in the worker processes if there
+    are several, and yields (name, result) pairs in order."""
+    tasks = [(count_only, name, layer) for name, layer in self.layers]
+    if self.processes <= 1 or len(tasks) <= 1:
+      for task in tasks:
+        yield _verify_layer(task)
+      return
+    pool = multiprocessing.Pool(min(self.processes, len(tasks)))
+    try:
+      for result in pool.imap(_verify_layer, tasks, 1):
+        yield result
+    finally:
+      pool.close()
+      pool.join()
+
+def _verify_layer(task):
+  """Parses and sweeps one layer given to BatchCrossVerifier.
+  
+  This runs in the worker processes of BatchCrossVerifier.
+  
+  Returns:
+    A (name, result) pair, where the result is the number of crossings or the
+    list of crossing name pairs.
+  """
+  count_only, name, layer = task
+  if isinstance(layer, str):
+    layer = ColumnarWireLayer.from_text(layer).columns()
+  verifier = ArrayCrossVerifier.from_columns(*layer)
+  if count_only:
+    return name, verifier.count_crossings()
+  return name, verifier.wire_crossings().crossings
 
 # Command-line controller.
 if __name__ == '__main__':
     import sys
-    layer = WireLayer.from_file(sys.stdin)
-    verifier = CrossVerifier(layer)
+    if len(sys.argv) > 1:
+      # Batch mode: every argument is a layer file or a directory of them.
+      layers = []
+      for path in sys.argv[1:]:
+        layers.extend(BatchCrossVerifier.from_path(path).layers)
+      verifier = BatchCrossVerifier(layers)
+      if os.environ.get('TRACE') == 'list':
+        for name, crossings in verifier.iter_results():
+          sys.stdout.write('layer ' + name + '\n')
+          for crossing in crossings:
+            sys.stdout.write(' '.join(crossing) + '\n')
+      else:
+        for name, count in verifier.iter_results(True):
+          sys.stdout.write(name + ' ' + str(count) + '\n')
+      sys.exit(0)
+    if os.environ.get('ENGINE') in ('array', 'parallel'):
+      # These engines read the columns directly, and can use a binary cache.
+      layer = ColumnarWireLayer.from_file(
+          sys.stdin, cache_path=os.environ.get('LAYER_CACHE'))
+    else:
+      layer = WireLayer.from_file(sys.stdin)
+    if os.environ.get('ENGINE') == 'btree':
+      verifier = CrossVerifier(layer, BTreeRangeIndex)
+    elif os.environ.get('ENGINE') == 'array':
+      verifier = ArrayCrossVerifier(layer)
+    elif os.environ.get('ENGINE') == 'parallel':
+      verifier = ParallelCrossVerifier(layer)
+    else:
+      verifier = CrossVerifier(layer)
+    
+    # Sampling and limits for the traces of big layers.
+    limits = {}
+    for option in ('sample', 'limit', 'max_ids'):
+      if os.environ.get('TRACE_' + option.upper()):
+        limits[option] = int(os.environ['TRACE_' + option.upper()])
     
     if os.environ.get('TRACE') == 'jsonp':
-      verifier = TracedCrossVerifier(layer)
-      result = verifier.wire_crossings()
-      json_obj = {'layer': layer.as_json(), 'trace': verifier.trace_as_json()}
-      sys.stdout.write('onJsonp(')
-      json.dump(json_obj, sys.stdout)
-      sys.stdout.write(');\n')
+      # The trace is streamed in the middle of the JSON object.
+      sys.stdout.write('onJsonp({"layer": ')
+      json.dump(layer.as_json(), sys.stdout)
+      sys.stdout.write(', "trace": ')
+      recorder = JsonTraceRecorder(sys.stdout, **limits)
+      TracedCrossVerifier(layer, recorder).wire_crossings()
+      recorder.close()
+      sys.stdout.write('});\n')
+    elif os.environ.get('TRACE') == 'binary':
+      recorder = BinaryTraceRecorder(sys.stdout.buffer, layer.wires.keys(),
+                                     **limits)
+      TracedCrossVerifier(layer, recorder).wire_crossings()
+      recorder.close()
     elif os.environ.get('TRACE') == 'list':
-      verifier.wire_crossings().write_to_file(sys.stdout)
+      verifier.stream_crossings_to_file(sys.stdout)
     else:
       sys.stdout.write(str(verifier.count_crossings()) + "\n")
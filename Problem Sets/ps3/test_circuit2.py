@@ -0,0 +1,549 @@
+import bisect
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import circuit2
+from circuit2 import *
+
+def random_layer_text(seed, wire_count=300, grid=40):
+  """Textual description of a layer with random wires on a small grid.
+
+  The grid is small, so many wires share coordinates and endpoints."""
+  rng = random.Random(seed)
+  lines = []
+  for i in xrange(wire_count):
+    other = rng.randint(0, grid)
+    start, end = sorted(rng.sample(xrange(grid + 1), 2))
+    if rng.random() < 0.5:
+      lines.append('wire h%d %d %d %d %d' % (i, start, other, end, other))
+    else:
+      lines.append('wire v%d %d %d %d %d' % (i, other, start, other, end))
+  return '\n'.join(lines) + '\ndone\n'
+
+def layer_from_text(text):
+  return WireLayer.from_file(io.StringIO(text))
+
+def sorted_crossings(verifier):
+  return sorted(verifier.wire_crossings().crossings)
+
+class TestArrayCrossVerifier(unittest.TestCase):
+  def check_random_layers(self):
+    for seed in xrange(20):
+      layer = layer_from_text(random_layer_text(seed))
+      expected = CrossVerifier(layer).count_crossings()
+      self.assertEqual(expected, ArrayCrossVerifier(layer).count_crossings())
+      crossings = sorted_crossings(CrossVerifier(layer))
+      self.assertEqual(expected, len(crossings))
+      self.assertEqual(crossings, sorted_crossings(ArrayCrossVerifier(layer)))
+      self.assertEqual(crossings, sorted(
+          [sorted(pair) for pair in ArrayCrossVerifier(layer).iter_crossings()]))
+
+  def test_without_numpy(self):
+    saved, circuit2.numpy = circuit2.numpy, None
+    try:
+      self.check_random_layers()
+    finally:
+      circuit2.numpy = saved
+
+  @unittest.skipIf(circuit2.numpy is None, 'NumPy is not installed')
+  def test_with_numpy(self):
+    self.check_random_layers()
+
+  @unittest.skipIf(circuit2.numpy is None, 'NumPy is not installed')
+  def test_numpy_event_order(self):
+    layer = layer_from_text(random_layer_text(3, 2000))
+    with_numpy = ArrayCrossVerifier(layer).events
+    saved, circuit2.numpy = circuit2.numpy, None
+    try:
+      self.assertEqual(with_numpy, ArrayCrossVerifier(layer).events)
+    finally:
+      circuit2.numpy = saved
+
+  def test_columnar_layer(self):
+    text = random_layer_text(7)
+    expected = sorted_crossings(CrossVerifier(layer_from_text(text)))
+    layer = ColumnarWireLayer.from_file(io.StringIO(text))
+    self.assertEqual(expected, sorted_crossings(ArrayCrossVerifier(layer)))
+
+  def test_empty_layer(self):
+    self.assertEqual(0, ArrayCrossVerifier(WireLayer()).count_crossings())
+
+class TestParallelCrossVerifier(unittest.TestCase):
+  def test_random_layers(self):
+    # The grid is small, so many vertical wires sit on the strip boundaries
+    # and most horizontal wires are cut into several pieces.
+    for processes in (1, 3):
+      for seed in xrange(6):
+        layer = layer_from_text(random_layer_text(seed))
+        expected = sorted_crossings(CrossVerifier(layer))
+        self.assertEqual(len(expected), ParallelCrossVerifier(
+            layer, processes).count_crossings())
+        crossings = sorted_crossings(ParallelCrossVerifier(layer, processes))
+        self.assertEqual(expected, crossings)
+        self.assertEqual(expected, sorted(
+            [sorted(pair) for pair in
+             ParallelCrossVerifier(layer, processes).iter_crossings()]))
+
+  def test_crossings_on_strip_edges(self):
+    # Every vertical wire is on a boundary, and every crossing is at one.
+    layer = WireLayer()
+    for x in xrange(8):
+      layer.add_wire('v%d' % x, x, 0, x, 10)
+    for y in xrange(5):
+      layer.add_wire('h%d' % y, 0, y, 7, y)
+    layer.add_wire('short', 3, 7, 4, 7)
+    verifier = ParallelCrossVerifier(layer, 2)
+    self.assertGreater(len(verifier.strips(4)), 1)
+    crossings = sorted_crossings(verifier)
+    self.assertEqual(sorted_crossings(CrossVerifier(layer)), crossings)
+    self.assertEqual(8 * 5 + 2, len(crossings))
+
+class TestStreamingCrossings(unittest.TestCase):
+  verifier_classes = (CrossVerifier, ArrayCrossVerifier, ParallelCrossVerifier)
+
+  def check_layer(self, text):
+    for verifier_class in self.verifier_classes:
+      expected_file = io.StringIO()
+      expected = verifier_class(layer_from_text(text)).wire_crossings()
+      expected.write_to_file(expected_file)
+
+      crossings = []
+      for pair in verifier_class(layer_from_text(text)).iter_crossings():
+        names = [wire if isinstance(wire, str) else wire.name
+                 for wire in pair]
+        crossings.append(sorted(names))
+      self.assertEqual(expected.crossings, crossings)
+
+      file = io.StringIO()
+      result = verifier_class(
+          layer_from_text(text)).stream_crossings_to_file(file)
+      self.assertIsInstance(result, StreamingResultSet)
+      self.assertEqual(len(expected.crossings), result.count)
+      self.assertEqual([], result.crossings)
+      self.assertEqual(expected_file.getvalue(), file.getvalue())
+
+  def test_random_layers(self):
+    for seed in xrange(5):
+      self.check_layer(random_layer_text(seed))
+
+  def test_empty_layer(self):
+    self.check_layer('done\n')
+
+  def test_used_verifier(self):
+    verifier = CrossVerifier(layer_from_text(random_layer_text(0)))
+    verifier.stream_crossings_to_file(io.StringIO())
+    self.assertRaises(RuntimeError, verifier.iter_crossings)
+
+  def test_result_set(self):
+    file = io.StringIO()
+    result = StreamingResultSet(file)
+    result.add_named_crossing('b', 'a')
+    result.add_named_crossing('a', 'c')
+    result.write_to_file(file)
+    self.assertEqual(2, result.count)
+    self.assertEqual('a b\na c\n', file.getvalue())
+
+class TestBatchCrossVerifier(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.texts = [('l%d' % seed, random_layer_text(seed, 200))
+                  for seed in xrange(4)]
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def check_results(self, make_verifier, texts):
+    expected = dict([(name, sorted_crossings(CrossVerifier(
+        layer_from_text(text)))) for name, text in texts])
+    self.assertEqual(dict([(name, len(crossings)) for name, crossings
+                           in expected.items()]),
+                     make_verifier().count_crossings())
+    results = make_verifier().wire_crossings()
+    self.assertEqual(expected, dict([(name, sorted(result.crossings))
+                                     for name, result in results.items()]))
+    self.assertEqual([name for name, text in texts],
+                     [name for name, crossings
+                      in make_verifier().iter_results()])
+
+  def test_layers(self):
+    layers = [(name, text) for name, text in self.texts[:2]]
+    layers.append(('l2', layer_from_text(self.texts[2][1])))
+    layers.append(('l3', ColumnarWireLayer.from_text(self.texts[3][1])))
+    for processes in (1, 3):
+      self.check_results(lambda: BatchCrossVerifier(layers, processes),
+                         self.texts)
+
+  def test_duplicate_names(self):
+    self.assertRaises(ValueError, BatchCrossVerifier,
+                      [('a', 'done\n'), ('a', 'done\n')])
+
+  def test_split_layers(self):
+    text = ''.join(['layer %s\n%s' % (name, text) for name, text in self.texts])
+    layers = BatchCrossVerifier.split_layers(text)
+    self.assertEqual([name for name, text in self.texts],
+                     [name for name, text in layers])
+    for expected, layer in zip(self.texts, layers):
+      self.assertEqual(layer_from_text(expected[1]).as_json(),
+                       layer_from_text(layer[1]).as_json())
+    self.assertEqual([('chip', self.texts[0][1])],
+                     BatchCrossVerifier.split_layers(self.texts[0][1], 'chip'))
+
+  def test_from_path(self):
+    # One multi-layer file and one single-layer file, named after the file.
+    with open(os.path.join(self.directory, 'a.in'), 'w') as file:
+      for name, text in self.texts[:3]:
+        file.write('layer %s\n%s' % (name, text))
+    with open(os.path.join(self.directory, 'b.in'), 'w') as file:
+      file.write(self.texts[3][1])
+    texts = self.texts[:3] + [('b', self.texts[3][1])]
+    self.check_results(
+        lambda: BatchCrossVerifier.from_path(self.directory, 2), texts)
+    self.check_results(lambda: BatchCrossVerifier.from_path(
+        os.path.join(self.directory, 'a.in'), 1), texts[:3])
+
+class TestWireRTree(unittest.TestCase):
+  def wire_boxes(self, layer):
+    names, x1, y1, x2, y2 = layer.columns()
+    return [(names[i], min(x1[i], x2[i]), min(y1[i], y2[i]),
+             max(x1[i], x2[i]), max(y1[i], y2[i]))
+            for i in xrange(len(names))]
+
+  def distance(self, box, x, y):
+    dx = max(box[1] - x, 0, x - box[3])
+    dy = max(box[2] - y, 0, y - box[4])
+    return math.sqrt(dx * dx + dy * dy)
+
+  def test_against_brute_force(self):
+    for seed in xrange(4):
+      rng = random.Random(seed)
+      layer = layer_from_text(random_layer_text(seed, rng.randint(1, 400)))
+      boxes = self.wire_boxes(layer)
+      for node_size in (2, 3, 16):
+        tree = WireRTree(layer, node_size)
+        self.assertEqual(len(boxes), len(tree))
+        for query in xrange(50):
+          x1, y1, x2, y2 = [rng.randint(-2, 42) for i in xrange(4)]
+          low_x, high_x = sorted([x1, x2])
+          low_y, high_y = sorted([y1, y2])
+          self.assertEqual(
+              sorted([box[0] for box in boxes
+                      if box[1] <= high_x and low_x <= box[3] and
+                         box[2] <= high_y and low_y <= box[4]]),
+              sorted(tree.window(x1, y1, x2, y2)))
+          self.assertEqual(
+              sorted([box[0] for box in boxes
+                      if box[1] <= x1 <= box[3] and box[2] <= y1 <= box[4]]),
+              sorted(tree.point(x1, y1)))
+
+          x, y = x1 + rng.choice([0, 0.5]), y1 + rng.choice([0, 0.5])
+          count = rng.randint(1, 10)
+          expected = sorted([(self.distance(box, x, y), box[0])
+                             for box in boxes])[:count]
+          nearest = tree.nearest(x, y, count)
+          self.assertEqual([distance for distance, name in expected],
+                           [distance for distance, name in nearest])
+          # Wires at the same distance can be returned in any order.
+          self.assertEqual(len(nearest), len(set(
+              [name for distance, name in nearest])))
+          for distance, name in nearest:
+            self.assertEqual(distance, self.distance(
+                [box for box in boxes if box[0] == name][0], x, y))
+
+  def test_nearest_everything(self):
+    layer = layer_from_text(random_layer_text(5, 50))
+    nearest = WireRTree(layer, 4).nearest(20, 20, 100)
+    self.assertEqual(sorted(layer.wires.keys()),
+                     sorted([name for distance, name in nearest]))
+
+  def test_empty_layer(self):
+    tree = WireRTree(WireLayer())
+    self.assertEqual([], tree.window(0, 0, 10, 10))
+    self.assertEqual([], tree.nearest(0, 0, 3))
+
+class TestTraceRecorders(unittest.TestCase):
+  limits = ({}, {'sample': 3}, {'limit': 50}, {'max_ids': 2},
+            {'sample': 2, 'limit': 40, 'max_ids': 1})
+
+  def list_trace(self, layer, **limits):
+    recorder = ListTraceRecorder(**limits)
+    TracedCrossVerifier(layer, recorder).wire_crossings()
+    return recorder.records
+
+  def test_list_recorder_limits(self):
+    layer = layer_from_text(random_layer_text(1, 100))
+    trace = self.list_trace(layer)
+    verifier = TracedCrossVerifier(layer)
+    verifier.wire_crossings()
+    self.assertEqual(trace, verifier.trace_as_json())
+    self.assertEqual(trace[::3], self.list_trace(layer, sample=3))
+    self.assertEqual(trace[:50], self.list_trace(layer, limit=50))
+    cut = self.list_trace(layer, max_ids=2)
+    self.assertTrue(any(['more' in record for record in cut]))
+    self.assertEqual(len(trace), len(cut))
+    for full, record in zip(trace, cut):
+      if 'ids' in record:
+        self.assertEqual(full['ids'][:2], record['ids'])
+        self.assertEqual(max(0, len(full['ids']) - 2), record.get('more', 0))
+      else:
+        self.assertEqual(full, record)
+
+  def test_json_recorder(self):
+    layer = layer_from_text(random_layer_text(2, 100))
+    for limits in self.limits:
+      file = io.StringIO()
+      recorder = JsonTraceRecorder(file, **limits)
+      TracedCrossVerifier(layer, recorder).wire_crossings()
+      recorder.close()
+      self.assertEqual(self.list_trace(layer, **limits),
+                       json.loads(file.getvalue()))
+      self.assertRaises(ValueError, recorder.as_json)
+
+  def test_json_recorder_empty(self):
+    file = io.StringIO()
+    JsonTraceRecorder(file).close()
+    self.assertEqual([], json.loads(file.getvalue()))
+
+  def test_binary_round_trip(self):
+    layer = layer_from_text(random_layer_text(3, 100))
+    for limits in self.limits:
+      file = io.BytesIO()
+      recorder = BinaryTraceRecorder(file, layer.wires.keys(), **limits)
+      TracedCrossVerifier(layer, recorder).wire_crossings()
+      recorder.close()
+      file.seek(0)
+      self.assertEqual(self.list_trace(layer, **limits),
+                       BinaryTraceRecorder.read(file))
+    self.assertRaises(ValueError, BinaryTraceRecorder.read,
+                      io.BytesIO(b'x' * 64))
+
+  def test_jsonp_output(self):
+    # The streamed TRACE=jsonp output is byte-identical to dumping the whole
+    # trace, which is what circuit2.py used to do.
+    text = random_layer_text(4, 100)
+    layer = layer_from_text(text)
+    verifier = TracedCrossVerifier(layer)
+    verifier.wire_crossings()
+    expected = 'onJsonp(' + json.dumps(
+        {'layer': layer.as_json(), 'trace': verifier.trace_as_json()}) + ');\n'
+    environment = dict(os.environ)
+    environment['TRACE'] = 'jsonp'
+    for option in ('ENGINE', 'TRACE_SAMPLE', 'TRACE_LIMIT', 'TRACE_MAX_IDS'):
+      environment.pop(option, None)
+    process = subprocess.Popen(
+        [sys.executable, circuit2.__file__], stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE, env=environment)
+    output = process.communicate(text.encode('utf-8'))[0]
+    self.assertEqual(0, process.returncode)
+    self.assertEqual(expected, output.decode('utf-8'))
+
+class TestRangeIndex(unittest.TestCase):
+  def test_list_order(self):
+    # list keeps the post-order of the original recursive code, which the
+    # visualizer traces depend on; iter_range is sorted.
+    rng = random.Random(2)
+    index, reference = RangeIndex(), RecursiveRangeIndex()
+    for step in xrange(3000):
+      key = rng.randint(0, 500)
+      if rng.random() < 0.6:
+        index.add(key)
+        reference.add(key)
+      else:
+        index.remove(key)
+        reference.remove(key)
+      low, high = sorted([rng.randint(0, 500), rng.randint(0, 500)])
+      expected = reference.list(low, high)
+      self.assertEqual(expected, index.list(low, high))
+      self.assertEqual(expected, list(index.iter_list(low, high)))
+      self.assertEqual(sorted(expected), list(index.iter_range(low, high)))
+    index.check_ri()
+
+class TestBTreeRangeIndex(unittest.TestCase):
+  def check_random_operations(self, indexes, seed, key_range=1000):
+    # The reference is a plain sorted list.
+    rng = random.Random(seed)
+    reference = []
+    for step in xrange(5000):
+      key = rng.randint(0, key_range)
+      choice = rng.random()
+      if choice < 0.45:
+        for index in indexes:
+          index.add(key)
+        position = bisect.bisect_left(reference, key)
+        if position == len(reference) or reference[position] != key:
+          reference.insert(position, key)
+      elif choice < 0.8:
+        for index in indexes:
+          index.remove(key)
+        position = bisect.bisect_left(reference, key)
+        if position < len(reference) and reference[position] == key:
+          del reference[position]
+      else:
+        low, high = sorted([key, rng.randint(0, key_range)])
+        expected = reference[bisect.bisect_left(reference, low):
+                             bisect.bisect_right(reference, high)]
+        # count(l, h) counts the keys in (l, h], like RangeIndex._rank does.
+        expected_count = (bisect.bisect_right(reference, high) -
+                          bisect.bisect_right(reference, low))
+        for index in indexes:
+          self.assertEqual(expected, sorted(index.list(low, high)))
+          self.assertEqual(expected_count, index.count(low, high))
+    for index in indexes:
+      self.assertEqual(reference, sorted(index.list(-1, key_range + 1)))
+      index.check_ri()
+
+  def test_against_sorted_list(self):
+    for seed in xrange(4):
+      self.check_random_operations(
+          [RangeIndex(), BTreeRangeIndex(2), BTreeRangeIndex(3),
+           BTreeRangeIndex(8), BTreeRangeIndex()], seed)
+
+  def test_small_key_range(self):
+    # Few distinct keys, so nodes keep splitting and merging.
+    self.check_random_operations([BTreeRangeIndex(2), BTreeRangeIndex(5)], 9,
+                                 key_range=40)
+
+class TestColumnarWireLayer(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'layer.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_matches_wire_layer(self):
+    text = random_layer_text(4)
+    expected = layer_from_text(text).as_json()
+    layer = ColumnarWireLayer.from_file(io.StringIO(text))
+    self.assertEqual(sorted(expected['wires'], key=lambda wire: wire['id']),
+                     sorted(layer.as_json()['wires'],
+                            key=lambda wire: wire['id']))
+
+  def test_duplicate_names(self):
+    layer = ColumnarWireLayer()
+    layer.add_wire('a', 0, 0, 1, 0)
+    self.assertRaises(ValueError, layer.add_wire, 'a', 0, 1, 1, 1)
+    self.assertRaises(ValueError, ColumnarWireLayer.from_text,
+                      'wire a 0 0 1 0\nwire a 0 1 1 1\ndone\n')
+
+  def test_malformed_wire(self):
+    for line in ('wire a 0 0 1', 'wire', 'wire a 0 0 one 0'):
+      self.assertRaises(ValueError, ColumnarWireLayer.from_text,
+                        'wire b 0 0 1 0\n' + line + '\ndone\n')
+
+  def test_binary_round_trip(self):
+    text = random_layer_text(5)
+    ColumnarWireLayer.from_file(io.StringIO(text), cache_path=self.path)
+    layer = ColumnarWireLayer.from_file(io.StringIO(text),
+                                        cache_path=self.path)
+    self.assertIsNotNone(layer.mapping)
+    self.assertEqual(sorted_crossings(CrossVerifier(layer_from_text(text))),
+                     sorted_crossings(ArrayCrossVerifier(layer)))
+    self.assertIsNone(ColumnarWireLayer.from_binary_path(self.path,
+                                                         b'x' * 20))
+
+  def test_rewrite_mapped_file(self):
+    # A layer that maps the file keeps its wires when the file is rewritten.
+    text = random_layer_text(8, 50)
+    ColumnarWireLayer.from_text(text).to_binary_path(self.path)
+    layer = ColumnarWireLayer.from_binary_path(self.path)
+    ColumnarWireLayer.from_text(random_layer_text(9, 80)).to_binary_path(
+        self.path)
+    self.assertEqual(['layer.bin'], os.listdir(self.directory))
+    self.assertEqual(80, len(ColumnarWireLayer.from_binary_path(self.path)))
+    self.assertEqual(sorted_crossings(CrossVerifier(layer_from_text(text))),
+                     sorted_crossings(ArrayCrossVerifier(layer)))
+
+  def test_add_wire_after_load(self):
+    text = random_layer_text(6, 20)
+    ColumnarWireLayer.from_file(io.StringIO(text)).to_binary_path(self.path)
+    layer = ColumnarWireLayer.from_binary_path(self.path)
+    self.assertRaises(ValueError, layer.add_wire, layer.names[0], 0, 0, 1, 0)
+    layer.add_wire('new', 0, 3, 40, 3)
+    expected = layer_from_text(text)
+    expected.add_wire('new', 0, 3, 40, 3)
+    self.assertEqual(21, len(layer))
+    self.assertEqual(sorted_crossings(CrossVerifier(expected)),
+                     sorted_crossings(ArrayCrossVerifier(layer)))
+
+class TestIncrementalCrossVerifier(unittest.TestCase):
+  def check_against_rerun(self, verifier):
+    layer = WireLayer()
+    for name, coordinates in verifier.wires.items():
+      layer.add_wire(name, *coordinates)
+    expected = sorted_crossings(CrossVerifier(layer)) if verifier.wires else []
+    self.assertEqual(len(expected), verifier.count_crossings())
+    self.assertEqual(expected, sorted_crossings(verifier))
+
+  def random_wire(self, rng, grid=40):
+    position = rng.randint(0, grid)
+    start, end = rng.randint(0, grid), rng.randint(0, grid)
+    if rng.random() < 0.5:
+      return start, position, end, position
+    return position, start, position, end
+
+  def test_random_edits(self):
+    for seed in xrange(10):
+      rng = random.Random(seed)
+      verifier = IncrementalCrossVerifier(
+          layer_from_text(random_layer_text(seed, 150)))
+      self.check_against_rerun(verifier)
+      for step in xrange(300):
+        names = list(verifier.wires.keys())
+        choice = rng.random()
+        if choice < 0.4 or not names:
+          verifier.add_wire('n%d' % step, *self.random_wire(rng))
+        elif choice < 0.7:
+          verifier.remove_wire(rng.choice(names))
+        else:
+          verifier.move_wire(rng.choice(names), *self.random_wire(rng))
+        if step % 50 == 49:
+          self.check_against_rerun(verifier)
+
+  def test_empty_start(self):
+    verifier = IncrementalCrossVerifier()
+    self.assertEqual(0, verifier.add_wire('h', 0, 5, 10, 5))
+    self.assertEqual(1, verifier.add_wire('v', 5, 0, 5, 10))
+    self.assertEqual(['v'], verifier.crossings_of('h'))
+    verifier.move_wire('v', 20, 0, 20, 10)
+    self.assertEqual(0, verifier.count_crossings())
+    self.check_against_rerun(verifier)
+
+  def test_bad_move_keeps_wire(self):
+    verifier = IncrementalCrossVerifier()
+    verifier.add_wire('h', 0, 5, 10, 5)
+    verifier.add_wire('v', 5, 0, 5, 10)
+    self.assertRaises(ValueError, verifier.move_wire, 'v', 0, 0, 1, 1)
+    self.assertEqual((5, 0, 5, 10), verifier.wires['v'])
+    self.assertEqual(1, verifier.count_crossings())
+
+class TestSpanIndex(unittest.TestCase):
+  def test_against_brute_force(self):
+    rng = random.Random(1)
+    wires = {}
+    index = SpanIndex()
+    for step in xrange(2000):
+      if rng.random() < 0.7 or not wires:
+        low, high = sorted([rng.randint(0, 50), rng.randint(0, 50)])
+        wires['w%d' % step] = (rng.randint(0, 50), low, high)
+        index.add(wires['w%d' % step][0], low, high, 'w%d' % step)
+      else:
+        name = rng.choice(list(wires.keys()))
+        del wires[name]
+        index.remove(name)
+      point = rng.randint(-1, 51) + rng.choice([0, 0.5])
+      first, last = sorted([rng.randint(0, 50), rng.randint(0, 50)])
+      expected = sorted([name for name, (position, low, high) in wires.items()
+                         if low <= point <= high and
+                            first <= position <= last])
+      self.assertEqual(expected, sorted(index.stab(point, first, last)))
+
+if __name__ == '__main__':
+  unittest.main()